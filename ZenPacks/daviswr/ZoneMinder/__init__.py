@@ -1,4 +1,5 @@
 import os
+from Products.ZenUtils.Utils import monkeypatch
 from ZenPacks.zenoss.ZenPackLib import zenpacklib
 
 CFG = zenpacklib.load_yaml(
@@ -6,3 +7,25 @@ CFG = zenpacklib.load_yaml(
     verbose=False,
     level=30)
 schema = CFG.zenpack_module.schema
+
+
+@monkeypatch('Products.ZenModel.Device.Device')
+def getZoneMinderModel(self):
+    """ Returns the last change time and paths of ZoneMinder components
+
+    Read by the modeler to tell whether the model is still what it
+    last sent. Paths are as zmFingerprint.component_path returns them.
+    """
+    components = list()
+    for zm in self.zoneMinder():
+        path = 'zoneMinder/{0}'.format(zm.id)
+        components.append(path)
+        for relname in ('zmMonitors', 'zmStorage'):
+            components.extend(
+                '{0}/{1}/{2}'.format(path, relname, x)
+                for x in getattr(zm, relname).objectIds()
+                )
+    return {
+        'changed': self.getLastChange().timeTime(),
+        'components': components,
+        }
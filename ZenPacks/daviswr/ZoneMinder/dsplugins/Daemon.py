@@ -6,14 +6,27 @@ LOG = logging.getLogger('zen.ZoneMinder')
 import json
 import re
 
-from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import getPage
+from twisted.internet.defer import DeferredList, inlineCallbacks, returnValue
 
+from Products.DataCollector.plugins.DataMaps import ObjectMap
 from ZenPacks.zenoss.PythonCollector.datasources.PythonDataSource import (
     PythonDataSourcePlugin
     )
 
-from ZenPacks.daviswr.ZoneMinder.lib import zmUtil
+from ZenPacks.daviswr.ZoneMinder.lib import (
+    zmCache,
+    zmCircuit,
+    zmConsole,
+    zmEventServer,
+    zmEvents,
+    zmPlanner,
+    zmProfile,
+    zmSchedule,
+    zmSession,
+    zmStagger,
+    zmUtil,
+    zmWorkers,
+    )
 
 
 class Daemon(PythonDataSourcePlugin):
@@ -38,8 +51,20 @@ class Daemon(PythonDataSourcePlugin):
             'path': context.zZoneMinderPath,
             'ssl': context.zZoneMinderSSL,
             'base_url': context.zZoneMinderURL,
+            'max_requests': context.zZoneMinderMaxRequests,
+            'profiling': context.zZoneMinderProfiling,
+            'jitter': context.zZoneMinderCycleJitter,
+            'version': context.version,
+            'apiversion': context.apiversion,
+            'es_url': context.zZoneMinderEventServerURL,
+            'monitors': dict(
+                (x.id.replace('zmMonitor', ''), (x.Function, x.Enabled))
+                for x in context.zmMonitors()
+                ),
             }
 
+    @zmStagger.staggered
+    @zmProfile.profiled('Daemon', zmProfile.config_device)
     @inlineCallbacks
     def collect(self, config):
         data = self.new_data()
@@ -79,116 +104,224 @@ class Daemon(PythonDataSourcePlugin):
                     base_url
                     )
 
-            api_url = '{0}api/'.format(base_url)
-            login_url = '{0}host/login.json?user={1}'.format(api_url, username)
-            login_url += '&pass={0}&stateful=1'.format(password)
-
-            cookies = dict()
+            session = zmSession.get_session(
+                base_url,
+                username,
+                password,
+                datasource.params['max_requests']
+                )
             try:
-                # Attempt login
-                response = yield getPage(
-                    login_url,
-                    method='POST',
-                    cookies=cookies
-                    )
+                # Log in before fanning out so requests share one login
+                yield session.login()
+            except zmSession.LoginError as e:
+                LOG.error('%s: %s', config.id, e)
+                returnValue(None)
+            except zmCircuit.CircuitOpen as e:
+                LOG.debug('%s: %s', config.id, e)
+                data['events'].append(session.circuit.event(
+                    config.id,
+                    datasource.component
+                    ))
+                continue
+            except Exception:
+                LOG.exception('%s: failed to log in', config.id)
+                continue
+
+            # Only endpoints behind the template's datapoints are requested.
+            # They're independent of each other, so they're requested
+            # concurrently and each may fail on its own.
+            # User might not have View access to Events.
+            api_mode = zmUtil.supports_api_mode(
+                datasource.params['version'],
+                datasource.params['apiversion']
+                )
+            plan = zmPlanner.plan_datasources(
+                session,
+                config.id,
+                'Daemon',
+                [datasource],
+                api_mode
+                )
+
+            # Event counts pushed by the Event Server since this
+            # datasource last read them replace polling
+            pushed = None
+            if datasource.params['es_url']:
+                pushed = zmEventServer.get_client(
+                    session,
+                    datasource.params['es_url'],
+                    datasource.cycletime
+                    ).event_counts((config.id, 'Daemon'), datasource.cycletime)
+                if pushed is not None:
+                    plan.discard('events')
+
+            requests = list()
+            for name in sorted(plan):
+                if 'events' == name:
+                    # Events created since the last cycle
+                    request = zmEvents.event_counts(
+                        session,
+                        datasource.cycletime
+                        )
+                elif 'console' == name:
+                    # Only read as far as needed for the datapoints
+                    # still scraped from it
+                    request = zmConsole.get_console(
+                        session,
+                        datasource.cycletime,
+                        zmConsole.header_only(zmPlanner.served_by(
+                            'Daemon',
+                            [x.id for x in datasource.points],
+                            'console',
+                            api_mode
+                            ))
+                        )
+                else:
+                    request = zmCache.cached_get(
+                        session,
+                        zmPlanner.endpoints[name],
+                        datasource.cycletime
+                        )
+                requests.append((name, request))
+            results = yield DeferredList(
+                [x for (_, x) in requests],
+                consumeErrors=True
+                )
 
-                if ('Login denied' in response
-                        or '"success": false' in response):
+            output = dict()
+            if pushed is not None:
+                output['results'] = pushed
+            for ((name, _), (success, result)) in zip(requests, results):
+                if not success and result.check(zmCircuit.CircuitOpen):
+                    LOG.debug('%s: skipped %s', config.id, name)
+                    continue
+                elif not success:
                     LOG.error(
-                        '%s: ZoneMinder login credentials invalid',
+                        '%s: failed to get %s: %s',
                         config.id,
+                        name,
+                        result.getErrorMessage()
                         )
-                    returnValue(None)
-                elif not cookies:
-                    LOG.error('%s: No cookies received', config.id)
-                    returnValue(None)
-
-                output = dict()
-
-                # Console
-                # Session cookies on 1.34 require view=login on action=login
-                # This returns a 302 to the console page
-                # rather than just the console
-                response = yield getPage(
-                    base_url + 'index.php?view=console',
-                    method='GET',
-                    cookies=cookies
-                    )
-
-                # Scrape shared memory utilization from HTML
-                output['devshm'] = zmUtil.scrape_console_shm(response)
-
-                # Scrape DB connection counts from HTML
-                output['db'] = zmUtil.scrape_console_db(response)
-
-                # Scrape total capture bandwidth from HTML
-                output['bandwidth'] = zmUtil.scrape_console_bandwidth(response)
-
-                # Scrape system capturing percentage from HTML
-                output['capturing'] = zmUtil.scrape_console_capturing(response)
-
-                # Daemon status
-                response = yield getPage(
-                    api_url + 'host/daemonCheck.json',
-                    method='GET',
-                    cookies=cookies
-                    )
-                output.update(json.loads(response))
-
-                # Run state
-                response = yield getPage(
-                    api_url + 'states.json',
-                    method='GET',
-                    cookies=cookies
-                    )
-                output.update(json.loads(response))
-
-                # Host Load
-                response = yield getPage(
-                    api_url + 'host/getLoad.json',
-                    method='GET',
-                    cookies=cookies
-                    )
-                output.update(json.loads(response))
-
-            except Exception:
-                LOG.exception('%s: failed to get daemon data', config.id)
-                continue
-
-            # User might not have View access to Events
-            try:
-                # Five-minute event counts
-                response = yield getPage(
-                    api_url + r'events/consoleEvents/300%20second.json',
-                    method='GET',
-                    cookies=cookies
-                    )
-                output.update(json.loads(response))
-            except Exception:
-                LOG.exception('%s: failed to get event counts', config.id)
+                    continue
 
-            try:
-                # API logout
-                yield getPage(
-                    api_url + 'host/logout.json',
-                    method='GET',
-                    cookies=cookies
-                    )
-            except Exception:
-                LOG.exception('%s: failed to log out', config.id)
+                try:
+                    if 'console' == name:
+                        # Scrape shared memory utilization, DB connections,
+                        # total capture bandwidth, and capturing percentage
+                        console = result
+                        output['devshm'] = console.shm
+                        output['db'] = console.db
+                        # Not in the header, if that's all that was read
+                        if '' != console.capturing:
+                            output['bandwidth'] = console.bandwidth
+                            output['capturing'] = console.capturing
+                    elif 'events' == name:
+                        output['results'] = result
+                    else:
+                        response = yield zmWorkers.parse(
+                            session.stats,
+                            json.loads,
+                            result
+                            )
+                        if 'monitors' == name:
+                            monitors = response.get('monitors', list())
+                            zmSchedule.update(session, config.id, monitors)
+                            # Console values stand if any status is missing
+                            if monitors and all(
+                                    x.get('Monitor_Status') for x in monitors
+                                    ):
+                                output.update(
+                                    zmUtil.summarize_monitors(monitors)
+                                    )
+                        elif 'daemonCheck' == name:
+                            # Daemon status ("result")
+                            output['result'] = response.get('result', '0')
+                        else:
+                            output.update(response)
+                except Exception:
+                    LOG.exception('%s: failed to parse %s', config.id, name)
+
+            # Fall back to the Console if the API lacked monitor status
+            if 'monitors' in plan and 'capturing' not in output:
+                try:
+                    console = yield zmConsole.get_console(
+                        session,
+                        datasource.cycletime
+                        )
+                    output['bandwidth'] = console.bandwidth
+                    output['capturing'] = console.capturing
+                except zmCircuit.CircuitOpen as e:
+                    LOG.debug('%s: %s', config.id, e)
+                except Exception:
+                    LOG.exception('%s: failed to get console', config.id)
 
             LOG.debug('%s: ZM daemon output:\n%s', config.id, output)
+            LOG.debug(
+                '%s: ZM response cache %s',
+                config.id,
+                session.cache.stats()
+                )
 
             stats = dict()
             # Daemon status ("result")
-            stats['result'] = output.get('result', '0')
-
-            states = output.get('states', list())
-            if len(states) > 0:
-                for state in states:
-                    if state.get('State', dict()).get('IsActive', '0') == '1':
-                        stats['state'] = state['State']['Id']
-                        break
+            if 'result' in output:
+                stats['result'] = output['result']
+
+            state = zmUtil.active_state(output.get('states', list()))
+            if state is not None:
+                stats['state'] = state
+
+            # Monitor Functions follow the run state. Once it's settled,
+            # only the Function and Enabled of monitors that changed are
+            # updated, rather than remodeling the whole device.
+            if 'state' in stats and zmSchedule.state_changed(
+                    session,
+                    config.id,
+                    stats['state']
+                    ):
+                try:
+                    stats['state'] = yield zmSchedule.settle(
+                        config.id,
+                        session,
+                        stats['state']
+                        )
+                    response = yield session.get(
+                        zmPlanner.endpoints['monitors']
+                        )
+                    # Only Function and Enabled are needed, so it's
+                    # trimmed as it's decoded
+                    response = yield zmWorkers.parse(
+                        session.stats,
+                        zmUtil.load_monitors,
+                        response
+                        )
+                    monitors = response.get('monitors', list())
+                    zmSchedule.update(session, config.id, monitors)
+                    changes = zmSchedule.changes(
+                        monitors,
+                        datasource.params['monitors']
+                        )
+                    for (monitor_id, function, enabled) in changes:
+                        data['maps'].append(ObjectMap(
+                            modname='ZenPacks.daviswr.ZoneMinder.ZMMonitor',
+                            compname='zoneMinder/{0}/zmMonitors/{1}'.format(
+                                datasource.component,
+                                'zmMonitor{0}'.format(monitor_id)
+                                ),
+                            data={'Function': function, 'Enabled': enabled}
+                            ))
+                    LOG.info(
+                        '%s: ZM run state changed, updating %s monitors',
+                        config.id,
+                        len(changes)
+                        )
+                except zmCircuit.CircuitOpen as e:
+                    LOG.debug('%s: %s', config.id, e)
+                except Exception:
+                    LOG.exception(
+                        '%s: failed to update monitors after run state change',
+                        config.id
+                        )
 
             load = output.get('load', list())
             if len(load) >= 3:
@@ -201,12 +334,22 @@ class Daemon(PythonDataSourcePlugin):
                     stats[metric] = output[metric]
 
             # Event counts ("results", plural)
-            events = output.get('results', list())
-            stats['events'] = 0
-            # "results" will be an empty *list* if no monitors have events
-            if len(events) > 0:
-                for key in events.keys():
-                    stats['events'] += int(events.get(key, 0))
+            if 'results' in output:
+                events = output['results']
+                stats['events'] = 0
+                # "results" will be an empty *list* if no monitors have events
+                if len(events) > 0:
+                    for key in events.keys():
+                        stats['events'] += int(events.get(key, 0))
+
+            # The collector's own requests to and time spent on the
+            # server, from every plugin, since this plugin last ran
+            stats.update(session.stats.take())
+
+            data['events'].append(session.circuit.event(
+                config.id,
+                datasource.component
+                ))
 
             for datapoint_id in (x.id for x in datasource.points):
                 if datapoint_id not in stats:
@@ -7,13 +7,25 @@ import json
 import re
 
 from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import getPage
 
 from ZenPacks.zenoss.PythonCollector.datasources.PythonDataSource import (
     PythonDataSourcePlugin
     )
 
-from ZenPacks.daviswr.ZoneMinder.lib import zmUtil
+from ZenPacks.daviswr.ZoneMinder.lib import (
+    zmCache,
+    zmCircuit,
+    zmConsole,
+    zmEventServer,
+    zmEvents,
+    zmPlanner,
+    zmProfile,
+    zmSchedule,
+    zmSession,
+    zmStagger,
+    zmUtil,
+    zmWorkers,
+    )
 
 
 class Monitor(PythonDataSourcePlugin):
@@ -21,10 +33,11 @@ class Monitor(PythonDataSourcePlugin):
 
     @classmethod
     def config_key(cls, datasource, context):
+        # Batch every monitor on the device into a single task,
+        # the API and Console report on all monitors at once
         return(
             context.device().id,
             datasource.getCycleTime(context),
-            context.id,
             'zoneminder-monitor',
             )
 
@@ -38,165 +51,230 @@ class Monitor(PythonDataSourcePlugin):
             'path': context.zZoneMinderPath,
             'ssl': context.zZoneMinderSSL,
             'base_url': context.zZoneMinderURL,
+            'max_requests': context.zZoneMinderMaxRequests,
+            'profiling': context.zZoneMinderProfiling,
+            'jitter': context.zZoneMinderCycleJitter,
+            'version': zmUtil.get_daemon(context).version,
+            'apiversion': zmUtil.get_daemon(context).apiversion,
+            'es_url': context.zZoneMinderEventServerURL,
+            'function': context.Function,
+            'enabled': context.Enabled,
             }
 
+    @zmStagger.staggered
+    @zmProfile.profiled('Monitor', zmProfile.config_device)
     @inlineCallbacks
     def collect(self, config):
         data = self.new_data()
 
-        for datasource in config.datasources:
-            # LOG.debug('%s: parameters\n%s', config.id, datasource.params)
-            username = datasource.params['username']
-            password = datasource.params['password']
-            hostname = datasource.params['hostname']
-            port = datasource.params['port']
-            path = datasource.params['path']
-            ssl = datasource.params['ssl']
-            base_url = datasource.params['base_url']
-            comp_id = datasource.component.replace('zmMonitor', '')
+        if not config.datasources:
+            returnValue(data)
+
+        # Connection parameters are device-level zProperties,
+        # so they're the same for every datasource in the batch
+        params = config.datasources[0].params
+        # LOG.debug('%s: parameters\n%s', config.id, params)
+        username = params['username']
+        password = params['password']
+        hostname = params['hostname']
+        port = params['port']
+        path = params['path']
+        ssl = params['ssl']
+        base_url = params['base_url']
+        cycletime = config.datasources[0].cycletime
+
+        if not username or not password:
+            LOG.error(
+                '%s: zZoneMinderUsername or zZoneMinderPassword not set',
+                config.id
+                )
+            returnValue(None)
+
+        base_url = zmUtil.generate_zm_url(
+            hostname=hostname or config.id,
+            port=port or 443,
+            path=path or '/zm/',
+            ssl=ssl or True,
+            url=base_url
+            )
 
-            if not username or not password:
-                LOG.error(
-                    '%s: zZoneMinderUsername or zZoneMinderPassword not set',
-                    config.id
-                    )
-                returnValue(None)
-
-            base_url = zmUtil.generate_zm_url(
-                hostname=hostname or config.id,
-                port=port or 443,
-                path=path or '/zm/',
-                ssl=ssl or True,
-                url=base_url
+        if re.match(zmUtil.url_regex, base_url) is None:
+            LOG.error('%s: %s is not a valid URL', config.id, base_url)
+            returnValue(None)
+        else:
+            LOG.debug(
+                '%s: using base ZoneMinder URL %s',
+                config.id,
+                base_url
                 )
 
-            if re.match(zmUtil.url_regex, base_url) is None:
-                LOG.error('%s: %s is not a valid URL', config.id, base_url)
-                returnValue(None)
-            else:
-                LOG.debug(
-                    '%s: using base ZoneMinder URL %s',
-                    config.id,
-                    base_url
-                    )
+        session = zmSession.get_session(
+            base_url,
+            username,
+            password,
+            params['max_requests']
+            )
 
-            api_url = '{0}api/'.format(base_url)
-            login_url = '{0}host/login.json?user={1}'.format(api_url, username)
-            login_url += '&pass={0}&stateful=1'.format(password)
-            mon_url = 'monitors/daemonStatus/id:{0}/daemon:zmc.json'.format(
-                comp_id
+        # Monitors with no Function aren't polled at all, and events
+        # are only counted for monitors that create them. Functions are
+        # as modeled until monitors.json shows they've since changed.
+        schedule = dict()
+        active = list()
+        for datasource in config.datasources:
+            schedule[datasource.component] = zmSchedule.get_function(
+                session,
+                config.id,
+                datasource.component.replace('zmMonitor', ''),
+                datasource.params['function'],
+                datasource.params['enabled']
                 )
-
-            cookies = dict()
-            try:
-                # Attempt login
-                response = yield getPage(
-                    login_url,
-                    method='POST',
-                    cookies=cookies
+            if zmSchedule.is_polled(schedule[datasource.component][0]):
+                active.append(datasource)
+
+        if not active:
+            LOG.debug('%s: no ZM monitors with a Function to poll', config.id)
+            returnValue(data)
+
+        # Only endpoints behind the template's datapoints are requested.
+        # Online state comes from Monitor_Status where supported,
+        # and is only scraped from the Console as a fallback.
+        api_mode = zmUtil.supports_api_mode(
+            params['version'],
+            params['apiversion']
+            )
+        plan = zmPlanner.plan_datasources(
+            session,
+            config.id,
+            'Monitor',
+            active,
+            api_mode
+            )
+        if not any(zmSchedule.has_events(*x) for x in schedule.values()):
+            plan.discard('events')
+
+        # Event counts pushed by the Event Server since this datasource
+        # last read them, and alarm state, replace polling
+        pushed = None
+        alarms = None
+        if params['es_url']:
+            client = zmEventServer.get_client(
+                session,
+                params['es_url'],
+                cycletime
+                )
+            pushed = client.event_counts((config.id, 'Monitor'), cycletime)
+            alarms = client.alarm_states()
+            if pushed is not None:
+                plan.discard('events')
+
+        datapoints = set(dp.id for ds in active for dp in ds.points)
+        monitors = dict()
+        console = None
+        try:
+            if 'monitors' in plan:
+                # All monitors, including their Monitor_Status
+                response = yield zmCache.cached_get(
+                    session,
+                    zmPlanner.endpoints['monitors'],
+                    cycletime
                     )
-
-                output = dict()
-
-                if ('Login denied' in response
-                        or '"success": false' in response):
-                    LOG.error(
-                        '%s: ZoneMinder login credentials invalid',
-                        config.id,
-                        )
-                    returnValue(None)
-                elif not cookies:
-                    LOG.error('%s: No cookies received', config.id)
-                    returnValue(None)
-
-                # Console
+                response = yield zmWorkers.parse(
+                    session.stats,
+                    json.loads,
+                    response
+                    )
+                items = response.get('monitors', list())
+                zmSchedule.update(session, config.id, items)
+                for item in items:
+                    monitor_id = item.get('Monitor', dict()).get('Id')
+                    if monitor_id:
+                        monitors[str(monitor_id)] = item
+
+            # Fall back to the Console for online state if the API
+            # didn't include Monitor_Status after all
+            if api_mode and 'online' in datapoints and not all(
+                    monitors.get(
+                        x.component.replace('zmMonitor', ''),
+                        dict()
+                        ).get('Monitor_Status')
+                    for x in active
+                    ):
+                plan.add('console')
+
+            if 'console' in plan:
                 # Session cookies on 1.34 require view=login on action=login
                 # This returns a 302 to the console page
                 # rather than just the console
-                response = yield getPage(
-                    base_url + 'index.php?view=console',
-                    method='GET',
-                    cookies=cookies
+                console = yield zmConsole.get_console(session, cycletime)
+
+        except zmSession.LoginError as e:
+            LOG.error('%s: %s', config.id, e)
+            returnValue(None)
+        except zmCircuit.CircuitOpen as e:
+            LOG.debug('%s: %s', config.id, e)
+            returnValue(None)
+        except Exception:
+            LOG.exception('%s: failed to get monitor data', config.id)
+            returnValue(None)
+
+        events = dict() if pushed is None else pushed
+        # User might not have View access to Events
+        if 'events' in plan:
+            try:
+                # Events created since the last cycle
+                events = yield zmEvents.event_counts(session, cycletime)
+            except zmCircuit.CircuitOpen as e:
+                LOG.debug('%s: %s', config.id, e)
+            except Exception:
+                LOG.exception('%s: failed to get event counts', config.id)
+
+        for datasource in active:
+            comp_id = datasource.component.replace('zmMonitor', '')
+            stats = dict()
+
+            monitor = monitors.get(comp_id, dict())
+            if not monitor and 'monitors' in plan:
+                LOG.warn(
+                    '%s: %s not found in ZM API monitors',
+                    config.id,
+                    datasource.component
                     )
 
+            if console is None:
+                if monitor.get('Monitor_Status'):
+                    stats['online'] = zmUtil.monitor_online(monitor)
+            else:
                 # Scrape monitor online status from HTML
-                output['online'] = zmUtil.scrape_console_monitor(
-                    response,
-                    comp_id
-                    )
+                stats['online'] = console.monitors.get(comp_id, '')
 
-                if not output['online']:
+                if not stats['online']:
                     LOG.warn(
                         '%s: %s not found in ZM web console',
                         config.id,
                         datasource.component
                         )
 
-                # Monitor enabled
-                response = yield getPage(
-                    api_url + 'monitors/{0}.json'.format(comp_id),
-                    method='GET',
-                    cookies=cookies
-                    )
-                output.update(json.loads(response))
-
-                # Monitor process status
-                response = yield getPage(
-                    api_url + mon_url,
-                    method='GET',
-                    cookies=cookies
-                    )
-                output.update(json.loads(response))
-
-            except Exception:
-                LOG.exception('%s: failed to get monitor data', config.id)
-                continue
-
-            # User might not have View access to Events
-            try:
-                # Five-minute event counts
-                response = yield getPage(
-                    api_url + 'events/consoleEvents/300%20second.json',
-                    method='GET',
-                    cookies=cookies
-                    )
-                output.update(json.loads(response))
-            except Exception:
-                LOG.exception('%s: failed to get event counts', config.id)
-
-            try:
-                # API logout
-                yield getPage(
-                    api_url + 'host/logout.json',
-                    method='GET',
-                    cookies=cookies
-                    )
-            except Exception:
-                LOG.exception('%s: failed to log out', config.id)
-
-            LOG.debug('%s: ZM monitor output:\n%s', config.id, output)
-
-            stats = dict()
-
-            if 'online' in output:
-                stats['online'] = output['online']
-
             # 1.32+ Monitor Status
-            stats.update(output.get('monitor', dict()).get(
-                'Monitor_Status',
-                dict()
-                ))
+            stats.update(monitor.get('Monitor_Status') or dict())
 
             # 1.32+
             stats['status'] = (1 if stats.get('Status', '') == 'Connected'
                                else 0)
 
-            events = output.get('results', list())
-            # "results" will be an empty *list* if no monitors have events
-            if len(events) > 0:
-                stats['events'] = int(events.get(comp_id, 0))
-            else:
+            if not zmSchedule.has_events(*schedule[datasource.component]):
                 stats['events'] = 0
+            elif 'events' in plan or pushed is not None:
+                stats['events'] = int(events.get(comp_id, 0))
+
+            if alarms is not None:
+                stats['alarm'] = alarms.get(comp_id, 0)
+
+            LOG.debug(
+                '%s: ZM monitor %s output:\n%s',
+                config.id,
+                comp_id,
+                stats
+                )
 
             for datapoint_id in (x.id for x in datasource.points):
                 if datapoint_id not in stats:
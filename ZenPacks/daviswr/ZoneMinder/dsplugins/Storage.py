@@ -7,13 +7,21 @@ import json
 import re
 
 from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import getPage
 
 from ZenPacks.zenoss.PythonCollector.datasources.PythonDataSource import (
     PythonDataSourcePlugin
     )
 
-from ZenPacks.daviswr.ZoneMinder.lib import zmUtil
+from ZenPacks.daviswr.ZoneMinder.lib import (
+    zmCircuit,
+    zmConsole,
+    zmPlanner,
+    zmProfile,
+    zmSession,
+    zmStagger,
+    zmUtil,
+    zmWorkers,
+    )
 
 
 class Storage(PythonDataSourcePlugin):
@@ -21,10 +29,11 @@ class Storage(PythonDataSourcePlugin):
 
     @classmethod
     def config_key(cls, datasource, context):
+        # Batch every volume on the device into a single task,
+        # the API and Console report on all volumes at once
         return(
             context.device().id,
             datasource.getCycleTime(context),
-            context.id,
             'zoneminder-storage',
             )
 
@@ -38,127 +47,136 @@ class Storage(PythonDataSourcePlugin):
             'path': context.zZoneMinderPath,
             'ssl': context.zZoneMinderSSL,
             'base_url': context.zZoneMinderURL,
+            'max_requests': context.zZoneMinderMaxRequests,
+            'profiling': context.zZoneMinderProfiling,
+            'jitter': context.zZoneMinderCycleJitter,
             }
 
+    @zmStagger.staggered
+    @zmProfile.profiled('Storage', zmProfile.config_device)
     @inlineCallbacks
     def collect(self, config):
         data = self.new_data()
 
-        for datasource in config.datasources:
-            # LOG.debug('%s: parameters\n%s', config.id, datasource.params)
-            username = datasource.params['username']
-            password = datasource.params['password']
-            hostname = datasource.params['hostname']
-            port = datasource.params['port']
-            path = datasource.params['path']
-            ssl = datasource.params['ssl']
-            base_url = datasource.params['base_url']
-            comp_id = datasource.component.replace('zmStorage_', '')
-
-            if not username or not password:
-                LOG.error(
-                    '%s: zZoneMinderUsername or zZoneMinderPassword not set',
-                    config.id
-                    )
-                returnValue(None)
-
-            base_url = zmUtil.generate_zm_url(
-                hostname=hostname or config.id,
-                port=port or 443,
-                path=path or '/zm/',
-                ssl=ssl or True,
-                url=base_url
+        if not config.datasources:
+            returnValue(data)
+
+        # Connection parameters are device-level zProperties,
+        # so they're the same for every datasource in the batch
+        params = config.datasources[0].params
+        # LOG.debug('%s: parameters\n%s', config.id, params)
+        username = params['username']
+        password = params['password']
+        hostname = params['hostname']
+        port = params['port']
+        path = params['path']
+        ssl = params['ssl']
+        base_url = params['base_url']
+        cycletime = config.datasources[0].cycletime
+
+        if not username or not password:
+            LOG.error(
+                '%s: zZoneMinderUsername or zZoneMinderPassword not set',
+                config.id
                 )
+            returnValue(None)
+
+        base_url = zmUtil.generate_zm_url(
+            hostname=hostname or config.id,
+            port=port or 443,
+            path=path or '/zm/',
+            ssl=ssl or True,
+            url=base_url
+            )
 
-            if re.match(zmUtil.url_regex, base_url) is None:
-                LOG.error('%s: %s is not a valid URL', config.id, base_url)
-                returnValue(None)
-            else:
-                LOG.debug(
-                    '%s: using base ZoneMinder URL %s',
-                    config.id,
-                    base_url
-                    )
+        if re.match(zmUtil.url_regex, base_url) is None:
+            LOG.error('%s: %s is not a valid URL', config.id, base_url)
+            returnValue(None)
+        else:
+            LOG.debug(
+                '%s: using base ZoneMinder URL %s',
+                config.id,
+                base_url
+                )
 
-            api_url = '{0}api/'.format(base_url)
-            login_url = '{0}host/login.json?user={1}'.format(api_url, username)
-            login_url += '&pass={0}&stateful=1'.format(password)
-
-            cookies = dict()
-            try:
-                # Attempt login
-                response = yield getPage(
-                    login_url,
-                    method='POST',
-                    cookies=cookies
-                    )
+        session = zmSession.get_session(
+            base_url,
+            username,
+            password,
+            params['max_requests']
+            )
+        # Only endpoints behind the template's datapoints are requested
+        plan = zmPlanner.plan_datasources(
+            session,
+            config.id,
+            'Storage',
+            config.datasources
+            )
 
-                if ('Login denied' in response
-                        or '"success": false' in response):
-                    LOG.error(
-                        '%s: ZoneMinder login credentials invalid',
-                        config.id,
-                        )
-                    returnValue(None)
-                elif not cookies:
-                    LOG.error('%s: No cookies received', config.id)
-                    returnValue(None)
-
-                # Console
+        volumes = dict()
+        storage = list()
+        try:
+            if 'console' in plan:
                 # Session cookies on 1.34 require view=login on action=login
                 # This returns a 302 to the console page
                 # rather than just the console
-                response = yield getPage(
-                    '{0}index.php?view=console'.format(base_url),
-                    method='GET',
-                    cookies=cookies
+                # Storage info is in the header, so the rest of the page
+                # is only read if another plugin needs it this cycle
+                console = yield zmConsole.get_console(
+                    session,
+                    cycletime,
+                    header=True
+                    )
+                # Copied, as the snapshot is shared
+                volumes = dict(
+                    (name, dict(store))
+                    for (name, store) in console.volumes.items()
                     )
 
-                # Scrape storage info from HTML
-                volumes = zmUtil.scrape_console_volumes(response)
-
-                if comp_id not in volumes:
-                    LOG.warn(
-                        '%s: %s not found in ZM web console',
-                        config.id,
-                        datasource.component
-                        )
-
-                # Storage
-                storage = list()
-                response = yield getPage(
-                    api_url + 'storage.json',
-                    method='GET',
-                    cookies=cookies
+            if 'storage' in plan:
+                response = yield session.get(zmPlanner.endpoints['storage'])
+                response = yield zmWorkers.parse(
+                    session.stats,
+                    json.loads,
+                    response
                     )
-                storage = json.loads(response).get('storage', list())
+                storage = response.get('storage', list())
+
+        except zmSession.LoginError as e:
+            LOG.error('%s: %s', config.id, e)
+            returnValue(None)
+        except zmCircuit.CircuitOpen as e:
+            LOG.debug('%s: %s', config.id, e)
+            returnValue(None)
+        except Exception:
+            LOG.exception('%s: failed to get store data', config.id)
+            returnValue(None)
+
+        # Combine storage info from API with that scraped from Console
+        for item in storage:
+            store = item['Storage']
+            if store['Name'] in volumes:
+                volumes[store['Name']].update(store)
+            # Scraping failed
+            else:
+                volumes[store['Name']] = store
 
-                # API logout
-                yield getPage(
-                    api_url + 'host/logout.json',
-                    method='GET',
-                    cookies=cookies
+            if 'DiskSpace' in volumes[store['Name']]:
+                volumes[store['Name']]['events'] = int(
+                    volumes[store['Name']]['DiskSpace']
                     )
 
-            except Exception:
-                LOG.exception('%s: failed to get store data', config.id)
-                continue
-
-            # Combine storage info from API with that scraped from Console
-            for item in storage:
-                store = item['Storage']
-                if store['Name'] in volumes:
-                    volumes[store['Name']].update(store)
-                # Scraping failed
-                else:
-                    volumes[store['Name']] = store
-
-                if 'DiskSpace' in volumes[store['Name']]:
-                    volumes[store['Name']]['events'] = int(
-                        volumes[store['Name']]['DiskSpace']
-                        )
-
-            LOG.debug('%s: ZM storage output:\n%s', config.id, volumes)
+        LOG.debug('%s: ZM storage output:\n%s', config.id, volumes)
+
+        for datasource in config.datasources:
+            comp_id = datasource.component.replace('zmStorage_', '')
+
+            if comp_id not in volumes:
+                LOG.warn(
+                    '%s: %s not found in ZM web console or API',
+                    config.id,
+                    datasource.component
+                    )
 
             stats = volumes.get(comp_id, dict())
 
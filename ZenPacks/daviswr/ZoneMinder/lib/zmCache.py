@@ -0,0 +1,107 @@
+""" Short-lived ZoneMinder response cache, shared by collection tasks """
+
+import logging
+LOG = logging.getLogger('zen.ZoneMinder')
+
+import time
+
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+
+# Fraction of the datasource cycle time a response stays cached,
+# short enough that the next cycle always fetches a fresh copy
+ttl_ratio = 0.5
+
+
+def cycle_ttl(cycletime):
+    """ Returns the cache lifetime for a datasource cycle time """
+    try:
+        return max(int(cycletime) * ttl_ratio, 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def cached_get(session, path, cycletime):
+    """ Requests a path through a session, at most once per cycle """
+    return session.cache.fetch(
+        path,
+        cycle_ttl(cycletime),
+        session.get,
+        path
+        )
+
+
+class ResponseCache(object):
+    """ Caches responses for a ZoneMinder server for a limited time
+
+    Callers asking for a response that's already being fetched wait
+    for that request rather than sending another. Failed requests
+    aren't cached.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.entries = dict()
+        self.pending = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def purge(self, now=None):
+        """ Drops expired responses """
+        now = now or time.time()
+        for key in [k for k, v in self.entries.items() if v[0] <= now]:
+            del self.entries[key]
+
+    def clear(self):
+        """ Drops every response """
+        self.entries = dict()
+
+    def has(self, key):
+        """ Whether a response is cached or being fetched """
+        self.purge()
+        return key in self.entries or key in self.pending
+
+    def fetch(self, key, ttl, func, *args, **kwargs):
+        """ Returns a Deferred firing with a cached or fresh response """
+        now = time.time()
+        self.purge(now)
+
+        if key in self.entries:
+            self.hits += 1
+            LOG.debug('%s: cache hit for %s', self.name, key)
+            return succeed(self.entries[key][1])
+        elif key in self.pending:
+            self.hits += 1
+            LOG.debug('%s: waiting on in-flight %s', self.name, key)
+            waiter = Deferred()
+            self.pending[key].append(waiter)
+            return waiter
+
+        self.misses += 1
+        self.pending[key] = list()
+
+        def finished(result, cache):
+            waiters = self.pending.pop(key, list())
+            if cache and ttl > 0:
+                self.entries[key] = (time.time() + ttl, result)
+            for waiter in waiters:
+                if cache:
+                    waiter.callback(result)
+                else:
+                    waiter.errback(result)
+            return result
+
+        request = maybeDeferred(func, *args, **kwargs)
+        request.addCallbacks(
+            finished,
+            finished,
+            callbackArgs=(True,),
+            errbackArgs=(False,)
+            )
+        return request
+
+    def stats(self):
+        """ Returns the hit and miss counters """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            }
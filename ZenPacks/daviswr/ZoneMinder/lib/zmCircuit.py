@@ -0,0 +1,172 @@
+""" Per-server request limiter and circuit breaker for ZoneMinder """
+
+import logging
+LOG = logging.getLogger('zen.ZoneMinder')
+
+import time
+
+from twisted.internet.defer import (
+    DeferredSemaphore,
+    inlineCallbacks,
+    returnValue
+    )
+
+# Default cap on requests in flight to one ZoneMinder server
+max_requests = 4
+
+# Consecutive failed requests that open the circuit
+failure_threshold = 5
+
+# Seconds the circuit stays open before a probe request is let through,
+# doubling each time the probe fails, up to the maximum
+reset_timeout = 60
+max_reset_timeout = 600
+
+(CLOSED, OPEN, HALF_OPEN) = ('closed', 'open', 'half-open')
+
+
+class CircuitOpen(Exception):
+    """ Requests to the ZoneMinder server are suspended """
+
+
+def is_server_failure(error):
+    """ Whether an error means the server itself is failing
+
+    Connection failures, timeouts, and 5xx responses count. Other
+    HTTP errors mean the server is up and answering.
+    """
+    try:
+        return int(getattr(error, 'status', None)) >= 500
+    except (TypeError, ValueError):
+        return True
+
+
+class Circuit(object):
+    """ Guards every request to one ZoneMinder server
+
+    Caps the requests in flight, and stops sending any once
+    `failure_threshold` requests in a row have failed, so tasks fail
+    fast rather than queueing behind a hung server. After a while a
+    single probe request is let through, closing the circuit again
+    if it succeeds.
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.semaphore = DeferredSemaphore(max_requests)
+        self.state = CLOSED
+        self.failures = 0
+        self.timeout = reset_timeout
+        self.retry_at = 0
+        self.last_error = ''
+
+    def set_limit(self, limit):
+        """ Sets the cap on requests in flight to the server """
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            return
+        if limit > 0 and limit != self.semaphore.limit:
+            # Requests already holding the old semaphore release it
+            # when done, new requests queue on the new one
+            self.semaphore = DeferredSemaphore(limit)
+
+    def is_open(self):
+        """ Whether requests are currently being refused """
+        return CLOSED != self.state
+
+    def _refuse(self):
+        raise CircuitOpen(
+            'requests suspended after {0}, retrying in {1:.0f}s'.format(
+                self.last_error or 'repeated failures',
+                max(self.retry_at - time.time(), 0)
+                )
+            )
+
+    def _before(self):
+        """ Returns True if a request is the probe, or refuses it """
+        if CLOSED == self.state:
+            return False
+        elif OPEN == self.state and time.time() >= self.retry_at:
+            self.state = HALF_OPEN
+            LOG.info('%s: probing ZoneMinder server', self.base_url)
+            return True
+        self._refuse()
+
+    def _succeeded(self):
+        if CLOSED != self.state:
+            LOG.warn(
+                '%s: ZoneMinder server responding, resuming requests',
+                self.base_url
+                )
+        self.state = CLOSED
+        self.failures = 0
+        self.timeout = reset_timeout
+        self.last_error = ''
+
+    def _failed(self, error, probe):
+        if not is_server_failure(error):
+            self._succeeded()
+            return
+
+        self.failures += 1
+        self.last_error = str(error) or error.__class__.__name__
+        if probe:
+            self.timeout = min(self.timeout * 2, max_reset_timeout)
+        elif self.failures < failure_threshold or CLOSED != self.state:
+            return
+        else:
+            LOG.warn(
+                '%s: %s ZoneMinder requests failed, suspending requests '
+                'for %ss: %s',
+                self.base_url,
+                self.failures,
+                self.timeout,
+                self.last_error
+                )
+        self.state = OPEN
+        self.retry_at = time.time() + self.timeout
+
+    def event(self, device, component):
+        """ Returns an event for the circuit's state
+
+        One event per server, rather than an error from every request.
+        """
+        event = {
+            'device': device,
+            'component': component,
+            'eventKey': 'Daemon-Circuit',
+            'eventClass': '/Status/ZoneMinder',
+            'severity': 0,
+            'current': 1,
+            'summary': 'ZoneMinder server responding',
+            }
+        if self.is_open():
+            event['severity'] = 4
+            event['current'] = 0
+            event['summary'] = (
+                'ZoneMinder server not responding, requests suspended: '
+                '{0}'.format(self.last_error)
+                )
+        return event
+
+    @inlineCallbacks
+    def run(self, func, *args, **kwargs):
+        """ Calls a request function, if the circuit allows it """
+        if OPEN == self.state and time.time() < self.retry_at:
+            self._refuse()
+
+        semaphore = self.semaphore
+        yield semaphore.acquire()
+        try:
+            # The circuit may have opened while waiting
+            probe = self._before()
+            try:
+                result = yield func(*args, **kwargs)
+            except Exception as e:
+                self._failed(e, probe)
+                raise
+            self._succeeded()
+            returnValue(result)
+        finally:
+            semaphore.release()
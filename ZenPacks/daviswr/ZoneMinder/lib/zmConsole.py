@@ -0,0 +1,41 @@
+""" The Console page, streamed and parsed at most once per cycle """
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmCache, zmPlanner, zmUtil
+
+# Datapoints scraped from the Console header, above the monitor table
+header_datapoints = ('devshm', 'db-used', 'db-max', 'used', 'total', 'percent')
+
+
+def header_only(datapoints):
+    """ Whether Console datapoints are all found in its header """
+    return all(x in header_datapoints for x in datapoints)
+
+
+def get_console(session, cycletime, header=False):
+    """ Returns a Deferred firing with a ConsoleSnapshot
+
+    The page is parsed as it's received rather than buffered. With
+    header set, reading stops at the monitor table, so the snapshot
+    has no monitors, bandwidth, or capturing percentage. Snapshots are
+    shared by every plugin polling the server, so are read-only.
+    """
+    cache = session.cache
+    ttl = zmCache.cycle_ttl(cycletime)
+    path = zmPlanner.endpoints['console']
+    # A whole page parsed this cycle has the header too
+    if header and not cache.has('console'):
+        return cache.fetch(
+            'console header',
+            ttl,
+            session.stream,
+            path,
+            zmUtil.ConsoleParser,
+            zmUtil.ConsoleParser.header_parsed
+            )
+    return cache.fetch(
+        'console',
+        ttl,
+        session.stream,
+        path,
+        zmUtil.ConsoleParser
+        )
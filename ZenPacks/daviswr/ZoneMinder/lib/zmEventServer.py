@@ -0,0 +1,424 @@
+""" Push-mode client for the ZoneMinder Event Notification Server """
+
+import logging
+LOG = logging.getLogger('zen.ZoneMinder')
+
+import base64
+import collections
+import hashlib
+import json
+import os
+import struct
+import urlparse
+
+from twisted.internet import reactor
+from twisted.internet.protocol import Protocol, ReconnectingClientFactory
+from twisted.internet.ssl import CertificateOptions
+from twisted.internet.task import LoopingCall
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmEvents
+
+# Seconds after a monitor's last alarm that it's assumed to have
+# ended, without end notifications
+alarm_timeout = 300
+
+# Seconds between reconnection attempts, growing up to the maximum
+initial_delay = 5
+max_delay = 300
+
+# Seconds between websocket pings, the connection is dropped and
+# reconnected if nothing's been heard for two intervals
+ping_interval = 60
+
+# Largest handshake response accepted before giving up on the server
+max_handshake = 16384
+
+# RFC 6455 constants
+guid = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+(OP_CONTINUATION, OP_TEXT, OP_BINARY) = (0x0, 0x1, 0x2)
+(OP_CLOSE, OP_PING, OP_PONG) = (0x8, 0x9, 0xA)
+
+
+def get_client(session, url, window):
+    """ Returns the shared, connected Event Server client of a server
+
+    A client connected with a different URL or credentials than the
+    session's is stopped and replaced. window is the seconds between
+    reads of the counts, normally the cycle time.
+    """
+    server = session.server
+    client = server.event_client
+    settings = (url, session.username, session.password)
+    if client and settings != client.settings():
+        LOG.info('%s: Event Server settings changed', server.base_url)
+        server.close()
+        client = None
+    if client is None:
+        client = EventServerClient(*settings)
+        server.event_client = client
+        client.start()
+    client.keep(window)
+    return client
+
+
+def accept_key(key):
+    """ Returns the Sec-WebSocket-Accept value expected for a key """
+    return base64.b64encode(hashlib.sha1(key + guid).digest())
+
+
+def mask(payload, key):
+    """ XORs a payload with a four-byte masking key """
+    data = bytearray(payload)
+    key = bytearray(key)
+    for index in range(len(data)):
+        data[index] ^= key[index % 4]
+    return str(data)
+
+
+def build_frame(opcode, payload=''):
+    """ Returns a single, masked client frame """
+    if isinstance(payload, unicode):
+        payload = payload.encode('utf-8')
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+    elif length < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+    key = os.urandom(4)
+    return header + key + mask(payload, key)
+
+
+def parse_frame(buf):
+    """ Splits the first complete frame off a buffer
+
+    Returns a tuple of (fin, opcode, payload, remainder), or None if
+    the buffer doesn't yet hold a whole frame.
+    """
+    if len(buf) < 2:
+        return None
+    (first, second) = struct.unpack('!BB', buf[:2])
+    length = second & 0x7F
+    offset = 2
+    if 126 == length:
+        if len(buf) < 4:
+            return None
+        length = struct.unpack('!H', buf[2:4])[0]
+        offset = 4
+    elif 127 == length:
+        if len(buf) < 10:
+            return None
+        length = struct.unpack('!Q', buf[2:10])[0]
+        offset = 10
+
+    key = None
+    if second & 0x80:
+        key = buf[offset:offset + 4]
+        offset += 4
+
+    if len(buf) < offset + length:
+        return None
+    payload = buf[offset:offset + length]
+    if key:
+        payload = mask(payload, key)
+    return (bool(first & 0x80), first & 0x0F, payload, buf[offset + length:])
+
+
+class EventServerProtocol(Protocol):
+    """ A minimal RFC 6455 websocket client connection
+
+    Only what zmeventnotification uses is supported: text messages,
+    fragmentation, ping, pong, and close.
+    """
+
+    def connectionMade(self):
+        self.buffer = ''
+        self.fragments = list()
+        self.handshaken = False
+        self.key = base64.b64encode(os.urandom(16))
+        self.last_heard = self.factory.clock.seconds()
+        self.pinger = None
+
+        url = self.factory.parsed
+        request = [
+            'GET {0} HTTP/1.1'.format(url.path or '/'),
+            'Host: {0}'.format(url.netloc),
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            'Sec-WebSocket-Key: {0}'.format(self.key),
+            'Sec-WebSocket-Version: 13',
+            '',
+            '',
+            ]
+        self.transport.write('\r\n'.join(request))
+
+    def connectionLost(self, reason):
+        if self.pinger and self.pinger.running:
+            self.pinger.stop()
+        self.factory.closed(self)
+
+    def dataReceived(self, data):
+        self.buffer += data
+        self.last_heard = self.factory.clock.seconds()
+
+        if not self.handshaken:
+            (head, sep, rest) = self.buffer.partition('\r\n\r\n')
+            if not sep:
+                if len(self.buffer) > max_handshake:
+                    self.fail('handshake response too large')
+                return
+            self.buffer = rest
+            if not self.handshake(head):
+                return
+
+        while self.buffer:
+            frame = parse_frame(self.buffer)
+            if frame is None:
+                break
+            (fin, opcode, payload, self.buffer) = frame
+            self.frameReceived(fin, opcode, payload)
+
+    def handshake(self, head):
+        """ Checks the server's response to the upgrade request """
+        lines = head.split('\r\n')
+        headers = dict()
+        for line in lines[1:]:
+            (name, _, value) = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if ' 101 ' not in '{0} '.format(lines[0]):
+            self.fail('upgrade refused: {0}'.format(lines[0]))
+            return False
+        elif headers.get('sec-websocket-accept') != accept_key(self.key):
+            self.fail('invalid Sec-WebSocket-Accept')
+            return False
+
+        self.handshaken = True
+        self.pinger = LoopingCall(self.ping)
+        self.pinger.clock = self.factory.clock
+        self.pinger.start(ping_interval, now=False)
+        self.factory.opened(self)
+        return True
+
+    def frameReceived(self, fin, opcode, payload):
+        if OP_PING == opcode:
+            self.transport.write(build_frame(OP_PONG, payload))
+        elif OP_PONG == opcode:
+            pass
+        elif OP_CLOSE == opcode:
+            self.transport.write(build_frame(OP_CLOSE, payload[:2]))
+            self.transport.loseConnection()
+        elif opcode in (OP_TEXT, OP_BINARY, OP_CONTINUATION):
+            self.fragments.append(payload)
+            if fin:
+                message = ''.join(self.fragments)
+                self.fragments = list()
+                self.factory.received(message)
+
+    def ping(self):
+        """ Sends a ping, dropping the connection if the server's silent """
+        silent = self.factory.clock.seconds() - self.last_heard
+        if silent > 2 * ping_interval:
+            self.fail('no response in {0:.0f}s'.format(silent))
+        else:
+            self.transport.write(build_frame(OP_PING))
+
+    def send(self, message):
+        """ Sends a JSON message """
+        self.transport.write(build_frame(OP_TEXT, json.dumps(message)))
+
+    def fail(self, reason):
+        """ Logs a protocol failure and drops the connection """
+        LOG.warn('%s: %s', self.factory.url, reason)
+        self.transport.abortConnection()
+
+
+class EventServerClient(ReconnectingClientFactory):
+    """ A long-lived connection to zmeventnotification
+
+    Counts the alarm notifications pushed for each monitor since each
+    consumer last read them, and tracks whether each monitor is in
+    alarm. Counts are only served if the connection has been up since
+    the consumer's last read, so collection falls back to polling the
+    API until then and whenever the Event Server is unreachable.
+    """
+
+    protocol = EventServerProtocol
+    initialDelay = initial_delay
+    maxDelay = max_delay
+
+    def __init__(self, url, username, password, clock=reactor):
+        self.url = url
+        self.parsed = urlparse.urlparse(url)
+        self.username = username
+        self.password = password
+        self.clock = clock
+        self.connection = None
+        self.authenticated = False
+        # Longest time between reads, how long events are kept
+        self.window = 0
+        # Authenticated connections so far, and alarm events received
+        self.logins = 0
+        self.alarms_received = 0
+        # (login, events received, time) by consumer, as of its last read
+        self.marks = dict()
+        # Per-monitor deques of (time, event ID, number received), and
+        # the time of each monitor's latest alarm that hasn't ended
+        self.events = dict()
+        self.alarms = dict()
+
+    def settings(self):
+        """ Returns the URL and credentials the client connects with """
+        return (self.url, self.username, self.password)
+
+    def keep(self, window):
+        """ Keeps events for reads at least window seconds apart """
+        self.window = max(self.window, window)
+
+    def start(self):
+        """ Connects to the Event Server, reconnecting when dropped """
+        ssl = 'wss' == self.parsed.scheme
+        host = self.parsed.hostname
+        port = self.parsed.port or (443 if ssl else 80)
+        LOG.info('Connecting to ZoneMinder Event Server %s', self.url)
+        if ssl:
+            self.connector = reactor.connectSSL(
+                host,
+                port,
+                self,
+                CertificateOptions(verify=False)
+                )
+        else:
+            self.connector = reactor.connectTCP(host, port, self)
+
+    def stop(self):
+        """ Disconnects without reconnecting """
+        self.stopTrying()
+        # Also drops a connection that hasn't finished its handshake
+        if self.connector:
+            self.connector.disconnect()
+
+    def opened(self, connection):
+        """ Authenticates a newly upgraded connection """
+        self.connection = connection
+        connection.send({
+            'event': 'auth',
+            'data': {'user': self.username, 'password': self.password},
+            })
+
+    def closed(self, connection):
+        if self.connection is connection:
+            self.connection = None
+        if self.authenticated:
+            LOG.warn(
+                '%s: Event Server connection lost, polling for events',
+                self.url
+                )
+        # Alarms may have ended while disconnected
+        self.alarms = dict()
+        self.authenticated = False
+
+    def clientConnectionFailed(self, connector, reason):
+        LOG.debug(
+            '%s: Event Server connection failed: %s',
+            self.url,
+            reason.getErrorMessage()
+            )
+        ReconnectingClientFactory.clientConnectionFailed(
+            self,
+            connector,
+            reason
+            )
+
+    def received(self, message):
+        """ Handles a message pushed by the Event Server """
+        try:
+            message = json.loads(message)
+        except ValueError:
+            LOG.debug('%s: unparseable message %r', self.url, message)
+            return
+
+        event = message.get('event')
+        if 'auth' == event:
+            if 'Success' == message.get('status'):
+                LOG.info('%s: Event Server authenticated', self.url)
+                self.authenticated = True
+                self.logins += 1
+                self.resetDelay()
+            else:
+                LOG.error(
+                    '%s: Event Server login failed: %s',
+                    self.url,
+                    message.get('reason', 'unknown reason')
+                    )
+                self.connection.transport.loseConnection()
+        elif 'alarm' == event:
+            now = self.clock.seconds()
+            for item in message.get('events', list()):
+                self.alarm(item, now)
+
+    def alarm(self, item, now):
+        """ Records one monitor's alarm notification """
+        monitor_id = str(item.get('MonitorId', ''))
+        if not monitor_id:
+            return
+        # End notifications, if enabled, have their cause prefixed
+        if str(item.get('Cause', '')).startswith('End:'):
+            self.alarms.pop(monitor_id, None)
+            return
+
+        self.alarms[monitor_id] = now
+        events = self.events.setdefault(monitor_id, collections.deque())
+        event_id = item.get('EventId')
+        if event_id is None or event_id not in (x[1] for x in events):
+            self.alarms_received += 1
+            events.append((now, event_id, self.alarms_received))
+        self.prune(now)
+
+    def prune(self, now):
+        """ Drops events and marks too old to be counted again """
+        oldest = now - zmEvents.stale_cycles * self.window
+        for events in self.events.values():
+            while events and events[0][0] < oldest:
+                events.popleft()
+        for consumer in [k for (k, v) in self.marks.items() if v[2] < oldest]:
+            del self.marks[consumer]
+
+    def event_counts(self, consumer, window):
+        """ Returns event counts by monitor ID, or None if not known
+
+        Counts are of events since the consumer's previous call, such
+        as a device's datasource plugin, so each event is counted once
+        however late or early its cycles run. The first call only sets
+        the mark, as does one after the connection was lost, or after
+        `zmEvents.stale_cycles` windows without a call.
+        """
+        now = self.clock.seconds()
+        mark = self.marks.pop(consumer, None)
+        self.prune(now)
+        if not self.authenticated:
+            return None
+        self.marks[consumer] = (self.logins, self.alarms_received, now)
+        if (mark is None
+                or mark[0] != self.logins
+                or now - mark[2] > zmEvents.stale_cycles * window):
+            return None
+        return dict(
+            (monitor_id, sum(1 for x in events if x[2] > mark[1]))
+            for (monitor_id, events) in self.events.items()
+            )
+
+    def alarm_states(self):
+        """ Returns 1 or 0 alarm state by monitor ID, or None if offline
+
+        Without end notifications an alarm is assumed over once
+        `alarm_timeout` seconds have passed without another.
+        """
+        if not self.authenticated:
+            return None
+        now = self.clock.seconds()
+        return dict(
+            (monitor_id, 1 if now - alarmed < alarm_timeout else 0)
+            for (monitor_id, alarmed) in self.alarms.items()
+            )
@@ -0,0 +1,113 @@
+""" Incremental ZoneMinder event counts, from a per-server cursor """
+
+import logging
+LOG = logging.getLogger('zen.ZoneMinder')
+
+import json
+import time
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmCache
+
+# Cycles without counting after which the cursor is started over,
+# as while the Event Server's counts are used instead
+stale_cycles = 2
+
+# Events requested per page, and the most pages read in one cycle.
+# Anything beyond is counted the next cycle.
+page_size = 100
+max_pages = 50
+
+# Event counts for the seconds before the first cycle
+seed_path = 'api/events/consoleEvents/{0}%20second.json'
+
+# The newest event, the starting point of the cursor
+latest_path = 'api/events/index.json?sort=Id&direction=desc&limit=1'
+
+# Events newer than the cursor, oldest first
+delta_path = ('api/events/index/Id%20%3E:{0}.json'
+              '?sort=Id&direction=asc&limit={1}')
+
+
+def event_counts(session, cycletime):
+    """ Returns a Deferred firing with event counts by monitor ID
+
+    Counts are of events created since the previous cycle. The result
+    is cached for the cycle so every datasource sees the same counts
+    rather than each advancing the cursor.
+    """
+    return session.cache.fetch(
+        'event cursor',
+        zmCache.cycle_ttl(cycletime),
+        advance,
+        session,
+        cycletime
+        )
+
+
+@inlineCallbacks
+def advance(session, cycletime):
+    """ Counts events newer than the cursor and moves it forward
+
+    A cursor that hasn't moved for a while is seeded again, rather
+    than counting every event since as this cycle's.
+    """
+    (mark, taken) = session.server.cursor or (None, 0)
+    if mark is None or time.time() - taken > stale_cycles * cycletime:
+        returnValue((yield seed(session, cycletime)))
+
+    counts = dict()
+    for page in range(max_pages):
+        response = yield session.get(delta_path.format(mark, page_size))
+        response = json.loads(response)
+        events = response.get('events', list())
+        for item in events:
+            event = item.get('Event', dict())
+            monitor_id = str(event.get('MonitorId', ''))
+            counts[monitor_id] = counts.get(monitor_id, 0) + 1
+            mark = max(mark, int(event.get('Id', 0)))
+
+        # The API may cap the page size below what was asked for,
+        # so its own pagination says whether there's more
+        more = response.get('pagination', dict()).get(
+            'nextPage',
+            len(events) >= page_size
+            )
+        if not events or not more:
+            break
+    else:
+        LOG.warn(
+            '%s: events remain after %s pages, counting them next cycle',
+            session.base_url,
+            max_pages
+            )
+
+    LOG.debug(
+        '%s: event cursor moved from %s to %s',
+        session.base_url,
+        session.server.cursor[0],
+        mark
+        )
+    session.server.cursor = (mark, time.time())
+    returnValue(counts)
+
+
+@inlineCallbacks
+def seed(session, cycletime):
+    """ Starts the cursor at the newest event
+
+    There's nothing to count a delta from on the first cycle, so the
+    counts are of events in the last cycle's worth of seconds.
+    """
+    response = yield session.get(latest_path)
+    events = json.loads(response).get('events', list())
+    mark = int(events[0].get('Event', dict()).get('Id', 0)) if events else 0
+
+    response = yield session.get(seed_path.format(int(cycletime)))
+    # "results" will be an empty *list* if no monitors have events
+    results = json.loads(response).get('results') or dict()
+
+    LOG.debug('%s: event cursor starting at %s', session.base_url, mark)
+    session.server.cursor = (mark, time.time())
+    returnValue(dict((str(k), int(v)) for (k, v) in results.items()))
@@ -0,0 +1,144 @@
+""" Incremental modeling, sending only the maps that have changed """
+
+import hashlib
+import json
+import time
+
+# Fingerprints of the last maps sent by device ID. They're kept here
+# rather than with the server's state in zmServer, as zenmodeler
+# models each device far less often than a server is kept while idle.
+fingerprints = dict()
+
+# Seconds between full remodels, in case the model was changed in a
+# way the device's last change time and components don't show
+full_model_interval = 14400
+
+
+def fingerprint(object_map):
+    """ Returns a digest of an ObjectMap's attributes
+
+    Attributes are sorted here rather than with sort_keys, which would
+    make Python 2's json fall back from its C encoder.
+    """
+    attributes = sorted(
+        (key, value) for (key, value) in vars(object_map).items()
+        if not key.startswith('_')
+        )
+    return hashlib.md5(json.dumps(attributes, default=str)).hexdigest()
+
+
+def component_path(relationship_map, object_map):
+    """ Returns the path of a RelationshipMap's component """
+    return '/'.join(x for x in (
+        relationship_map.compname,
+        relationship_map.relname,
+        object_map.id,
+        ) if x)
+
+
+def full_model_reason(previous, model, now):
+    """ Returns why the full model should be sent, if it should be
+
+    model is what the device's getZoneMinderModel returned, or None if
+    it isn't known. Zenoss updates a device's last change time when it
+    applies a change, so if the maps last sent were applied it will
+    have moved, and otherwise it won't have.
+    """
+    if previous is None:
+        return 'first model'
+    elif now - previous['time'] > full_model_interval:
+        return 'full model interval passed'
+    elif model is None:
+        return None
+    elif set(model['components']) != previous['components']:
+        return 'components differ from the last model'
+    elif previous['changed'] is None:
+        return None
+    elif previous['sent'] and model['changed'] == previous['changed']:
+        return 'changes sent last model not applied'
+    elif not previous['sent'] and model['changed'] != previous['changed']:
+        return 'model changed since the last model'
+    return None
+
+
+def sweep(now):
+    """ Drops fingerprints of devices not fully modeled for too long
+
+    The full model would be sent next time anyway, so this only frees
+    those of devices that were deleted or renamed.
+    """
+    for device in [
+            k for (k, v) in fingerprints.items()
+            if now - v['time'] > full_model_interval
+            ]:
+        del fingerprints[device]
+
+
+def incremental(device, maps, log, model=None):
+    """ Returns only the maps that differ from the last ones sent
+
+    Unchanged RelationshipMaps are dropped. If a relationship has the
+    same components as before but some have changed, just their
+    ObjectMaps are sent. Everything's sent the first time a device is
+    modeled, every `full_model_interval` seconds after that, and
+    whenever the device's model isn't what was last sent.
+    """
+    now = time.time()
+    previous = fingerprints.get(device)
+    sweep(now)
+    current = {
+        'time': now,
+        'maps': dict(
+            (x.relname, dict((y.id, fingerprint(y)) for y in x.maps))
+            for x in maps
+            ),
+        'components': set(
+            component_path(x, y) for x in maps for y in x.maps
+            ),
+        # Last change time of the model the maps are compared with,
+        # unknown until the full model has been applied
+        'changed': None,
+        'sent': False,
+        }
+
+    reason = full_model_reason(previous, model, now)
+    if reason:
+        fingerprints[device] = current
+        log.debug('%s: sending full model, %s', device, reason)
+        return maps
+
+    current['time'] = previous['time']
+    if model is not None:
+        current['changed'] = model['changed']
+    fingerprints[device] = current
+
+    output = list()
+    for relationship_map in maps:
+        relname = relationship_map.relname
+        old = previous['maps'].get(relname)
+        new = current['maps'][relname]
+        if old == new:
+            log.debug('%s: %s unchanged', device, relname)
+        elif old is not None and set(old) == set(new):
+            changed = [
+                x for x in relationship_map.maps if old[x.id] != new[x.id]
+                ]
+            log.info(
+                '%s: %s of %s %s changed',
+                device,
+                len(changed),
+                len(new),
+                relname
+                )
+            for object_map in changed:
+                object_map.compname = component_path(
+                    relationship_map,
+                    object_map
+                    )
+                output.append(object_map)
+        else:
+            log.info('%s: %s components added or removed', device, relname)
+            output.append(relationship_map)
+
+    current['sent'] = bool(output)
+    return output
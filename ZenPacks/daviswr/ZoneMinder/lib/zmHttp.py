@@ -0,0 +1,292 @@
+""" Persistent HTTP(S) client for ZoneMinder, shared by all plugins """
+
+import logging
+LOG = logging.getLogger('zen.ZoneMinder')
+
+import urlparse
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    CancelledError,
+    Deferred,
+    inlineCallbacks,
+    returnValue
+    )
+from twisted.internet.error import TimeoutError
+from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
+from twisted.internet.ssl import CertificateOptions
+from twisted.web.client import (
+    Agent,
+    ContentDecoderAgent,
+    GzipDecoder,
+    HTTPConnectionPool,
+    ResponseDone,
+    readBody,
+    )
+from twisted.web.http import PotentialDataLoss
+from twisted.web.error import Error
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IPolicyForHTTPS
+from zope.interface import implementer
+
+# Seconds to wait for a TCP (and TLS) connection to be established
+connect_timeout = 30
+
+# Seconds to wait for response headers, then again for the body
+read_timeout = 60
+
+# Idle keep-alive connections held open per ZoneMinder host
+max_persistent = 4
+
+# Seconds an idle keep-alive connection is held open,
+# long enough to span a typical 300 second datasource cycle
+idle_timeout = 330
+
+# Redirects followed before giving up, the 1.34 console login
+# redirects once to the console page
+max_redirects = 5
+
+redirect_codes = (301, 302, 303, 307, 308)
+
+user_agent = 'ZenPacks.daviswr.ZoneMinder'
+
+# The shared agent, created on first use
+agent = None
+
+
+@implementer(IPolicyForHTTPS)
+class ReusedTLSPolicy(object):
+    """ TLS settings for ZoneMinder servers
+
+    Certificates aren't verified, matching getPage, as ZoneMinder is
+    commonly installed with a self-signed certificate. One OpenSSL
+    context is kept per host rather than built for every connection.
+    """
+
+    def __init__(self):
+        self.options = dict()
+
+    def creationForNetloc(self, hostname, port):
+        key = (hostname, port)
+        if key not in self.options:
+            self.options[key] = CertificateOptions(verify=False)
+        return self.options[key]
+
+
+def get_agent():
+    """ Returns the shared, connection-pooling HTTP agent """
+    global agent
+    if agent is None:
+        pool = HTTPConnectionPool(reactor, persistent=True)
+        pool.maxPersistentPerHost = max_persistent
+        pool.cachedConnectionTimeout = idle_timeout
+        agent = ContentDecoderAgent(
+            Agent(
+                reactor,
+                contextFactory=ReusedTLSPolicy(),
+                connectTimeout=connect_timeout,
+                pool=pool
+                ),
+            [('gzip', GzipDecoder)]
+            )
+    return agent
+
+
+def update_cookies(response, cookies):
+    """ Stores cookies set by a response in a dict """
+    for header in response.headers.getRawHeaders('set-cookie', list()):
+        (name, _, value) = header.split(';', 1)[0].partition('=')
+        name = name.strip()
+        if not name:
+            continue
+        elif 'deleted' == value:
+            cookies.pop(name, None)
+        else:
+            cookies[name] = value
+
+
+def with_timeout(deferred, timeout):
+    """ Cancels a Deferred that hasn't fired within a timeout """
+    if not timeout:
+        return deferred
+
+    timer = reactor.callLater(timeout, deferred.cancel)
+
+    def finished(result):
+        if timer.active():
+            timer.cancel()
+        elif hasattr(result, 'trap') and result.check(CancelledError):
+            raise TimeoutError(string='no response in {0}s'.format(timeout))
+        return result
+
+    return deferred.addBoth(finished)
+
+
+@inlineCallbacks
+def request(url, method='GET', cookies=None, timeout=read_timeout):
+    """ Sends a request, following redirects and tracking cookies
+
+    Returns a Deferred firing with the final twisted.web Response,
+    before its body has been read.
+    """
+    cookies = cookies if cookies is not None else dict()
+    for _ in range(max_redirects + 1):
+        headers = Headers({'User-Agent': [user_agent]})
+        if cookies:
+            headers.addRawHeader(
+                'Cookie',
+                '; '.join('{0}={1}'.format(*x) for x in cookies.items())
+                )
+
+        response = yield with_timeout(
+            get_agent().request(method, url, headers, None),
+            timeout
+            )
+        update_cookies(response, cookies)
+
+        location = response.headers.getRawHeaders('location', [None])[0]
+        if response.code in redirect_codes and location:
+            # Read the short redirect body so the connection
+            # goes back to the pool for the next request
+            yield with_timeout(readBody(response), timeout)
+            url = urlparse.urljoin(url, location)
+            if response.code in (302, 303):
+                method = 'GET'
+            continue
+
+        returnValue(response)
+
+    raise Error('310', 'Too many redirects', url)
+
+
+@inlineCallbacks
+def get_page(url, method='GET', cookies=None, timeout=read_timeout):
+    """ Returns a Deferred firing with the body of a URL
+
+    A drop-in replacement for twisted.web.client.getPage that reuses
+    connections. HTTP errors raise twisted.web.error.Error.
+    """
+    response = yield request(url, method, cookies, timeout)
+    body = yield with_timeout(readBody(response), timeout)
+    if response.code >= 400:
+        raise Error(str(response.code), response.phrase, body)
+    returnValue(body)
+
+
+class StreamProtocol(Protocol):
+    """ Hands a response body to a callable as it arrives
+
+    Once the callable returns True the rest of the body is unwanted,
+    and the connection is closed rather than read to the end. It can
+    instead return a Deferred firing with that, as when the body is
+    parsed in a worker thread, and reading is paused until it fires.
+    """
+
+    def __init__(self, feed):
+        self.feed = feed
+        self.finished = Deferred(self.cancel)
+        self.received = 0
+        self.stopped = False
+        # Waiting on a Deferred from the callable, the data received
+        # meanwhile, and why the body ended if it did meanwhile
+        self.waiting = False
+        self.paused = False
+        self.pending = list()
+        self.ended = None
+
+    def cancel(self, deferred):
+        self.stopped = True
+        if self.transport:
+            self.transport.stopProducing()
+
+    def dataReceived(self, data):
+        if self.stopped:
+            return
+        self.received += len(data)
+        if self.waiting:
+            self.pending.append(data)
+        else:
+            self.deliver(data)
+
+    def deliver(self, data):
+        """ Passes data to the callable """
+        try:
+            enough = self.feed(data)
+        except Exception:
+            self.fail(Failure())
+            return
+        if not isinstance(enough, Deferred):
+            self.fed(enough)
+            return
+        self.waiting = True
+        enough.addCallbacks(self.fed, self.fail)
+        if self.waiting and not self.paused:
+            self.paused = True
+            self.transport.pauseProducing()
+
+    def fed(self, enough):
+        """ Carries on once the callable has taken some data """
+        self.waiting = False
+        if self.stopped:
+            return
+        elif enough:
+            self.stopped = True
+            self.transport.stopProducing()
+            self.finished.callback(self.received)
+        elif self.pending:
+            data = ''.join(self.pending)
+            self.pending = list()
+            self.deliver(data)
+        elif self.ended is not None:
+            self.end(self.ended)
+        elif self.paused:
+            self.paused = False
+            self.transport.resumeProducing()
+
+    def fail(self, failure):
+        """ Stops reading when the callable raises an exception """
+        self.waiting = False
+        if self.stopped:
+            return
+        self.stopped = True
+        self.transport.stopProducing()
+        self.finished.errback(failure)
+
+    def end(self, reason):
+        """ Fires once the whole body has been taken """
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(self.received)
+        else:
+            self.finished.errback(reason)
+
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return
+        elif self.stopped:
+            # Cancelled, the Deferred has already failed
+            return
+        elif self.waiting:
+            # Finished once the callable has taken what it's been given
+            self.ended = reason
+        else:
+            self.end(reason)
+
+
+@inlineCallbacks
+def stream(url, feed, method='GET', cookies=None, timeout=read_timeout):
+    """ Requests a URL, passing its body to feed() as it arrives
+
+    feed() can return True to stop reading early. Returns a Deferred
+    firing with the number of bytes read. HTTP errors raise
+    twisted.web.error.Error, as from get_page.
+    """
+    response = yield request(url, method, cookies, timeout)
+    if response.code >= 400:
+        body = yield with_timeout(readBody(response), timeout)
+        raise Error(str(response.code), response.phrase, body)
+
+    protocol = StreamProtocol(feed)
+    response.deliverBody(protocol)
+    received = yield with_timeout(protocol.finished, timeout)
+    returnValue(received)
@@ -0,0 +1,122 @@
+""" Works out which ZoneMinder endpoints a datasource actually needs """
+
+import logging
+LOG = logging.getLogger('zen.ZoneMinder')
+
+# Paths relative to the ZoneMinder base URL
+endpoints = {
+    'console': 'index.php?view=console',
+    'daemonCheck': 'api/host/daemonCheck.json',
+    # Counted incrementally by zmEvents
+    'events': 'api/events/index.json',
+    'getLoad': 'api/host/getLoad.json',
+    'monitors': 'api/monitors.json',
+    'states': 'api/states.json',
+    'storage': 'api/storage.json',
+    }
+
+# Endpoints producing each datapoint, by datasource plugin
+datapoint_endpoints = {
+    'Daemon': {
+        'result': ('daemonCheck',),
+        'state': ('states',),
+        'load-1': ('getLoad',),
+        'load-5': ('getLoad',),
+        'load-15': ('getLoad',),
+        'events': ('events',),
+        'devshm': ('console',),
+        'db-used': ('console',),
+        'db-max': ('console',),
+        'bandwidth': ('console',),
+        'capturing': ('console',),
+        # The collector's own statistics
+        'requests': tuple(),
+        'bytes': tuple(),
+        'console-bytes': tuple(),
+        'login-time': tuple(),
+        'api-time': tuple(),
+        'monitors-time': tuple(),
+        'events-time': tuple(),
+        'console-time': tuple(),
+        'parse-time': tuple(),
+        'parse-queue': tuple(),
+        'parse-wait': tuple(),
+        },
+    'Monitor': {
+        'status': ('monitors',),
+        'CaptureFPS': ('monitors',),
+        'AnalysisFPS': ('monitors',),
+        'CaptureBandwidth': ('monitors',),
+        'events': ('events',),
+        'online': ('console',),
+        # Only pushed by the Event Server
+        'alarm': tuple(),
+        },
+    'Storage': {
+        'used': ('console',),
+        'total': ('console',),
+        'percent': ('console',),
+        'events': ('storage',),
+        },
+    }
+
+# Datapoints that come from the API instead when supported. Storage
+# has none, as storage.json's DiskSpace is only the space used by
+# events, not the size or usage of the volume's filesystem, so those
+# are always read from the Console header.
+api_datapoint_endpoints = {
+    'Daemon': {
+        'bandwidth': ('monitors',),
+        'capturing': ('monitors',),
+        },
+    'Monitor': {
+        'online': ('monitors',),
+        },
+    }
+
+
+def plan(plugin, datapoints, api_mode=False):
+    """ Returns the set of endpoint names needed for datapoint IDs """
+    needed = set()
+    mapping = datapoint_endpoints.get(plugin, dict())
+    api_mapping = api_datapoint_endpoints.get(plugin, dict())
+    for datapoint in datapoints:
+        if api_mode and datapoint in api_mapping:
+            needed.update(api_mapping[datapoint])
+        else:
+            needed.update(mapping.get(datapoint, tuple()))
+    return needed
+
+
+def served_by(plugin, datapoints, endpoint, api_mode=False):
+    """ Returns the datapoint IDs that come from an endpoint """
+    return set(
+        x for x in datapoints if endpoint in plan(plugin, [x], api_mode)
+        )
+
+
+def plan_datasources(session, device, plugin, datasources, api_mode=False):
+    """ Returns the endpoints needed by a task's datasources
+
+    The plan is logged at INFO when it first appears or changes,
+    and at DEBUG otherwise, so the last one is kept on the server.
+    """
+    datapoints = set()
+    for datasource in datasources:
+        datapoints.update(x.id for x in datasource.points)
+    needed = plan(plugin, datapoints, api_mode)
+
+    plans = session.server.plans
+    key = (device, plugin)
+    level = logging.DEBUG if plans.get(key) == needed else logging.INFO
+    plans[key] = needed
+    LOG.log(
+        level,
+        '%s: %s requests %s for datapoints %s',
+        device,
+        plugin,
+        ', '.join(sorted(needed)) or 'nothing',
+        ', '.join(sorted(datapoints))
+        )
+    # A copy, so callers can add fallbacks without touching the log state
+    return set(needed)
@@ -0,0 +1,131 @@
+""" Opt-in profiling of the modeler and datasource plugins """
+
+import logging
+LOG = logging.getLogger('zen.ZoneMinder')
+
+import cProfile
+import functools
+import glob
+import os
+import pstats
+import time
+
+from StringIO import StringIO
+
+from twisted.internet.defer import Deferred
+
+from Products.ZenUtils.Utils import zenPath
+
+# Directory profile dumps are written to
+profile_dir = zenPath('log', 'ZoneMinder', 'profiles')
+
+# Functions listed in the logged summary, by cumulative time
+top_n = 25
+
+# Dumps kept per device and plugin, oldest removed first
+max_dumps = 20
+
+# Name of the call being profiled, as only one profiler can be
+# active at a time in the collector's reactor thread
+active = None
+
+
+def config_device(plugin, config):
+    """ Returns a datasource task's device ID if profiling's enabled """
+    for datasource in config.datasources:
+        if datasource.params.get('profiling'):
+            return config.id
+    return None
+
+
+def modeler_device(plugin, device, *args, **kwargs):
+    """ Returns a modeled device's ID if profiling's enabled """
+    if getattr(device, 'zZoneMinderProfiling', False):
+        return device.id
+    return None
+
+
+def profiled(name, get_device):
+    """ Decorates a method to be profiled when its device asks for it
+
+    get_device is called with the method's arguments, returning the
+    device ID to profile for, or None. When it's None the method is
+    called as-is.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            device = get_device(*args, **kwargs)
+            if device is None:
+                return func(*args, **kwargs)
+            return profile(device, name, func, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profile(device, name, func, *args, **kwargs):
+    """ Calls a function under cProfile, dumping and summarizing it
+
+    If the function returns a Deferred, profiling continues until it
+    fires, so the profile includes anything else the reactor ran in
+    the meantime.
+    """
+    global active
+    label = '{0} {1}'.format(device, name)
+    if active is not None:
+        LOG.debug(
+            '%s: already profiling %s, skipping %s',
+            device,
+            active,
+            name
+            )
+        return func(*args, **kwargs)
+
+    profiler = cProfile.Profile()
+    active = label
+    start = time.time()
+
+    def finished(result):
+        global active
+        profiler.disable()
+        active = None
+        try:
+            dump(device, name, profiler, time.time() - start)
+        except Exception:
+            LOG.exception('%s: failed to write %s profile', device, name)
+        return result
+
+    profiler.enable()
+    try:
+        result = func(*args, **kwargs)
+    except Exception:
+        finished(None)
+        raise
+
+    if isinstance(result, Deferred):
+        return result.addBoth(finished)
+    return finished(result)
+
+
+def dump(device, name, profiler, seconds):
+    """ Writes a profile to disk and logs its top functions """
+    if not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    prefix = os.path.join(profile_dir, '{0}-{1}-'.format(device, name))
+    path = '{0}{1}.prof'.format(prefix, time.strftime('%Y%m%d-%H%M%S'))
+    profiler.dump_stats(path)
+
+    for old in sorted(glob.glob(prefix + '*.prof'))[:-max_dumps]:
+        os.remove(old)
+
+    summary = StringIO()
+    stats = pstats.Stats(profiler, stream=summary)
+    stats.sort_stats('cumulative').print_stats(top_n)
+    LOG.info(
+        '%s: %s took %.3fs, profile written to %s\n%s',
+        device,
+        name,
+        seconds,
+        path,
+        summary.getvalue()
+        )
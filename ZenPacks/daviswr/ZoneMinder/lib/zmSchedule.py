@@ -0,0 +1,114 @@
+""" Which monitors are polled, and for what, from their Function """
+
+import logging
+LOG = logging.getLogger('zen.ZoneMinder')
+
+import json
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import deferLater
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmPlanner, zmUtil
+
+# Monitors with this Function have no capture daemon running
+idle_functions = ('None', '')
+
+# Functions that create events, if the monitor is Enabled
+event_functions = ('Modect', 'Record', 'Mocord', 'Nodect')
+
+# Seconds to wait for the run state to settle after a change, and the
+# most times to wait, so a burst of changes becomes one update
+settle_time = 15
+max_settles = 4
+
+
+def enabled(value):
+    """ Returns an Enabled value from the API or model as a boolean """
+    return value is True or str(value) in ('1', 'True', 'true')
+
+
+def update(session, device, monitors):
+    """ Records the live Function and Enabled of monitors.json items
+
+    Kept on the session's server by device ID and monitor ID, they
+    override the modeled values until the next remodel catches up.
+    """
+    functions = session.server.functions
+    for item in monitors:
+        monitor = item.get('Monitor', dict())
+        if monitor.get('Id') is None:
+            continue
+        functions[(device, str(monitor['Id']))] = (
+            str(monitor.get('Function') or 'None'),
+            enabled(monitor.get('Enabled'))
+            )
+
+
+def get_function(session, device, monitor_id, function, is_enabled):
+    """ Returns a monitor's (Function, Enabled), live if known """
+    return session.server.functions.get(
+        (device, str(monitor_id)),
+        (str(function or 'None'), enabled(is_enabled))
+        )
+
+
+def is_polled(function):
+    """ Whether a monitor with a Function is polled at all """
+    return function not in idle_functions
+
+
+def has_events(function, is_enabled):
+    """ Whether a monitor with a Function creates events """
+    return is_enabled and function in event_functions
+
+
+def state_changed(session, device, state):
+    """ Records a run state, returning whether it's changed
+
+    The first state seen for a device isn't a change.
+    """
+    run_states = session.server.run_states
+    previous = run_states.get(device)
+    run_states[device] = state
+    return previous is not None and previous != state
+
+
+@inlineCallbacks
+def settle(device, session, state):
+    """ Waits for the run state to stop changing, returning the last """
+    for _ in range(max_settles):
+        yield deferLater(reactor, settle_time, lambda: None)
+        response = yield session.get(zmPlanner.endpoints['states'])
+        current = zmUtil.active_state(
+            json.loads(response).get('states', list())
+            )
+        if current is None or current == state:
+            break
+        LOG.debug('%s: ZM run state still changing', device)
+        state = current
+    session.server.run_states[device] = state
+    returnValue(state)
+
+
+def changes(monitors, modeled):
+    """ Returns monitors.json items whose Function or Enabled differ
+
+    Compared with a dict of modeled (Function, Enabled) by monitor ID,
+    monitors that weren't modeled are left for the next remodel.
+    Returns a list of (monitor ID, Function, Enabled) tuples.
+    """
+    output = list()
+    for item in monitors:
+        monitor = item.get('Monitor', dict())
+        monitor_id = str(monitor.get('Id'))
+        if monitor_id not in modeled:
+            continue
+        live = (
+            str(monitor.get('Function') or 'None'),
+            enabled(monitor.get('Enabled'))
+            )
+        (function, is_enabled) = modeled[monitor_id]
+        if live != (str(function or 'None'), enabled(is_enabled)):
+            output.append((monitor_id,) + live)
+    return output
@@ -0,0 +1,74 @@
+""" State kept between collection cycles for each ZoneMinder server """
+
+import logging
+LOG = logging.getLogger('zen.ZoneMinder')
+
+import time
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmCache, zmCircuit, zmStats
+
+# Servers by ZoneMinder base URL, within one collector process
+servers = dict()
+
+# Seconds a server can go unused before its state is dropped,
+# as when its device is deleted or its URL changes
+idle_timeout = 3600
+
+
+def get_server(base_url):
+    """ Returns the state kept for a ZoneMinder base URL """
+    now = time.time()
+    sweep(now)
+    if base_url not in servers:
+        servers[base_url] = ZMServer(base_url)
+    servers[base_url].used = now
+    return servers[base_url]
+
+
+def evict(base_url):
+    """ Drops a server's state, closing its Event Server connection """
+    server = servers.pop(base_url, None)
+    if server is not None:
+        LOG.debug('%s: dropping server state', base_url)
+        server.close()
+
+
+def sweep(now=None):
+    """ Evicts servers unused for `idle_timeout` seconds """
+    now = now or time.time()
+    for base_url in [
+            k for (k, v) in servers.items() if now - v.used > idle_timeout
+            ]:
+        evict(base_url)
+
+
+class ZMServer(object):
+    """ A ZoneMinder server's sessions, circuit, cache, and statistics """
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.circuit = zmCircuit.Circuit(base_url)
+        self.cache = zmCache.ResponseCache(base_url)
+        self.stats = zmStats.CollectorStats(base_url)
+        # Sessions by (username, password)
+        self.sessions = dict()
+        # Highest event ID counted and when, see zmEvents
+        self.cursor = None
+        # Event Notification Server client, see zmEventServer
+        self.event_client = None
+        # Live monitor Functions and last run state of each device
+        # polling the server, see zmSchedule
+        self.functions = dict()
+        self.run_states = dict()
+        # Last endpoint plan logged by device and plugin, see zmPlanner
+        self.plans = dict()
+        # Whether the API leaves out monitors by a condition on their ID,
+        # until the modeler finds that it doesn't
+        self.filters_monitors = True
+        self.used = time.time()
+
+    def close(self):
+        """ Stops the Event Server client, if any """
+        if self.event_client is not None:
+            self.event_client.stop()
+            self.event_client = None
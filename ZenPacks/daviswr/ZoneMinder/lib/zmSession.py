@@ -0,0 +1,357 @@
+""" Shared ZoneMinder login sessions, reused across collection tasks """
+
+import logging
+LOG = logging.getLogger('zen.ZoneMinder')
+
+import json
+import time
+
+from twisted.internet.defer import (
+    DeferredLock,
+    inlineCallbacks,
+    returnValue
+    )
+
+from ZenPacks.daviswr.ZoneMinder.lib import (
+    zmHttp,
+    zmServer,
+    zmStats,
+    zmWorkers
+    )
+
+# Treat tokens as expired this many seconds early to allow for latency
+# and clock skew between the collector and ZoneMinder
+expiry_margin = 60
+
+# Hidden form field on the 1.32 - 1.36 login view, returned with a
+# 200 status in place of the requested page once a web session expires
+login_marker = 'name="action" value="login"'
+
+# Characters of a streamed page gathered before they're parsed, enough
+# for zmWorkers to pass the parse to a worker thread
+stream_batch = zmWorkers.min_offload
+
+
+class LoginError(Exception):
+    """ ZoneMinder refused the login or returned no usable session """
+
+
+def get_session(base_url, username, password, limit=None):
+    """ Returns the shared session for a ZoneMinder base URL """
+    server = zmServer.get_server(base_url)
+    key = (username, password)
+    if key not in server.sessions:
+        server.sessions[key] = ZMSession(server, username, password)
+    if limit:
+        server.sessions[key].set_limit(limit)
+    return server.sessions[key]
+
+
+def http_status(error):
+    """ Returns the HTTP status of a failed request, if any """
+    status = getattr(error, 'status', None)
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
+
+
+class ZMSession(object):
+    """ A ZoneMinder login, kept alive between collection cycles
+
+    Logs in once and reuses the session cookie, along with the access
+    token issued by ZoneMinder 1.34+, until it expires. Access tokens
+    are renewed with the refresh token where possible, and a full login
+    is only repeated after the server rejects the session.
+    """
+
+    def __init__(self, server, username, password):
+        self.server = server
+        self.base_url = server.base_url
+        self.api_url = '{0}api/'.format(server.base_url)
+        self.username = username
+        self.password = password
+        self.cookies = dict()
+        self.access_token = None
+        self.access_expires = 0
+        self.refresh_token = None
+        self.refresh_expires = 0
+        # Incremented on every login so callers whose request failed
+        # can tell if another caller has already logged in again
+        self.generation = 0
+        self.lock = DeferredLock()
+        # Shared with any other session for the same server
+        self.circuit = server.circuit
+        self.cache = server.cache
+        self.stats = server.stats
+
+    def set_limit(self, limit):
+        """ Sets the cap on requests in flight to the server """
+        self.circuit.set_limit(limit)
+
+    def is_valid(self):
+        """ Returns True if the session can be used without logging in """
+        if not self.cookies:
+            return False
+        elif self.access_token:
+            return time.time() < self.access_expires
+        return True
+
+    def invalidate(self, generation=None):
+        """ Discards the session, unless it has already been replaced """
+        if generation is None or generation == self.generation:
+            self.cookies = dict()
+            self.access_token = None
+            self.access_expires = 0
+
+    def _update_tokens(self, output):
+        """ Stores the tokens from a login.json response """
+        now = time.time()
+        if output.get('access_token'):
+            self.access_token = output['access_token']
+            self.access_expires = now - expiry_margin + int(
+                output.get('access_token_expires', 0)
+                )
+        if output.get('refresh_token'):
+            self.refresh_token = output['refresh_token']
+            self.refresh_expires = now - expiry_margin + int(
+                output.get('refresh_token_expires', 0)
+                )
+
+    @inlineCallbacks
+    def _fetch(self, url, method, cookies):
+        """ Requests a URL, recording its time and size """
+        start = time.time()
+        size = 0
+        try:
+            response = yield zmHttp.get_page(
+                url,
+                method=method,
+                cookies=cookies
+                )
+            size = len(response)
+        finally:
+            self.stats.request(
+                zmStats.request_kind(url[len(self.base_url):]),
+                time.time() - start,
+                size
+                )
+        returnValue(response)
+
+    @inlineCallbacks
+    def _refresh(self):
+        """ Renews the access token using the refresh token """
+        response = yield self.circuit.run(
+            self._fetch,
+            '{0}host/login.json?token={1}'.format(
+                self.api_url,
+                self.refresh_token
+                ),
+            'POST',
+            self.cookies
+            )
+        output = json.loads(response)
+        if not output.get('access_token'):
+            raise LoginError('ZoneMinder did not renew the access token')
+        self._update_tokens(output)
+        LOG.debug('%s: renewed ZoneMinder access token', self.base_url)
+
+    @inlineCallbacks
+    def _login(self):
+        """ Performs a full API login """
+        login_url = '{0}host/login.json?user={1}&pass={2}&stateful=1'.format(
+            self.api_url,
+            self.username,
+            self.password
+            )
+        cookies = dict()
+        response = yield self.circuit.run(
+            self._fetch,
+            login_url,
+            'POST',
+            cookies
+            )
+
+        if 'Login denied' in response or '"success": false' in response:
+            raise LoginError('ZoneMinder login credentials invalid')
+        elif not cookies:
+            raise LoginError(
+                'No cookies received, enable OPT_USE_LEGACY_API_AUTH'
+                )
+
+        self.cookies = cookies
+        self.access_token = None
+        self.access_expires = 0
+        self.refresh_token = None
+        self.refresh_expires = 0
+        try:
+            self._update_tokens(json.loads(response))
+        except ValueError:
+            # Pre-1.34 login.json may not return JSON tokens at all
+            pass
+        self.generation += 1
+        LOG.debug('%s: logged in to ZoneMinder', self.base_url)
+
+    @inlineCallbacks
+    def login(self):
+        """ Ensures the session is usable, logging in if needed """
+        if self.is_valid():
+            returnValue(self.generation)
+
+        # Only one caller at a time logs in, the rest wait for it
+        # and then find a valid session waiting for them
+        yield self.lock.acquire()
+        try:
+            if not self.is_valid():
+                if (self.cookies and self.refresh_token
+                        and time.time() < self.refresh_expires):
+                    try:
+                        yield self._refresh()
+                    except Exception:
+                        LOG.debug(
+                            '%s: ZoneMinder token refresh failed',
+                            self.base_url
+                            )
+                        yield self._login()
+                else:
+                    yield self._login()
+        finally:
+            self.lock.release()
+
+        returnValue(self.generation)
+
+    def _url(self, path):
+        """ Returns the full URL for a path relative to the base URL """
+        url = self.base_url + path
+        if self.access_token and path.startswith('api/'):
+            url += '&' if '?' in url else '?'
+            url += 'token={0}'.format(self.access_token)
+        return url
+
+    @inlineCallbacks
+    def get(self, path, method='GET'):
+        """ Requests a path relative to the ZoneMinder base URL
+
+        Logs in first if needed, and retries once with a new login
+        if ZoneMinder rejects the current session.
+        """
+        retry = True
+        while True:
+            generation = yield self.login()
+            try:
+                response = yield self.circuit.run(
+                    self._fetch,
+                    self._url(path),
+                    method,
+                    self.cookies
+                    )
+            except Exception as e:
+                if retry and http_status(e) == 401:
+                    LOG.debug('%s: ZoneMinder session rejected', path)
+                    self.invalidate(generation)
+                    retry = False
+                    continue
+                raise
+
+            if (retry and not path.startswith('api/')
+                    and login_marker in response):
+                LOG.debug('%s: ZoneMinder web session expired', path)
+                self.invalidate(generation)
+                retry = False
+                continue
+
+            returnValue(response)
+
+    @inlineCallbacks
+    def _stream(self, url, feed):
+        """ Streams a URL to feed(), recording its time and size """
+        start = time.time()
+        size = 0
+        try:
+            size = yield zmHttp.stream(url, feed, cookies=self.cookies)
+        finally:
+            self.stats.request(
+                zmStats.request_kind(url[len(self.base_url):]),
+                time.time() - start,
+                size
+                )
+        returnValue(size)
+
+    @inlineCallbacks
+    def stream(self, path, parser_class, enough=None):
+        """ Parses a page relative to the base URL as it's received
+
+        The page is fed to a new parser_class instance `stream_batch`
+        characters at a time, never held whole, by zmWorkers so the
+        reactor thread isn't kept parsing. Reading is paused while a
+        batch is parsed. If enough(parser) returns True after a batch,
+        the rest of the page isn't read. Returns what the parser's
+        close() returns. Logs in and retries like get().
+        """
+        retry = True
+        while True:
+            generation = yield self.login()
+            parser = parser_class()
+            # The end of the last chunk, to find a marker split over two,
+            # and chunks not yet parsed
+            state = {'tail': '', 'login': False, 'batch': list(), 'size': 0}
+
+            def parse(text):
+                # May run in a worker thread, while reading is paused
+                parser.feed(text)
+                return enough is not None and enough(parser)
+
+            def finish(text):
+                parser.feed(text)
+                return parser.close()
+
+            def take():
+                text = ''.join(state['batch'])
+                state['batch'] = list()
+                state['size'] = 0
+                return text
+
+            def feed(chunk):
+                window = state['tail'] + chunk
+                if retry and login_marker in window:
+                    state['login'] = True
+                    return True
+                state['tail'] = window[-len(login_marker):]
+                state['batch'].append(chunk)
+                state['size'] += len(chunk)
+                if state['size'] < stream_batch:
+                    return False
+                return zmWorkers.parse(self.stats, parse, take())
+
+            try:
+                yield self.circuit.run(self._stream, self._url(path), feed)
+            except Exception as e:
+                if retry and http_status(e) == 401:
+                    LOG.debug('%s: ZoneMinder session rejected', path)
+                    self.invalidate(generation)
+                    retry = False
+                    continue
+                raise
+
+            if state['login']:
+                LOG.debug('%s: ZoneMinder web session expired', path)
+                self.invalidate(generation)
+                retry = False
+                continue
+
+            result = yield zmWorkers.parse(self.stats, finish, take())
+            returnValue(result)
+
+    @inlineCallbacks
+    def logout(self):
+        """ Ends the session on the ZoneMinder server """
+        if self.cookies:
+            try:
+                yield self.circuit.run(
+                    self._fetch,
+                    self._url('api/host/logout.json'),
+                    'GET',
+                    self.cookies
+                    )
+            finally:
+                self.invalidate()
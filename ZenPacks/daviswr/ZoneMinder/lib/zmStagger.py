@@ -0,0 +1,54 @@
+""" Spreads each device's collection across the cycle """
+
+import functools
+import hashlib
+
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
+
+# Longest delay as a fraction of the cycle time, so a delayed
+# collection has time to finish before the next cycle starts
+max_fraction = 0.5
+
+
+def offset(device, cycletime, jitter):
+    """ Returns the seconds a device's collection is delayed each cycle
+
+    The delay comes from a hash of the device ID, so it's the same
+    every cycle and for every datasource of the device, which keeps
+    sharing responses, while different devices are spread evenly
+    across up to jitter seconds. It's capped at half the cycle time,
+    and a jitter of 0 disables it.
+    """
+    limit = min(float(jitter or 0), float(cycletime or 0) * max_fraction)
+    if limit <= 0:
+        return 0.0
+    digest = int(hashlib.md5(device).hexdigest()[:8], 16)
+    return digest / float(2 ** 32) * limit
+
+
+def config_offset(config):
+    """ Returns the delay of a datasource task's device """
+    if not config.datasources:
+        return 0.0
+    datasource = config.datasources[0]
+    return offset(
+        config.id,
+        datasource.cycletime,
+        datasource.params.get('jitter')
+        )
+
+
+def staggered(func):
+    """ Decorates a datasource plugin's collect to start after its delay
+
+    The whole call is delayed, including logging in, so a device's
+    requests stay together and are timed from when they're sent.
+    """
+    @functools.wraps(func)
+    def wrapper(plugin, config):
+        delay = config_offset(config)
+        if not delay:
+            return func(plugin, config)
+        return deferLater(reactor, delay, func, plugin, config)
+    return wrapper
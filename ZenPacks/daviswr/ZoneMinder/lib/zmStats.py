@@ -0,0 +1,88 @@
+""" The collector's own cost of polling each ZoneMinder server """
+
+# Request kinds timed separately, the rest are 'api'
+request_kinds = ('login', 'console', 'events', 'monitors', 'api')
+
+
+def request_kind(path):
+    """ Returns the kind of request for a path relative to the base URL """
+    if path.startswith(('api/host/login', 'api/host/logout')):
+        return 'login'
+    elif path.startswith('index.php'):
+        return 'console'
+    elif path.startswith('api/events'):
+        return 'events'
+    elif path.startswith('api/monitors'):
+        return 'monitors'
+    return 'api'
+
+
+class CollectorStats(object):
+    """ Requests, bytes, and time spent on one ZoneMinder server
+
+    Every plugin adds to the same counters, and the Daemon plugin
+    takes them once a cycle, so they cover everything the collector
+    did for the server since the Daemon plugin last ran.
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.bytes = 0
+        self.console_bytes = 0
+        self.parse_time = 0.0
+        # Most parses queued or running in worker threads at once,
+        # and the total seconds and count of parses waiting for one
+        self.parse_queue = 0
+        self.parse_wait = [0.0, 0]
+        # Request kind to total seconds and count
+        self.times = dict((x, [0.0, 0]) for x in request_kinds)
+
+    def request(self, kind, seconds, size=0):
+        """ Records a finished or failed request """
+        self.requests += 1
+        self.bytes += size
+        if 'console' == kind:
+            self.console_bytes += size
+        self.times[kind][0] += seconds
+        self.times[kind][1] += 1
+
+    def parsed(self, seconds):
+        """ Records time spent parsing responses """
+        self.parse_time += seconds
+
+    def queued(self, backlog):
+        """ Records the worker backlog when a parse is queued """
+        self.parse_queue = max(self.parse_queue, backlog)
+
+    def waited(self, seconds):
+        """ Records time a parse spent waiting for a worker """
+        self.parse_wait[0] += seconds
+        self.parse_wait[1] += 1
+
+    def take(self):
+        """ Returns datapoint values and starts counting again
+
+        Times are in milliseconds, the mean for each kind of request
+        and for waiting on a parse worker, and the total for parsing.
+        Kinds of request not seen are left out.
+        """
+        values = {
+            'requests': self.requests,
+            'bytes': self.bytes,
+            'console-bytes': self.console_bytes,
+            'parse-time': int(self.parse_time * 1000),
+            'parse-queue': self.parse_queue,
+            }
+        if self.parse_wait[1]:
+            values['parse-wait'] = int(
+                self.parse_wait[0] * 1000 / self.parse_wait[1]
+                )
+        for (kind, (seconds, count)) in self.times.items():
+            if count:
+                values['{0}-time'.format(kind)] = int(seconds * 1000 / count)
+        self.reset()
+        return values
@@ -1,5 +1,6 @@
 """ A library of ZoneMinder-related functions """
 
+import json
 import re
 
 url_regex = r'^https?:\/\/\S+:?\d*\/?\S*\/$'
@@ -61,153 +62,524 @@ def generate_zm_url(hostname=None,
     return url
 
 
-def scrape_console_bandwidth(html):
-    """ Scrapes total capture bandwidth from Console page HTML """
-    bandwidth_regex = r'<td class="colFunction">(\S+)B\/s'
-    match = re.search(bandwidth_regex, html)
-    if match:
-        bandwidth_str = match.groups()[0].upper()
-        if bandwidth_str[-1] not in '0123456789':
-            unit_multi = {
-                'K': 1000,
-                'M': 1000**2,
-                'G': 1000**3,
-                'T': 1000**4,
-                }
-            bandwidth = float(bandwidth_str[:-1])
-            bandwidth = bandwidth * unit_multi.get(
-                bandwidth_str[-1],
-                1
-                )
-        else:
-            bandwidth = float(bandwidth_str)
-    else:
-        bandwidth = ''
-
-    return bandwidth
-
+# Oldest versions whose monitors.json includes Monitor_Status
+# for every monitor, letting the API stand in for the Console
+api_mode_version = (1, 34)
+api_mode_apiversion = (2, 0)
+
+
+def version_tuple(version):
+    """ Returns a dotted version string as a tuple of integers """
+    output = list()
+    for token in str(version or '').split('.'):
+        match = re.match(r'\d+', token)
+        if not match:
+            break
+        output.append(int(match.group()))
+    return tuple(output)
+
+
+def supports_api_mode(version, apiversion=None):
+    """ Returns True if values can be taken from the API, not Console """
+    return (version_tuple(version) >= api_mode_version
+            or version_tuple(apiversion) >= api_mode_apiversion)
+
+
+def get_daemon(context):
+    """ Returns the ZoneMinder daemon component of a component """
+    if hasattr(context, 'zoneMinder'):
+        return context.zoneMinder()
+    return context
+
+
+def active_state(states):
+    """ Returns the ID of the active run state from states.json items """
+    for state in states:
+        if state.get('State', dict()).get('IsActive', '0') == '1':
+            return state['State']['Id']
+    return None
+
+
+def monitor_online(monitor):
+    """ Returns a monitor's online state from its API Monitor_Status
+
+    Mirrors the Source column class on the Console page, where
+    errorText is 0, infoText is 1, and anything else is 2.
+    """
+    config = monitor.get('Monitor') or dict()
+    status = monitor.get('Monitor_Status') or dict()
+
+    if status.get('Status', 'NotRunning') == 'NotRunning':
+        if config.get('Type') != 'WebSite':
+            return 0
+    elif not float(status.get('CaptureFPS') or 0):
+        return 0
+    elif (not float(status.get('AnalysisFPS') or 0)
+            and config.get('Function') not in ('Monitor', 'Nodect')):
+        return 2
+    return 1
+
+
+def summarize_monitors(monitors):
+    """ Returns Console-style totals from API monitors with status
+
+    Total capture bandwidth in bytes/sec is the sum of each monitor's,
+    and capturing is the rounded percentage of monitors with a function
+    other than None that are connected.
+    """
+    bandwidth = 0.0
+    active = 0
+    capturing = 0
+    for monitor in monitors:
+        config = monitor.get('Monitor') or dict()
+        status = monitor.get('Monitor_Status') or dict()
+        bandwidth += float(status.get('CaptureBandwidth') or 0)
+        if config.get('Function', 'None') != 'None':
+            active += 1
+            if status.get('Status') == 'Connected':
+                capturing += 1
 
-def scrape_console_capturing(html):
-    """ Scrapes system capturing percentage from Console page HTML """
-    # Capturing percentage examples:
-    # <span class="status"><label>Capturing</label>66.7%</span>
-    # <span class="status"><label>Capturing</label>100%</span>
-    capturing_regex = r'Capturing\D+(\d+\.?\d*)%'
-    capturing_match = re.search(capturing_regex, html)
-    return round(float(capturing_match.groups()[0])) if capturing_match else ''
-
-
-def scrape_console_db(html):
-    """ Scrapes DB connection count from Console page HTML """
-    # 1.34 database connections example:
-    # <li>DB:35/151</li>
-    # 1.36:
-    # DB: 33/1000
-    db_regex = r'DB:\s?(\d+)/(\d+)'
-    db_match = re.search(db_regex, html)
     return {
-        'db-used': int(db_match.groups()[0]) if db_match else '',
-        'db-max': int(db_match.groups()[1]) if db_match else '',
+        'bandwidth': bandwidth,
+        'capturing': round(100.0 * capturing / active) if active else '',
         }
 
 
-def scrape_console_monitor(html, monitor_id):
-    """ Scrapes monitor connectivity status from Console page HTML """
-    online_regex = r'<td class="colSource">.*<span class="(\w+)Text">'
-    online_map = {
-        'error': 0,
-        'info': 1,
-        }
-    output = ''
-
-    # Late 1.36
-    if '<a class="functionLnk ' in html:
-        watch_prefix = 'functionLnk-'
-        watch_offset = 0
-        online_regex = r'<a class="functionLnk (\w+)Text"'
-    # Early 1.36
-    elif 'functionLnk-' in html:
-        watch_prefix = 'functionLnk-'
-        watch_offset = 5
-    # 1.34
-    elif 'zmMonitor' in html:
-        watch_prefix = 'zmMonitor'
-        watch_offset = 0
-        online_regex = r'zmMonitor.*<span class="(\w+)Text">'
-    # 1.32 - has to be last
-    elif 'monitor_id-' in html:
-        watch_prefix = 'monitor_id-'
-        watch_offset = 9
+# Monitor columns the modeler reads, all others are dropped from
+# monitors.json as it's decoded
+monitor_keys = frozenset((
+    'AlarmMaxFPS',
+    'AnalysisFPS',
+    'CaptureFPS',
+    'Colours',
+    'ControlId',
+    'Controllable',
+    'Enabled',
+    'Function',
+    'Height',
+    'Host',
+    'Id',
+    'MaxFPS',
+    'Method',
+    'Name',
+    'Path',
+    'Port',
+    'Protocol',
+    'Sequence',
+    'ServerId',
+    'Type',
+    'Width',
+    ))
+
+# Monitors excluding a list of IDs, filtered by the API server
+monitors_excluding_path = 'api/monitors/index/Id%20!%3D:%5B{0}%5D.json'
+
+
+def monitors_path(ignore_ids):
+    """ Returns the path of monitors.json without ignored monitor IDs
+
+    Only the numeric IDs can be expressed as an API condition. Names
+    and hostnames are Python regexes, which MySQL's REGEXP doesn't
+    match the same way, so those are always filtered by the modeler.
+    """
+    ids = sorted(
+        set(str(x) for x in ignore_ids or list() if str(x).isdigit()),
+        key=int
+        )
+    if not ids:
+        return 'api/monitors.json'
+    return monitors_excluding_path.format(','.join(ids))
+
+
+def trim_monitor(pairs):
+    """ json object_pairs_hook keeping only modeled monitor columns
+
+    Decoded from the innermost object out, so each monitor's columns
+    are trimmed as soon as it's complete, and the rest of the item,
+    such as Monitor_Status, is dropped, rather than the whole response
+    being held until it's been decoded.
+    """
+    item = dict(pairs)
+    monitor = item.get('Monitor')
+    if isinstance(monitor, dict):
+        for key in monitor.viewkeys() - monitor_keys:
+            del monitor[key]
+        return {'Monitor': monitor}
+    return item
+
+
+def load_monitors(text):
+    """ Decodes monitors.json with only the modeled monitor columns """
+    return json.loads(text, object_pairs_hook=trim_monitor)
+
+
+# Monitor source Path that's a full URL with protocol, host, and path
+source_url_regex = re.compile(r'([A-Za-z]+):\/\/([^/]+)(\/.*)')
+
+# Passwords in a source URL, followed by more of the URL or at its end
+source_pass_mid_regex = re.compile(r'(\S+)passw?o?r?d?=[^_&?]+[_&?](\S+)')
+source_pass_end_regex = re.compile(r'(\S+)passw?o?r?d?=[^_&?]+')
+
+# Default ports of monitor source protocols, and the inverse
+protocol_port = {
+    'http': '80',
+    'https': '443',
+    'rtsp': '554',
+    }
+port_protocol = dict((value, key) for (key, value) in protocol_port.items())
+
+# Monitor Colours to a description
+monitor_colors = {
+    '1': '8-bit grayscale',
+    '2': '24-bit color',
+    '3': '32-bit color',
+    '4': '32-bit color',
+    }
+
+# Normalized sources by their raw monitor fields, emptied when full
+sources = dict()
+max_sources = 65536
+
+
+def normalize_source(protocol, host, port, path):
+    """ Returns a monitor's source protocol, host, port, and path
+
+    We may or may not have a hostname/IP, port, protocol, path, or full
+    URL, and some of these may have passwords. Credentials are removed,
+    and the path is always returned as a full URL. Results are cached,
+    as monitors often share source fields and are remodeled unchanged.
+    """
+    key = (protocol, host, port, path)
+    source = sources.get(key)
+    if source is None:
+        if len(sources) >= max_sources:
+            sources.clear()
+        source = parse_source(protocol, host, port, path)
+        sources[key] = source
+    return source
+
+
+def parse_source(protocol, host, port, path):
+    """ Normalizes a monitor's source fields without caching """
+    path_url_match = source_url_regex.match(path)
+    if path_url_match:
+        # Path attribute is a full URL with protocol, host, and port
+        # so it's more believable than the individual attributes
+        (protocol, host_string, url_path) = path_url_match.groups()
     else:
-        watch_prefix = ''
+        host_string = host
+        url_path = path
 
-    watch_id = watch_prefix + monitor_id
+    if '@' in host_string:
+        (credentials, host_string) = host_string.split('@')
+        url_path = url_path.replace(credentials + '@', '')
+        path = path.replace(credentials + '@', '')
 
-    if watch_prefix and watch_id in html:
-        watch_index = -1
-        console = html.splitlines()
-        for ii in range(0, len(console) - 1):
-            if watch_id in console[ii]:
-                watch_index = ii
+    if ':' in host_string:
+        (host, port) = host_string.split(':')
+    else:
+        host = host_string
+
+    if not path_url_match:
+        path = '{0}://{1}:{2}{3}'.format(protocol, host, port, url_path)
+        if port:
+            if (not protocol
+                    or protocol != port_protocol.get(port, protocol)):
+                protocol = port_protocol.get(port, protocol)
+        elif protocol:
+            port = protocol_port.get(protocol, port)
+
+    # Getting protocol from the full URL path
+    elif port != protocol_port.get(protocol, port):
+        port = protocol_port.get(protocol, port)
+
+    url_pass_match = (source_pass_mid_regex.match(path)
+                      or source_pass_end_regex.match(path))
+    if url_pass_match:
+        path = url_pass_match.groups()[0]
+        if len(url_pass_match.groups()) > 1:
+            path += url_pass_match.groups()[1]
+
+    return (protocol.upper(), host, port, path)
+
+
+# Byte multipliers for Console storage volume sizes
+volume_multiplier = {
+    'B': 1,
+    'KB': 1024,
+    'MB': 1024**2,
+    'GB': 1024**3,
+    'TB': 1024**4,
+    'PB': 1024**5,
+    'EB': 1024**6,
+    'ZB': 1024**7,
+    'YB': 1024**8,
+    }
+
+# Total capture bandwidth example:
+# <td class="colFunction">1.5MB/s
+bandwidth_regex = re.compile(r'<td class="colFunction">(\S+)B\/s')
+
+# Capturing percentage examples:
+# <span class="status"><label>Capturing</label>66.7%</span>
+# <span class="status"><label>Capturing</label>100%</span>
+capturing_regex = re.compile(r'Capturing\D+(\d+\.?\d*)%')
+
+# 1.34 database connections example:
+# <li>DB:35/151</li>
+# 1.36:
+# DB: 33/1000
+db_regex = re.compile(r'DB:\s?(\d+)/(\d+)')
+
+# SHM Example:
+# <span class="">/run/shm: 34%</span></li>
+shm_regex = re.compile(r'/\w+\/shm.?\s+(\d+)%?')
+
+# 1.34 Storage Volume Example:
+# <span class="" title="390.06GB of 2.69TB 249.93GB used by events">Storage2: 14%</span>  # noqa
+# 1.36 Example:
+# <a class="dropdown-item " title="2.38TB of 5.41TB 2.11TB used by events"
+# 	href="?view=options&amp;tab=storage">Storage2: 44%</a>
+volume_regex = re.compile(r'(\d+\.?\d*)(\w?B) of (\d+\.?\d*)(\w?B) (\d+\.?\d*)(\w?B) used by events"[\n\r]?.*\>(\S+):\s+(\d+)%')  # noqa
+
+# Monitor online state from the Source column, or from
+# the Function link in late 1.36
+source_regex = re.compile(r'<td class="colSource">.*<span class="(\w+)Text">')
+function_regex = re.compile(r'<a class="functionLnk (\w+)Text"')
+zm_monitor_regex = re.compile(r'zmMonitor.*<span class="(\w+)Text">')
+
+online_map = {
+    'error': 0,
+    'info': 1,
+    }
+
+# Console layouts, in the order they're preferred when detected.
+# Each has the marker identifying the layout, the prefix on monitor IDs,
+# how many lines after the ID the state is found, and the state regex.
+console_layouts = (
+    ('1.36-late', '<a class="functionLnk ', 'functionLnk-', 0,
+     function_regex),
+    ('1.36-early', 'functionLnk-', 'functionLnk-', 5, source_regex),
+    ('1.34', 'zmMonitor', 'zmMonitor', 0, zm_monitor_regex),
+    # 1.32 - has to be last
+    ('1.32', 'monitor_id-', 'monitor_id-', 9, source_regex),
+    )
+
+# The monitor table's opening element, after everything in the header.
+# It has the consoleTable class in 1.32 and 1.34, and ID in 1.36, where
+# the element's attributes are each on their own line. Layout markers
+# can't be relied on for this, as they may appear in the header too.
+console_table_regex = re.compile(
+    r'(?:class|id)="(?:[^"]*\s)?consoleTable[\s"]'
+    )
+
+monitor_id_regexes = dict(
+    (prefix, re.compile(re.escape(prefix) + r'(\d+)'))
+    for prefix in set(layout[2] for layout in console_layouts)
+    )
+
+
+class ConsoleSnapshot(object):
+    """ Values scraped from a single pass over the Console page """
+
+    def __init__(self):
+        self.layout = None
+        self.shm = ''
+        self.db = {
+            'db-used': '',
+            'db-max': '',
+            }
+        self.bandwidth = ''
+        self.capturing = ''
+        # Storage volume name to used, total, events, and percent
+        self.volumes = dict()
+        # Monitor ID string to online state
+        self.monitors = dict()
+
+
+class ConsoleParser(object):
+    """ Parses the Console page line by line into a ConsoleSnapshot
+
+    Text can be fed in chunks of any size. Values split across two
+    adjacent lines are still found.
+    """
+
+    def __init__(self):
+        self.snapshot = ConsoleSnapshot()
+        self.buffer = ''
+        self.previous = ''
+        self.line_no = 0
+        # Layouts whose marker has been seen
+        self.markers = set()
+        self.table_reached = False
+        # Per-layout monitor states, and monitors waiting on a later line
+        self.states = dict((layout[0], dict()) for layout in console_layouts)
+        self.pending = dict()
+
+    def feed(self, text):
+        """ Parses a chunk of Console HTML """
+        lines = (self.buffer + text).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            self._parse_line(line.rstrip('\r'))
+
+    def header_parsed(self):
+        """ Whether the monitor table has been reached
+
+        Shared memory, database connections, and storage volumes are
+        all in the header above it. Never true of a page without the
+        table's opening element, which is then read in full.
+        """
+        return self.table_reached
+
+    def close(self):
+        """ Parses any remaining text and returns the ConsoleSnapshot """
+        if self.buffer:
+            self._parse_line(self.buffer.rstrip('\r'))
+            self.buffer = ''
+
+        snapshot = self.snapshot
+        for layout in console_layouts:
+            if layout[0] in self.markers:
+                snapshot.layout = layout[0]
+                snapshot.monitors = self.states[layout[0]]
                 break
-        if watch_index > -1:
-            online_line = console[watch_index + watch_offset]
-            online_match = re.search(online_regex, online_line)
-            if online_match:
-                online_state = online_match.groups()[0]
-                output = online_map.get(online_state, 2)
-
-    return output
-
-
-def scrape_console_shm(html):
-    """ Scrape SHM utilization from Console page HTML """
-    # SHM Example:
-    # <span class="">/run/shm: 34%</span></li>
-    shm_regex = r'/\w+\/shm.?\s+(\d+)%?'
-    shm_match = re.search(shm_regex, html)
-    return int(shm_match.groups()[0]) if shm_match else ''
-
-
-def scrape_console_volumes(html):
-    """ Scrapes storage volume information from HTML """
-
-    multiplier = {
-        'B': 1,
-        'KB': 1024,
-        'MB': 1024**2,
-        'GB': 1024**3,
-        'TB': 1024**4,
-        'PB': 1024**5,
-        'EB': 1024**6,
-        'ZB': 1024**7,
-        'YB': 1024**8,
-        }
 
-    # 1.34 Storage Volume Example:
-    # <span class="" title="390.06GB of 2.69TB 249.93GB used by events">Storage2: 14%</span>  # noqa
-    # 1.36 Example:
-    # <a class="dropdown-item " title="2.38TB of 5.41TB 2.11TB used by events"
-    # 	href="?view=options&amp;tab=storage">Storage2: 44%</a>
-    stores_regex = r'(\d+\.?\d*)(\w?B) of (\d+\.?\d*)(\w?B) (\d+\.?\d*)(\w?B) used by events"[\n\r]?.*\>(\S+):\s+(\d+)%'  # noqa
-    stores = dict()
-
-    store_matches = re.findall(stores_regex, html)
-    for store_match in store_matches:
-        # store_match tuple example:
-        # ('3.37', 'TB', '3.58', 'TB', '2.6', 'TB', 'Default', '94')
-        store_name = store_match[6]
-        store = {
-            'used': float(store_match[0]) * multiplier.get(store_match[1]),
-            'total': float(store_match[2]) * multiplier.get(store_match[3]),
-            'events': float(store_match[4]) * multiplier.get(store_match[5]),
-            'percent': store_match[7],
+        dedupe_default_volume(snapshot.volumes)
+        return snapshot
+
+    def _parse_line(self, line):
+        """ Scrapes values from a line and the one before it """
+        snapshot = self.snapshot
+        # Lets a match begin on the previous line
+        window = self.previous + '\n' + line
+
+        if '' == snapshot.shm and 'shm' in window:
+            match = shm_regex.search(window)
+            if match:
+                snapshot.shm = int(match.groups()[0])
+
+        if '' == snapshot.db['db-used'] and 'DB:' in window:
+            match = db_regex.search(window)
+            if match:
+                snapshot.db = {
+                    'db-used': int(match.groups()[0]),
+                    'db-max': int(match.groups()[1]),
+                    }
+
+        if '' == snapshot.bandwidth and 'colFunction' in line:
+            match = bandwidth_regex.search(line)
+            if match:
+                snapshot.bandwidth = parse_bandwidth(match.groups()[0])
+
+        if '' == snapshot.capturing and 'Capturing' in window:
+            match = capturing_regex.search(window)
+            if match:
+                snapshot.capturing = round(float(match.groups()[0]))
+
+        if 'used by events"' in window:
+            previous_len = len(self.previous)
+            for match in volume_regex.finditer(window):
+                # Matches entirely on the previous line were already found
+                if match.end() > previous_len:
+                    store_name, store = parse_volume(match.groups())
+                    snapshot.volumes[store_name] = store
+
+        if not self.table_reached and 'consoleTable' in line:
+            self.table_reached = bool(console_table_regex.search(line))
+
+        self._parse_monitors(line)
+        self.previous = line
+        self.line_no += 1
+
+    def _parse_monitors(self, line):
+        """ Tracks monitor online state for every possible layout """
+        # Monitors found on an earlier line with their state on this one
+        for (layout, monitor_id, state_regex) in self.pending.pop(
+                self.line_no,
+                list()
+                ):
+            self._parse_state(layout, monitor_id, state_regex, line)
+
+        for (layout, marker, prefix, offset, state_regex) in console_layouts:
+            if marker in line:
+                self.markers.add(layout)
+            if prefix not in line:
+                continue
+
+            states = self.states[layout]
+            for monitor_id in monitor_id_regexes[prefix].findall(line):
+                # Only the first appearance of a monitor counts
+                if monitor_id in states:
+                    continue
+                # Placeholder until the state line is reached
+                states[monitor_id] = ''
+                if 0 == offset:
+                    self._parse_state(layout, monitor_id, state_regex, line)
+                else:
+                    self.pending.setdefault(
+                        self.line_no + offset,
+                        list()
+                        ).append((layout, monitor_id, state_regex))
+
+    def _parse_state(self, layout, monitor_id, state_regex, line):
+        """ Records a monitor's online state from its state line """
+        match = state_regex.search(line)
+        if match:
+            self.states[layout][monitor_id] = online_map.get(
+                match.groups()[0],
+                2
+                )
+
+
+def parse_console(html):
+    """ Scrapes everything of interest from Console page HTML at once """
+    parser = ConsoleParser()
+    parser.feed(html)
+    return parser.close()
+
+
+def parse_bandwidth(bandwidth_str):
+    """ Converts a Console bandwidth string like 1.5M to bytes/sec """
+    bandwidth_str = bandwidth_str.upper()
+    if bandwidth_str[-1] not in '0123456789':
+        unit_multi = {
+            'K': 1000,
+            'M': 1000**2,
+            'G': 1000**3,
+            'T': 1000**4,
             }
-        for metric in store:
-            store[metric] = int(store[metric])
+        bandwidth = float(bandwidth_str[:-1])
+        bandwidth = bandwidth * unit_multi.get(
+            bandwidth_str[-1],
+            1
+            )
+    else:
+        bandwidth = float(bandwidth_str)
+
+    return bandwidth
+
+
+def parse_volume(store_match):
+    """ Converts a storage volume regex match to a name and stats dict """
+    # store_match tuple example:
+    # ('3.37', 'TB', '3.58', 'TB', '2.6', 'TB', 'Default', '94')
+    store_name = store_match[6]
+    multiplier = volume_multiplier
+    store = {
+        'used': float(store_match[0]) * multiplier.get(store_match[1]),
+        'total': float(store_match[2]) * multiplier.get(store_match[3]),
+        'events': float(store_match[4]) * multiplier.get(store_match[5]),
+        'percent': store_match[7],
+        }
+    for metric in store:
+        store[metric] = int(store[metric])
+
+    return (store_name, store)
 
-        stores[store_name] = store
 
+def dedupe_default_volume(stores):
+    """ Merges the Default volume into the volume it duplicates """
     # A volume named Default can be a dopplerganger of another volume,
     # but the event storage metric is associated with it instead of
     # the actual storage volume
@@ -0,0 +1,67 @@
+""" Parses large responses in worker threads, off the reactor thread """
+
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import maybeDeferred
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+# Most worker threads parsing at once in the collector process
+max_workers = 2
+
+# Responses shorter than this many characters are parsed in the
+# reactor thread, as handing them to a worker would cost more
+min_offload = 65536
+
+# The shared pool, created on first use
+pool = None
+
+# Offloaded parses queued or running
+backlog = 0
+
+
+def get_pool():
+    """ Returns the shared worker thread pool, starting it if needed """
+    global pool
+    if pool is None:
+        pool = ThreadPool(0, max_workers, 'zen.ZoneMinder.parse')
+        pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', pool.stop)
+    return pool
+
+
+def parse(stats, func, text):
+    """ Returns a Deferred firing with func(text)
+
+    Large responses are parsed by a worker thread, so the reactor
+    thread keeps serving every other task meanwhile. func must not
+    touch shared state. Time spent parsing, and waiting for a worker,
+    is recorded in a CollectorStats.
+    """
+    global backlog
+    if len(text) < min_offload:
+        start = time.time()
+        deferred = maybeDeferred(func, text)
+        stats.parsed(time.time() - start)
+        return deferred
+
+    backlog += 1
+    stats.queued(backlog)
+    queued = time.time()
+
+    def work():
+        # Runs in the worker thread
+        start = time.time()
+        try:
+            return func(text)
+        finally:
+            reactor.callFromThread(finished, start, time.time())
+
+    def finished(start, end):
+        global backlog
+        backlog -= 1
+        stats.waited(start - queued)
+        stats.parsed(end - start)
+
+    return deferToThreadPool(reactor, get_pool(), work)
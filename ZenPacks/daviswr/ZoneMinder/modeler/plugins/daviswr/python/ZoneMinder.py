@@ -2,14 +2,20 @@
 
 import json
 import re
+import time
 
-from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import getPage
+from twisted.internet.defer import DeferredList, inlineCallbacks, returnValue
 
 from Products.DataCollector.plugins.CollectorPlugin import PythonPlugin
 from Products.DataCollector.plugins.DataMaps import ObjectMap, RelationshipMap
 
-from ZenPacks.daviswr.ZoneMinder.lib import zmUtil
+from ZenPacks.daviswr.ZoneMinder.lib import (
+    zmFingerprint,
+    zmProfile,
+    zmSession,
+    zmUtil,
+    zmWorkers,
+    )
 
 
 class ZoneMinder(PythonPlugin):
@@ -29,10 +35,16 @@ class ZoneMinder(PythonPlugin):
         'zZoneMinderIgnoreStorageId',
         'zZoneMinderIgnoreStorageName',
         'zZoneMinderIgnoreStoragePath',
+        'zZoneMinderMaxRequests',
+        'zZoneMinderProfiling',
         )
 
-    deviceProperties = PythonPlugin.deviceProperties + requiredProperties
+    deviceProperties = PythonPlugin.deviceProperties + requiredProperties + (
+        # Last change time and components, added to Device by this ZenPack
+        'getZoneMinderModel',
+        )
 
+    @zmProfile.profiled('modeler-collect', zmProfile.modeler_device)
     @inlineCallbacks
     def collect(self, device, log):
         """Asynchronously collect data from device. Return a deferred."""
@@ -63,108 +75,128 @@ class ZoneMinder(PythonPlugin):
             returnValue(None)
 
         log.info('%s: using base ZoneMinder URL %s', device.id, base_url)
-        api_url = '{0}api/'.format(base_url)
-        login_url = '{0}host/login.json?user={1}&pass={2}&stateful=1'.format(
-            api_url,
+
+        session = zmSession.get_session(
+            base_url,
             username,
-            password
+            password,
+            getattr(device, 'zZoneMinderMaxRequests', None)
             )
-        # log.debug('%s: ZoneMinder URL:%s', device.id, login_url)
-
-        cookies = dict()
         try:
             # Attempt login
-            response = yield getPage(login_url, method='POST', cookies=cookies)
-
-            if 'Login denied' in response or '"success": false' in response:
-                log.error(
-                    '%s: ZoneMinder login credentials invalid',
-                    device.id
-                    )
-                returnValue(None)
-            elif not cookies:
-                log.error(
-                    '%s: No cookies received, enable OPT_USE_LEGACY_API_AUTH',
-                    device.id
-                    )
-                returnValue(None)
-
-            log.debug('%s: ZoneMinder cookies\n%s', device.id, cookies)
+            yield session.login()
+            log.debug('%s: ZoneMinder cookies\n%s', device.id, session.cookies)
 
             output = dict()
             output['url'] = base_url
 
-            # Versions
-            log.debug('%s: ZoneMinder URL: host/getVersion.json', device.id)
-            response = yield getPage(
-                api_url + 'host/getVersion.json',
-                method='GET',
-                cookies=cookies
+            # Ignored monitor IDs are left out by the API server,
+            # unless it's been found not to
+            ignore_ids = set(
+                getattr(device, 'zZoneMinderIgnoreMonitorId', None) or list()
                 )
-            version_json = json.loads(response)
+            if session.server.filters_monitors:
+                monitors = zmUtil.monitors_path(ignore_ids)
+            else:
+                monitors = 'api/monitors.json'
+
+            # Versions, config, monitors, storage, and storage volumes
+            # don't depend on each other, so they're requested concurrently
+            endpoints = (
+                'api/host/getVersion.json',
+                'api/configs.json',
+                monitors,
+                'api/storage.json',
+                # Servers
+                # 'api/servers.json',
+                )
+            results = yield DeferredList(
+                [self.get_monitors(session, x, device, log) if monitors == x
+                 else self.timed_get(session, x, device, log)
+                 for x in endpoints]
+                + [self.get_volumes(session, device, log)],
+                consumeErrors=True
+                )
+
+            for (success, result) in results:
+                if not success:
+                    result.raiseException()
+
+            responses = dict(zip(endpoints, (x[1] for x in results)))
+            console = results[-1][1]
+
+            # Large responses are decoded by worker threads
+            parsers = {
+                monitors: zmUtil.load_monitors,
+                }
+            decoded = yield DeferredList([
+                zmWorkers.parse(
+                    session.stats,
+                    parsers.get(x, json.loads),
+                    responses[x]
+                    )
+                for x in endpoints
+                ], consumeErrors=True)
+            for (success, result) in decoded:
+                if not success:
+                    result.raiseException()
+            decoded = dict(zip(endpoints, (x[1] for x in decoded)))
+
+            version_json = decoded['api/host/getVersion.json']
             versions = zmUtil.dissect_versions(version_json)
             output.update(version_json)
 
-            # Config
-            log.debug('%s: ZoneMinder URL: configs.json', device.id)
-            response = yield getPage(
-                api_url + 'configs.json',
-                method='GET',
-                cookies=cookies
+            output.update(decoded['api/configs.json'])
+            # Any ignored monitor returned means the server didn't apply
+            # the condition as expected, so what it did return can't be
+            # trusted to be every other monitor
+            returned = set(
+                x.get('Monitor', dict()).get('Id')
+                for x in decoded[monitors].get('monitors', list())
                 )
-            output.update(json.loads(response))
-
-            # Monitors
-            log.debug('%s: ZoneMinder URL: monitors.json', device.id)
-            response = yield getPage(
-                api_url + 'monitors.json',
-                method='GET',
-                cookies=cookies
-                )
-            output.update(json.loads(response))
-
-            # Monitor PTZ Types
-            log.debug('%s: ZoneMinder URL: controls.json', device.id)
-            response = yield getPage(
-                api_url + 'controls.json',
-                method='GET',
-                cookies=cookies
-                )
-            output.update(json.loads(response))
+            if 'api/monitors.json' != monitors and returned & ignore_ids:
+                session.server.filters_monitors = False
+                log.info(
+                    '%s: ZoneMinder did not filter ignored monitors, '
+                    'requesting all monitors',
+                    device.id
+                    )
+                response = yield self.timed_get(
+                    session,
+                    'api/monitors.json',
+                    device,
+                    log
+                    )
+                decoded[monitors] = yield zmWorkers.parse(
+                    session.stats,
+                    zmUtil.load_monitors,
+                    response
+                    )
+            output.update(decoded[monitors])
 
             # Storage Volumes
-            log.debug('%s: ZoneMinder URL: index.php?view=console', device.id)
-            response = yield getPage(
-                '{0}index.php?view=console'.format(base_url),
-                method='GET',
-                cookies=cookies
-                )
-            output['volumes'] = zmUtil.scrape_console_volumes(response)
-
-            # Servers
-            # response = yield getPage(
-            #     api_url + 'servers.json',
-            #     method='GET',
-            #     cookies=cookies
-            #     )
-            # output.update(json.loads(response))
-
-            # Storage
-            log.debug('%s: ZoneMinder URL: storage.json', device.id)
-            response = yield getPage(
-                api_url + 'storage.json',
-                method='GET',
-                cookies=cookies
-                )
-            output.update(json.loads(response))
-
-            # API logout
-            log.debug('%s: ZoneMinder URL: host/logout.json', device.id)
-            yield getPage(
-                api_url + 'host/logout.json',
-                method='GET',
-                cookies=cookies
-                )
+            output['volumes'] = console.volumes
+
+            output.update(decoded['api/storage.json'])
+
+            # Monitor PTZ Types, only needed for controllable monitors
+            controllable = [
+                x for x in output.get('monitors', list())
+                if x.get('Monitor', dict()).get('Controllable') == '1'
+                ]
+            if controllable:
+                response = yield self.timed_get(
+                    session,
+                    'api/controls.json',
+                    device,
+                    log
+                    )
+                output.update(json.loads(response))
+            else:
+                log.debug(
+                    '%s: No controllable monitors, skipping controls.json',
+                    device.id
+                    )
 
         except Exception, e:
             log.error('%s: %s', device.id, e)
@@ -172,6 +204,73 @@ class ZoneMinder(PythonPlugin):
 
         returnValue(output)
 
+    @inlineCallbacks
+    def timed_get(self, session, path, device, log):
+        """Request a path from ZoneMinder, logging how long it took."""
+        log.debug('%s: ZoneMinder URL: %s', device.id, path)
+        start = time.time()
+        try:
+            response = yield session.get(path)
+        finally:
+            log.info(
+                '%s: ZoneMinder %s took %.3f seconds',
+                device.id,
+                path,
+                time.time() - start
+                )
+        returnValue(response)
+
+    @inlineCallbacks
+    def get_volumes(self, session, device, log):
+        """Scrape storage volumes from the Console page header.
+
+        The API has each volume's space used by events, but not the
+        size or usage of its filesystem. Those are only on the Console,
+        above the monitor table, so the rest of the page isn't read.
+        """
+        path = 'index.php?view=console'
+        log.debug('%s: ZoneMinder URL: %s', device.id, path)
+        start = time.time()
+        try:
+            console = yield session.stream(
+                path,
+                zmUtil.ConsoleParser,
+                zmUtil.ConsoleParser.header_parsed
+                )
+        finally:
+            log.info(
+                '%s: ZoneMinder %s header took %.3f seconds',
+                device.id,
+                path,
+                time.time() - start
+                )
+        returnValue(console)
+
+    @inlineCallbacks
+    def get_monitors(self, session, path, device, log):
+        """Request monitors filtered by ZoneMinder, falling back to
+        all monitors if the filtered request fails."""
+        try:
+            response = yield self.timed_get(session, path, device, log)
+        except Exception, e:
+            if 'api/monitors.json' == path:
+                raise
+            log.info(
+                '%s: ZoneMinder could not filter monitors, '
+                'requesting all monitors: %s',
+                device.id,
+                e
+                )
+            response = yield self.timed_get(
+                session,
+                'api/monitors.json',
+                device,
+                log
+                )
+            session.server.filters_monitors = False
+        returnValue(response)
+
+    @zmProfile.profiled('modeler-process', zmProfile.modeler_device)
     def process(self, device, results, log):
         """Process results. Return iterable of datamaps or None."""
 
@@ -250,95 +349,20 @@ class ZoneMinder(PythonPlugin):
                     )
                 continue
 
-            # We may or may not have a hostname/IP, port, protocol,
-            # path, or full URL. Some of these may have passwords.
-            full_url_regex = r'([A-Za-z]+):\/\/([^/]+)(\/.*)'
-            path = monitor.get('Path', '')
-            path_url_match = re.match(full_url_regex, path)
-            if path_url_match:
-                # Path attribute is a full URL with protocol, host, and port
-                # so it's more believable than the individual attributes
-                log.debug('%s: Path is full URL: %s', device.id, path)
-                protocol = path_url_match.groups()[0]
-                host_string = path_url_match.groups()[1]
-                url_path = path_url_match.groups()[2]
-            else:
-                log.debug('%s: Path is NOT a full URL: %s', device.id, path)
-                protocol = monitor.get('Protocol', '')
-                host_string = monitor.get('Host', '')
-                url_path = monitor.get('Path', '')
-
-            if '@' in host_string:
-                log.debug(
-                    '%s: Credentials found in host: %s',
-                    device.id,
-                    host_string
-                    )
-                (credentials, host_string) = host_string.split('@')
-                url_path = url_path.replace(credentials + '@', '')
-                path = path.replace(credentials + '@', '')
-
-            if ':' in host_string:
-                log.debug('%s: Port found in host: %s', device.id, host_string)
-                (host, port) = host_string.split(':')
-            else:
-                host = host_string
-                port = monitor.get('Port', '')
-
-            protocol_port = {
-                'http': '80',
-                'https': '443',
-                'rtsp': '554',
-                }
-
-            # Invert the dictionary
-            port_protocol = dict(
-                (value, key) for key, value in protocol_port.items()
+            (protocol, host, port, path) = zmUtil.normalize_source(
+                monitor.get('Protocol', ''),
+                monitor.get('Host', ''),
+                monitor.get('Port', ''),
+                monitor.get('Path', '')
                 )
-
-            if not path_url_match:
-                path = '{0}://{1}:{2}{3}'.format(
-                    protocol,
-                    host,
-                    port,
-                    url_path
-                    )
-                log.debug('%s: Assembled URL %s', device.id, path)
-
-                if port:
-                    if (not protocol
-                            or protocol != port_protocol.get(port, protocol)):
-                        protocol = port_protocol.get(port, protocol)
-                        log.debug(
-                            '%s: Fixing protocol: %s',
-                            device.id,
-                            protocol
-                            )
-                elif protocol:
-                    port = protocol_port.get(protocol, port)
-                    log.debug('%s: Fixing port: %s', device.id, port)
-
-            # Getting protocol from the full URL path
-            elif port != protocol_port.get(protocol, port):
-                port = protocol_port.get(protocol, port)
-
-            url_pass_mid_regex = r'(\S+)passw?o?r?d?=[^_&?]+[_&?](\S+)'
-            url_pass_end_regex = r'(\S+)passw?o?r?d?=[^_&?]+'
-            url_pass_match = (re.match(url_pass_mid_regex, path)
-                              or re.match(url_pass_end_regex, path))
-            if url_pass_match:
-                log.debug('%s: Remove password from URL %s', device.id, path)
-                path = url_pass_match.groups()[0]
-                if len(url_pass_match.groups()) > 1:
-                    path += url_pass_match.groups()[1]
+            log.debug('%s: Monitor source %s', device.id, path)
 
             monitor['Path'] = path
             monitor['Host'] = host
             monitor['Port'] = port
-            monitor['Protocol'] = protocol.upper()
+            monitor['Protocol'] = protocol
 
-            ignore_match = re.search(ignore_host, host)
-            if ignore_host and ignore_match:
+            if ignore_host and re.search(ignore_host, host):
                 log.info(
                     '%s: Skipping %s in zZoneMinderIgnoreMonitorHostname',
                     device.id,
@@ -361,14 +385,7 @@ class ZoneMinder(PythonPlugin):
                 value = monitor.get(key, None)
                 monitor[key] = int(value) if value else 0
 
-            color_map = {
-                '1': '8-bit grayscale',
-                '2': '24-bit color',
-                '3': '32-bit color',
-                '4': '32-bit color',
-                }
-
-            monitor['Color'] = color_map.get(
+            monitor['Color'] = zmUtil.monitor_colors.get(
                 monitor.get('Colours', 0),
                 'Unknown'
                 )
@@ -476,4 +493,10 @@ class ZoneMinder(PythonPlugin):
             log.debug('%s ZoneMinder storage:\n%s', device.id, rm)
         maps.append(rm)
 
-        return maps
+        # Only send what's changed since the last model
+        return zmFingerprint.incremental(
+            device.id,
+            maps,
+            log,
+            getattr(device, 'getZoneMinderModel', None)
+            )
@@ -0,0 +1,288 @@
+""" End-to-end scale benchmark against a fake ZoneMinder server
+
+Models a FakeZoneMinder, then runs the Daemon, Monitor, and Storage
+datasources for several collection cycles, reporting the requests,
+bytes, wall time, and peak memory of each. Runs in a Zenoss
+environment with the PythonCollector ZenPack installed:
+
+    python -m ZenPacks.daviswr.ZoneMinder.tests.benchmark \\
+        --monitors 10,100,1000 --layout 1.36-late
+"""
+
+import argparse
+import logging
+import resource
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredList, inlineCallbacks
+
+from ZenPacks.daviswr.ZoneMinder.dsplugins.Daemon import Daemon
+from ZenPacks.daviswr.ZoneMinder.dsplugins.Monitor import Monitor
+from ZenPacks.daviswr.ZoneMinder.dsplugins.Storage import Storage
+from ZenPacks.daviswr.ZoneMinder.lib import zmServer
+from ZenPacks.daviswr.ZoneMinder.modeler.plugins.daviswr.python.ZoneMinder \
+    import ZoneMinder
+from ZenPacks.daviswr.ZoneMinder.tests import fakezm
+
+LOG = logging.getLogger('zen.ZoneMinder.benchmark')
+
+# Datapoints of each datasource, as in zenpack.yaml
+datapoints = {
+    'Daemon': (
+        'result',
+        'load-1',
+        'load-5',
+        'load-15',
+        'devshm',
+        'state',
+        'events',
+        'bandwidth',
+        'db-used',
+        'db-max',
+        'capturing',
+        'requests',
+        'bytes',
+        'console-bytes',
+        'login-time',
+        'api-time',
+        'monitors-time',
+        'events-time',
+        'console-time',
+        'parse-time',
+        'parse-queue',
+        'parse-wait',
+        ),
+    'Monitor': (
+        'status',
+        'events',
+        'online',
+        'CaptureFPS',
+        'AnalysisFPS',
+        'CaptureBandwidth',
+        'alarm',
+        ),
+    'Storage': (
+        'used',
+        'total',
+        'events',
+        'percent',
+        ),
+    }
+
+# New events created on the fake server between cycles, per monitor
+events_per_cycle = 0.5
+
+columns = ('layout', 'monitors', 'phase', 'requests', 'KB', 'seconds',
+           'peak MB')
+
+
+class Record(object):
+    """ Attributes standing in for a device or collector config """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def peak_memory():
+    """ Returns the peak resident memory of the process in MB """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def make_device(device_id, base_url, max_requests, profiling=False):
+    """ Returns a device with the zProperties the modeler reads """
+    return Record(
+        id=device_id,
+        manageIp='127.0.0.1',
+        zZoneMinderUsername='admin',
+        zZoneMinderPassword='secret',
+        zZoneMinderHostname='',
+        zZoneMinderPort=None,
+        zZoneMinderPath='/zm/',
+        zZoneMinderSSL=False,
+        zZoneMinderURL=base_url,
+        zZoneMinderIgnoreMonitorId=list(),
+        zZoneMinderIgnoreMonitorName='',
+        zZoneMinderIgnoreMonitorHostname='',
+        zZoneMinderIgnoreStorageId=list(),
+        zZoneMinderIgnoreStorageName='',
+        zZoneMinderIgnoreStoragePath='',
+        zZoneMinderMaxRequests=max_requests,
+        zZoneMinderProfiling=profiling,
+        zZoneMinderCycleJitter=0,
+        )
+
+
+def make_datasource(plugin, component, params):
+    """ Returns a datasource config as zenpython would build it """
+    return Record(
+        datasource=plugin,
+        component=component,
+        cycletime=300,
+        params=params,
+        points=[Record(id=x) for x in datapoints[plugin]],
+        )
+
+
+def make_configs(device, maps):
+    """ Returns Daemon, Monitor, and Storage configs from modeled maps """
+    components = dict((x.relname, x.maps) for x in maps)
+    daemon = components['zoneMinder'][0]
+    monitors = components.get('zmMonitors', list())
+    common = {
+        'username': device.zZoneMinderUsername,
+        'password': device.zZoneMinderPassword,
+        'hostname': device.zZoneMinderHostname,
+        'port': device.zZoneMinderPort,
+        'path': device.zZoneMinderPath,
+        'ssl': device.zZoneMinderSSL,
+        'base_url': device.zZoneMinderURL,
+        'max_requests': device.zZoneMinderMaxRequests,
+        'profiling': device.zZoneMinderProfiling,
+        'jitter': device.zZoneMinderCycleJitter,
+        'es_url': '',
+        }
+
+    params = dict(common)
+    params.update({
+        'version': daemon.version,
+        'apiversion': daemon.apiversion,
+        'monitors': dict(
+            (x.id.replace('zmMonitor', ''), (x.Function, x.Enabled))
+            for x in monitors
+            ),
+        })
+    configs = [(Daemon, Record(id=device.id, datasources=[
+        make_datasource('Daemon', daemon.id, params),
+        ]))]
+
+    datasources = list()
+    for monitor in monitors:
+        params = dict(common)
+        params.update({
+            'version': daemon.version,
+            'apiversion': daemon.apiversion,
+            'function': monitor.Function,
+            'enabled': monitor.Enabled,
+            })
+        datasources.append(make_datasource('Monitor', monitor.id, params))
+    configs.append((Monitor, Record(id=device.id, datasources=datasources)))
+
+    configs.append((Storage, Record(id=device.id, datasources=[
+        make_datasource('Storage', x.id, dict(common))
+        for x in components.get('zmStorage', list())
+        ])))
+    return configs
+
+
+def report(server, layout, monitors, phase, start):
+    """ Prints a row of results and resets the server's counters """
+    print('{0:<11} {1:>8} {2:<8} {3:>8} {4:>10.1f} {5:>8.3f} {6:>8.1f}'.format(
+        layout,
+        monitors,
+        phase,
+        server.requests,
+        server.bytes / 1024.0,
+        time.time() - start,
+        peak_memory()
+        ))
+    server.reset_counters()
+
+
+@inlineCallbacks
+def benchmark(layout, monitors, options):
+    """ Models and collects from a fake server with some monitors """
+    server = fakezm.FakeZoneMinder(
+        monitors,
+        options.volumes,
+        layout,
+        options.latency
+        )
+    port = fakezm.listen(server)
+    try:
+        base_url = 'http://127.0.0.1:{0}/zm/'.format(port.getHost().port)
+        device = make_device(
+            'zm-bench-{0}-{1}'.format(layout, monitors),
+            base_url,
+            options.max_requests,
+            options.profile
+            )
+
+        start = time.time()
+        modeler = ZoneMinder()
+        results = yield modeler.collect(device, LOG)
+        maps = modeler.process(device, results, LOG)
+        report(server, layout, monitors, 'model', start)
+
+        configs = make_configs(device, maps)
+        for cycle in range(1, options.cycles + 1):
+            # Cached responses would have expired between real cycles
+            for zm_server in zmServer.servers.values():
+                zm_server.cache.clear()
+            server.add_events(int(monitors * events_per_cycle))
+
+            start = time.time()
+            results = yield DeferredList(
+                [plugin().collect(config) for (plugin, config) in configs],
+                consumeErrors=True
+                )
+            for (success, result) in results:
+                if not success:
+                    LOG.error('collection failed: %s', result)
+            report(server, layout, monitors, 'cycle {0}'.format(cycle), start)
+    finally:
+        yield port.stopListening()
+
+
+@inlineCallbacks
+def run(options):
+    try:
+        print(('{0:<11} {1:>8} {2:<8} {3:>8} {4:>10} {5:>8} {6:>8}').format(
+            *columns
+            ))
+        for layout in options.layouts:
+            for monitors in options.monitors:
+                yield benchmark(layout, monitors, options)
+    except Exception:
+        LOG.exception('benchmark failed')
+    finally:
+        reactor.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--monitors',
+        default='10,100,1000',
+        help='comma-separated monitor counts'
+        )
+    parser.add_argument(
+        '--layout',
+        dest='layouts',
+        action='append',
+        choices=fakezm.layouts,
+        help='Console layout, may be repeated, defaults to all'
+        )
+    parser.add_argument('--volumes', type=int, default=3)
+    parser.add_argument('--cycles', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--max-requests', type=int, default=4)
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='profile as if zZoneMinderProfiling were set'
+        )
+    parser.add_argument('--verbose', action='store_true')
+    options = parser.parse_args()
+    options.monitors = [int(x) for x in options.monitors.split(',')]
+    options.layouts = options.layouts or fakezm.layouts
+
+    logging.basicConfig(
+        level=logging.DEBUG if options.verbose else logging.WARNING
+        )
+    reactor.callWhenRunning(run, options)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
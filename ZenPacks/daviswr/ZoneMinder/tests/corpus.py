@@ -0,0 +1,98 @@
+""" Synthetic Console pages and monitors.json for scraper benchmarks
+
+Pages are generated from a FakeZoneMinder for every Console layout at
+increasing monitor counts, along with the values a correct parse
+should find. The same seed always gives the same page. Write the
+corpus out to inspect it with:
+
+    python -m ZenPacks.daviswr.ZoneMinder.tests.corpus --output /tmp/zm
+"""
+
+import argparse
+import json
+import os
+
+from ZenPacks.daviswr.ZoneMinder.tests import fakezm
+
+# Monitor counts of each page
+sizes = (10, 100, 1000, 5000)
+
+
+class Page(object):
+    """ A generated Console page and what should be scraped from it """
+
+    def __init__(self, layout, monitors, volumes=3, seed=0,
+                 navbar_markers=False):
+        server = fakezm.FakeZoneMinder(monitors, volumes, layout, seed=seed)
+        server.navbar_markers = navbar_markers
+        self.layout = layout
+        self.size = monitors
+        self.html = server.console()
+        self.api = json.dumps({'monitors': server.monitors})
+        # Decoded monitors.json items, for the API scrapers
+        self.items = json.loads(self.api)['monitors']
+        self.name = '{0}-{1}'.format(layout, monitors)
+
+        # Monitor ID string to online state
+        self.monitors = dict(
+            (x['Monitor']['Id'], server.online_state(x))
+            for x in server.monitors
+            )
+        self.volumes = set(name for (_, name, _) in server.volumes)
+        self.capturing = server.capturing()
+
+    def check(self, snapshot):
+        """ Returns a list of what a ConsoleSnapshot got wrong """
+        errors = list()
+        if self.layout != snapshot.layout:
+            errors.append('layout {0}'.format(snapshot.layout))
+        if self.monitors != snapshot.monitors:
+            wrong = [
+                x for x in self.monitors
+                if self.monitors[x] != snapshot.monitors.get(x)
+                ]
+            errors.append('{0} monitor states'.format(len(wrong)))
+        # The Default volume may be merged into the one it duplicates
+        missing = self.volumes - set(snapshot.volumes) - set(['Default'])
+        if missing:
+            errors.append('volumes {0}'.format(', '.join(sorted(missing))))
+        if self.capturing != snapshot.capturing:
+            errors.append('capturing {0}'.format(snapshot.capturing))
+        for value in ('shm', 'bandwidth'):
+            if '' == getattr(snapshot, value):
+                errors.append('no {0}'.format(value))
+        if '' == snapshot.db['db-used']:
+            errors.append('no db')
+        return errors
+
+
+def generate(layouts=fakezm.layouts, page_sizes=sizes, seed=0):
+    """ Yields a Page for each layout and monitor count """
+    for layout in layouts:
+        for size in page_sizes:
+            yield Page(layout, size, seed=seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', required=True, help='directory')
+    parser.add_argument('--sizes', default=','.join(str(x) for x in sizes))
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+
+    if not os.path.isdir(options.output):
+        os.makedirs(options.output)
+    page_sizes = [int(x) for x in options.sizes.split(',')]
+    for page in generate(page_sizes=page_sizes, seed=options.seed):
+        for (extension, text) in (('html', page.html), ('json', page.api)):
+            path = os.path.join(
+                options.output,
+                '{0}.{1}'.format(page.name, extension)
+                )
+            with open(path, 'w') as output:
+                output.write(text)
+            print(path)
+
+
+if __name__ == '__main__':
+    main()
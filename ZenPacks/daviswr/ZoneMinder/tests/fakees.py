@@ -0,0 +1,269 @@
+""" A fake ZoneMinder Event Notification Server
+
+Speaks enough RFC 6455 for lib/zmEventServer: the upgrade handshake,
+masked client frames, text messages, ping, pong, and close. Clients
+authenticate with a fixed username and password, and alarms can be
+pushed to them, whole or fragmented. Run it standalone with:
+
+    python -m ZenPacks.daviswr.ZoneMinder.tests.fakees --port 9000
+
+then set zZoneMinderEventServerURL to ws://localhost:9000 and
+zZoneMinderUsername and zZoneMinderPassword to admin and secret.
+Every monitor from 1 to --monitors alarms every --interval seconds.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import struct
+
+from twisted.internet import reactor
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.task import LoopingCall
+
+# RFC 6455 constants, kept apart from zmEventServer's so it's tested
+# against an independent implementation
+guid = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+(OP_CONTINUATION, OP_TEXT, OP_CLOSE, OP_PING, OP_PONG) = (
+    0x0, 0x1, 0x8, 0x9, 0xA
+    )
+
+
+def server_frame(opcode, payload='', fin=True):
+    """ Returns an unmasked server frame """
+    length = len(payload)
+    first = (0x80 if fin else 0) | opcode
+    if length < 126:
+        header = struct.pack('!BB', first, length)
+    elif length < 65536:
+        header = struct.pack('!BBH', first, 126, length)
+    else:
+        header = struct.pack('!BBQ', first, 127, length)
+    return header + payload
+
+
+def read_frame(buf):
+    """ Splits the first client frame off a buffer
+
+    Returns (opcode, payload, masked, remainder), or None if the frame
+    isn't complete yet.
+    """
+    if len(buf) < 2:
+        return None
+    (first, second) = struct.unpack('!BB', buf[:2])
+    length = second & 0x7F
+    offset = 2
+    if 126 == length:
+        if len(buf) < 4:
+            return None
+        length = struct.unpack('!H', buf[2:4])[0]
+        offset = 4
+    elif 127 == length:
+        if len(buf) < 10:
+            return None
+        length = struct.unpack('!Q', buf[2:10])[0]
+        offset = 10
+    masked = bool(second & 0x80)
+    key = buf[offset:offset + 4] if masked else '\0\0\0\0'
+    offset += 4 if masked else 0
+    if len(buf) < offset + length:
+        return None
+    payload = bytearray(buf[offset:offset + length])
+    for index in range(len(payload)):
+        payload[index] ^= ord(key[index % 4])
+    return (first & 0x0F, str(payload), masked, buf[offset + length:])
+
+
+class FakeEventServerProtocol(Protocol):
+    """ One client connection to the fake Event Server """
+
+    def connectionMade(self):
+        self.buffer = ''
+        self.upgraded = False
+        self.authenticated = False
+        self.factory.connections.append(self)
+
+    def connectionLost(self, reason):
+        self.factory.connections.remove(self)
+        self.factory.disconnects += 1
+
+    def dataReceived(self, data):
+        self.buffer += data
+        if not self.upgraded:
+            (head, sep, self.buffer) = self.buffer.partition('\r\n\r\n')
+            if not sep:
+                self.buffer = head
+                return
+            self.upgrade(head)
+
+        while self.upgraded and self.buffer:
+            frame = read_frame(self.buffer)
+            if frame is None:
+                break
+            (opcode, payload, masked, self.buffer) = frame
+            if not masked:
+                self.factory.unmasked += 1
+            self.frameReceived(opcode, payload)
+
+    def upgrade(self, head):
+        """ Answers the client's upgrade request """
+        headers = dict()
+        for line in head.split('\r\n')[1:]:
+            (name, _, value) = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if self.factory.refuse:
+            self.transport.write('HTTP/1.1 403 Forbidden\r\n\r\n')
+            self.transport.loseConnection()
+            return
+        accept = base64.b64encode(hashlib.sha1(
+            headers.get('sec-websocket-key', '') + guid
+            ).digest())
+        if self.factory.bad_accept:
+            accept = base64.b64encode('wrong')
+        self.transport.write('\r\n'.join((
+            'HTTP/1.1 101 Switching Protocols',
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            'Sec-WebSocket-Accept: {0}'.format(accept),
+            '',
+            '',
+            )))
+        self.upgraded = True
+
+    def frameReceived(self, opcode, payload):
+        if OP_TEXT == opcode:
+            message = json.loads(payload)
+            self.factory.messages.append(message)
+            if 'auth' == message.get('event'):
+                self.auth(message.get('data', dict()))
+        elif OP_PING == opcode:
+            self.transport.write(server_frame(OP_PONG, payload))
+        elif OP_PONG == opcode:
+            self.factory.pongs.append(payload)
+        elif OP_CLOSE == opcode:
+            self.factory.closes.append(payload)
+            self.transport.loseConnection()
+
+    def auth(self, data):
+        """ Answers a login as zmeventnotification does """
+        if (self.factory.username == data.get('user')
+                and self.factory.password == data.get('password')):
+            self.authenticated = True
+            self.send({
+                'event': 'auth',
+                'type': '',
+                'status': 'Success',
+                'reason': '',
+                'version': '6.1.28',
+                })
+        else:
+            self.send({
+                'event': 'auth',
+                'type': '',
+                'status': 'Fail',
+                'reason': 'BADAUTH',
+                })
+
+    def send(self, message, fragments=1):
+        """ Sends a JSON message, split over a number of frames """
+        text = json.dumps(message)
+        size = max(len(text) // fragments, 1)
+        pieces = [text[x:x + size] for x in range(0, len(text), size)]
+        for (index, piece) in enumerate(pieces):
+            self.transport.write(server_frame(
+                OP_CONTINUATION if index else OP_TEXT,
+                piece,
+                index == len(pieces) - 1
+                ))
+
+
+class FakeEventServer(Factory):
+    """ Accepts Event Server clients and pushes alarms to them """
+
+    protocol = FakeEventServerProtocol
+
+    def __init__(self, username='admin', password='secret'):
+        self.username = username
+        self.password = password
+        # Refuse the upgrade, or answer it with the wrong accept key
+        self.refuse = False
+        self.bad_accept = False
+        self.connections = list()
+        self.disconnects = 0
+        self.messages = list()
+        self.pongs = list()
+        self.closes = list()
+        # Client frames that weren't masked, as RFC 6455 requires
+        self.unmasked = 0
+        self.event_id = 0
+
+    def authenticated(self):
+        """ Returns the connections that have logged in """
+        return [x for x in self.connections if x.authenticated]
+
+    def alarm(self, monitor_ids, cause='Motion', fragments=1):
+        """ Pushes an alarm for each monitor to every logged in client """
+        events = list()
+        for monitor_id in monitor_ids:
+            self.event_id += 1
+            events.append({
+                'Name': 'Monitor {0}'.format(monitor_id),
+                'MonitorId': str(monitor_id),
+                'EventId': str(self.event_id),
+                'Cause': cause,
+                })
+        for connection in self.authenticated():
+            connection.send(
+                {'event': 'alarm', 'type': '', 'status': 'Success',
+                 'events': events},
+                fragments
+                )
+
+    def ping(self, payload='ping'):
+        """ Pings every client """
+        for connection in self.connections:
+            connection.transport.write(server_frame(OP_PING, payload))
+
+    def close(self, code=1001):
+        """ Starts a clean close of every connection """
+        for connection in self.connections:
+            connection.transport.write(server_frame(
+                OP_CLOSE,
+                struct.pack('!H', code)
+                ))
+
+    def drop(self):
+        """ Drops every connection without closing it cleanly """
+        for connection in list(self.connections):
+            connection.transport.abortConnection()
+
+
+def listen(server, port=0, interface='127.0.0.1'):
+    """ Starts serving a FakeEventServer, returning the listening port """
+    return reactor.listenTCP(port, server, interface=interface)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--monitors', type=int, default=10)
+    parser.add_argument('--interval', type=float, default=30.0)
+    parser.add_argument('--port', type=int, default=9000)
+    options = parser.parse_args()
+
+    server = FakeEventServer()
+    listen(server, options.port, '0.0.0.0')
+    LoopingCall(
+        server.alarm,
+        range(1, options.monitors + 1)
+        ).start(options.interval, now=False)
+    print('Fake Event Server with {0} monitors on port {1}'.format(
+        options.monitors,
+        options.port
+        ))
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
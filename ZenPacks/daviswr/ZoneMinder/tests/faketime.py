@@ -0,0 +1,11 @@
+""" A stand-in for the time module, for patching into lib modules """
+
+
+class FakeTime(object):
+    """ Reports a time that only moves when moved by hand """
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
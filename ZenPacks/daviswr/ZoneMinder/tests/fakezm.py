@@ -0,0 +1,528 @@
+""" A fake ZoneMinder server with any number of synthetic monitors
+
+Serves the API endpoints and Console page used by the modeler and
+datasource plugins, in the 1.32, 1.34, and early and late 1.36 Console
+layouts, counting requests and bytes sent. Run it standalone with:
+
+    python -m ZenPacks.daviswr.ZoneMinder.tests.fakezm --monitors 100
+
+then point zZoneMinderURL at http://localhost:8080/zm/
+"""
+
+import argparse
+import json
+import random
+import urllib
+import urlparse
+
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
+
+layouts = ('1.32', '1.34', '1.36-early', '1.36-late')
+
+# Version and API version reported for each layout
+versions = {
+    '1.32': ('1.32.3', '1.0'),
+    '1.34': ('1.34.26', '2.0'),
+    '1.36-early': ('1.36.5', '2.0'),
+    '1.36-late': ('1.36.33', '2.0'),
+    }
+
+functions = ('Modect', 'Record', 'Mocord', 'Nodect', 'Monitor', 'None')
+
+# Console Source column class for each online state
+online_classes = ('error', 'info', 'warn')
+
+# Configs the modeler reads, padded out with filler to a realistic count
+base_configs = {
+    'ZM_DYN_CURR_VERSION': None,
+    'ZM_DYN_DB_VERSION': None,
+    'ZM_EMAIL_ADDRESS': 'zm@example.com',
+    'ZM_LOG_DATABASE_LIMIT': '7 day',
+    'ZM_OPT_CONTROL': '1',
+    'ZM_OPT_FFMPEG': '1',
+    'ZM_OPT_USE_EVENTNOTIFICATION': '0',
+    }
+filler_configs = 250
+
+# Navbar links containing each layout's monitor marker, as a
+# customized or future Console header might
+navbar_marker_lines = {
+    '1.32': '<li><a id="monitor_id-menu" href="#">Monitors</a></li>',
+    '1.34': '<li><a class="zmMonitorMenu" href="#">Monitors</a></li>',
+    '1.36-early': '<li><a class="functionLnk-menu" href="#">Function</a></li>',
+    '1.36-late': '<li><a class="functionLnk nav-link" href="#">Function</a>'
+                 '</li>',
+    }
+
+login_page = ('<html><body><form name="loginForm" method="post">'
+              '<input type="hidden" name="action" value="login"/>'
+              '</form></body></html>')
+
+
+def volume_sizes(rnd):
+    """ Returns used, total, and event sizes, and percent used """
+    total = rnd.uniform(1, 9)
+    used = rnd.uniform(0.1, 0.9) * total
+    events = rnd.uniform(0.1, 0.9) * used
+    return (
+        '{0:.2f}TB'.format(used),
+        '{0:.2f}TB'.format(total),
+        '{0:.2f}TB'.format(events),
+        int(100 * used / total),
+        )
+
+
+def console_navbar(layout, volumes, markers=False):
+    """ Returns the Console header lines for a layout
+
+    With markers set, the layout's monitor marker appears before any
+    of the header's values.
+    """
+    lines = ['<div id="navbar">']
+    if markers:
+        lines.append(navbar_marker_lines[layout])
+    lines.append('<li>Load: 1.20</li>')
+    if '1.32' == layout:
+        lines.append('<li>DB:42/151</li>')
+    else:
+        lines.append('DB: 42/1000')
+    lines.append('<span class="">/dev/shm: 37%</span></li>')
+
+    for (name, (used, total, events, percent)) in volumes:
+        if layout.startswith('1.36'):
+            lines.append(
+                '<a class="dropdown-item " title="{0} of {1} {2} used by '
+                'events"'.format(used, total, events)
+                )
+            lines.append(
+                '\thref="?view=options&amp;tab=storage">{0}: {1}%</a>'.format(
+                    name,
+                    percent
+                    )
+                )
+        else:
+            lines.append(
+                '<span class="" title="{0} of {1} {2} used by events">'
+                '{3}: {4}%</span>'.format(used, total, events, name, percent)
+                )
+    lines.append('</div>')
+    return lines
+
+
+def console_table(layout):
+    """ Returns the lines opening the Console's monitor table """
+    if layout.startswith('1.36'):
+        return [
+            '<table',
+            '  id="consoleTable"',
+            '  data-locale="en-US"',
+            '  data-toggle="table"',
+            '  class="table table-sm table-hover"',
+            '>',
+            ]
+    return ['<table class="table table-striped table-hover '
+            'table-condensed consoleTable">']
+
+
+def console_rows(layout, monitor_id, state):
+    """ Returns the Console table lines for one monitor """
+    css = online_classes[state]
+    source = ('<td class="colSource"><a href="#"><span class="{0}Text">'
+              'cam{1}</span></a></td>'.format(css, monitor_id))
+    if '1.32' == layout:
+        return (
+            ['<tr id="monitor_id-{0}" title="{0}">'.format(monitor_id)]
+            + ['  <td class="colX">x</td>'] * 8
+            + ['  ' + source, '</tr>']
+            )
+    elif '1.34' == layout:
+        return [
+            '<tr><td class="colName"><a class="zmMonitor{0}" href="#">'
+            'Cam</a></td><td class="colSource"><span class="{1}Text">'
+            'cam{0}</span></td></tr>'.format(monitor_id, css)
+            ]
+    elif '1.36-early' == layout:
+        return (
+            ['<tr><td class="colFunction"><a class="functionLnk-{0}" '
+             'href="#">Modect</a></td>'.format(monitor_id)]
+            + ['  <td class="colX">x</td>'] * 4
+            + ['  ' + source, '</tr>']
+            )
+    return [
+        '<tr><td class="colFunction"><a class="functionLnk {0}Text" '
+        'data-mid="{1}" id="functionLnk-{1}" href="#">Modect</a></td>'.format(
+            css,
+            monitor_id
+            ),
+        '  <td class="colSource">cam{0}</td></tr>'.format(monitor_id),
+        ]
+
+
+def console_page(layout, monitors, volumes, bandwidth=0, capturing=100,
+                 markers=False):
+    """ Returns Console HTML
+
+    Takes a list of (monitor ID, online state) and a list of
+    (volume name, volume sizes) tuples.
+    """
+    lines = ['<html><body>'] + console_navbar(layout, volumes, markers)
+    lines.extend(console_table(layout))
+    for (monitor_id, state) in monitors:
+        lines.extend(console_rows(layout, monitor_id, state))
+    lines.append('<tr><td class="colFunction">{0:.2f}MB/s</td></tr>'.format(
+        bandwidth / 1024.0 ** 2
+        ))
+    lines.append('<span class="status"><label>Capturing</label>{0}%</span>'
+                 .format(capturing))
+    lines.extend(['</table>', '</body></html>'])
+    return '\n'.join(lines)
+
+
+class FakeZoneMinder(Resource):
+    """ Serves a synthetic ZoneMinder installation under /zm/ """
+
+    isLeaf = True
+
+    def __init__(self, monitors=10, volumes=3, layout='1.36-late',
+                 latency=0.0, seed=0):
+        Resource.__init__(self)
+        self.layout = layout
+        (self.version, self.apiversion) = versions[layout]
+        self.latency = latency
+        self.rnd = random.Random(seed)
+        # Monitor markers in the Console header
+        self.navbar_markers = False
+        # Whether conditions on monitors' IDs are applied, as they aren't
+        # by some API versions
+        self.filters = True
+        self.sessions = set()
+        self.active_state = 1
+        self.reset_counters()
+
+        self.volumes = list()
+        for index in range(volumes):
+            name = 'Default' if 0 == index else 'Storage{0}'.format(index)
+            self.volumes.append((index + 1, name, volume_sizes(self.rnd)))
+
+        self.monitors = list()
+        for index in range(1, monitors + 1):
+            self.monitors.append(self.make_monitor(index))
+
+        # (Id, MonitorId) of every event, oldest first
+        self.events = list()
+        self.add_events(monitors * 2)
+
+    def reset_counters(self):
+        self.requests = 0
+        self.bytes = 0
+        self.paths = dict()
+
+    def make_monitor(self, index):
+        function = self.rnd.choice(functions)
+        host = '10.{0}.{1}.{2}'.format(
+            index // 65536 % 256,
+            index // 256 % 256,
+            index % 256
+            )
+        monitor = {
+            'Id': str(index),
+            'Name': 'Camera {0}'.format(index),
+            'ServerId': '0',
+            'StorageId': str(index % max(len(self.volumes), 1) + 1),
+            'Type': self.rnd.choice(('Ffmpeg', 'Remote', 'Libvlc')),
+            'Function': function,
+            'Enabled': '0' if 'None' == function else '1',
+            'Protocol': 'rtsp',
+            'Method': 'rtpRtsp',
+            'Host': 'admin:secret@{0}'.format(host),
+            'Port': '554',
+            'Path': 'rtsp://admin:secret@{0}:554/stream1'.format(host),
+            'Width': '1920',
+            'Height': '1080',
+            'Colours': '4',
+            'MaxFPS': '15.00',
+            'AlarmMaxFPS': '',
+            'Controllable': '1' if 0 == index % 10 else '0',
+            'ControlId': '1' if 0 == index % 10 else '0',
+            'Sequence': str(index - 1),
+            }
+        running = 'None' != function and 0 != index % 17
+        status = {
+            'MonitorId': str(index),
+            'Status': 'Connected' if running else 'NotRunning',
+            'CaptureFPS': '15.00' if running else '0.00',
+            'AnalysisFPS': '15.00' if running and function in (
+                'Modect',
+                'Mocord',
+                ) else '0.00',
+            'CaptureBandwidth': str(self.rnd.randint(100000, 900000)
+                                    if running else 0),
+            }
+        return {'Monitor': monitor, 'Monitor_Status': status}
+
+    def online_state(self, item):
+        """ The Console online state of a monitor, as 0, 1, or 2 """
+        status = item['Monitor_Status']
+        if 'Connected' != status['Status']:
+            return 0
+        elif (float(status['AnalysisFPS']) == 0
+                and item['Monitor']['Function'] not in ('Monitor', 'Nodect')):
+            return 2
+        return 1
+
+    def capturing(self):
+        """ Rounded percentage of monitors with a Function capturing """
+        active = [
+            x for x in self.monitors if 'None' != x['Monitor']['Function']
+            ]
+        connected = [
+            x for x in active if 'Connected' == x['Monitor_Status']['Status']
+            ]
+        if not active:
+            return 0
+        return int(round(100.0 * len(connected) / len(active)))
+
+    def console(self):
+        """ Returns the Console page for the current monitors """
+        return console_page(
+            self.layout,
+            [(int(x['Monitor']['Id']), self.online_state(x))
+             for x in self.monitors],
+            [(name, sizes) for (_, name, sizes) in self.volumes],
+            sum(int(x['Monitor_Status']['CaptureBandwidth'])
+                for x in self.monitors),
+            self.capturing(),
+            self.navbar_markers
+            )
+
+    def add_events(self, count):
+        """ Creates new events on random active monitors """
+        candidates = [
+            int(x['Monitor']['Id']) for x in self.monitors
+            if x['Monitor']['Function'] in ('Modect', 'Record', 'Mocord')
+            ] or [1]
+        next_id = self.events[-1][0] + 1 if self.events else 1
+        for event_id in range(next_id, next_id + count):
+            self.events.append((event_id, self.rnd.choice(candidates)))
+
+    # Responses
+
+    def api_login(self, request, args):
+        session = 'fake{0}'.format(self.rnd.randint(0, 2**31))
+        self.sessions.add(session)
+        request.addCookie('ZMSESSID', session, path='/')
+        output = {
+            'credentials': 'auth=fake',
+            'append_password': 0,
+            'version': self.version,
+            'apiversion': self.apiversion,
+            }
+        if self.apiversion >= '2.0':
+            output.update({
+                'access_token': 'access' + session,
+                'access_token_expires': 3600,
+                'refresh_token': 'refresh' + session,
+                'refresh_token_expires': 86400,
+                })
+        return output
+
+    def api_monitors(self, request, args, conditions=()):
+        monitors = self.monitors
+        for condition in conditions if self.filters else ():
+            (field, _, value) = condition.partition(' !=:')
+            if 'Id' == field.strip():
+                excluded = value.strip('[]').split(',')
+                monitors = [
+                    x for x in monitors if x['Monitor']['Id'] not in excluded
+                    ]
+        if self.layout in ('1.32',):
+            return {'monitors': [
+                {'Monitor': x['Monitor']} for x in monitors
+                ]}
+        return {'monitors': monitors}
+
+    def api_configs(self, request, args):
+        configs = dict(base_configs)
+        configs['ZM_DYN_CURR_VERSION'] = self.version
+        configs['ZM_DYN_DB_VERSION'] = self.version
+        for index in range(filler_configs):
+            configs['ZM_FILLER_{0}'.format(index)] = str(index)
+        return {'configs': [
+            {'Config': {'Name': key, 'Value': value}}
+            for (key, value) in sorted(configs.items())
+            ]}
+
+    def api_controls(self, request, args):
+        return {'controls': [
+            {'Control': {'Id': '1', 'Name': 'ONVIF', 'Type': 'Ffmpeg'}},
+            ]}
+
+    def api_storage(self, request, args):
+        return {'storage': [{'Storage': {
+            'Id': str(storage_id),
+            'Name': name,
+            'Path': '/var/cache/zoneminder/{0}'.format(name.lower()),
+            'Type': 'local',
+            'DiskSpace': str(self.rnd.randint(10**9, 10**12)),
+            }} for (storage_id, name, _) in self.volumes]}
+
+    def api_states(self, request, args):
+        return {'states': [{'State': {
+            'Id': str(state_id),
+            'Name': 'state{0}'.format(state_id),
+            'IsActive': '1' if state_id == self.active_state else '0',
+            }} for state_id in (1, 2, 3)]}
+
+    def api_console_events(self, request, args):
+        counts = dict()
+        # Roughly the newest events, as the fake has no timestamps
+        for (_, monitor_id) in self.events[-len(self.monitors):]:
+            counts[str(monitor_id)] = counts.get(str(monitor_id), 0) + 1
+        # ZoneMinder returns an empty list rather than an empty object
+        return {'results': counts or list()}
+
+    def api_events(self, request, args, conditions):
+        events = self.events
+        for condition in conditions:
+            (field, _, value) = condition.partition(' >:')
+            if 'Id' == field.strip():
+                events = [x for x in events if x[0] > int(value)]
+        if 'desc' == args.get('direction'):
+            events = list(reversed(events))
+        limit = int(args.get('limit') or 25)
+        page = events[:limit]
+        return {
+            'events': [{'Event': {
+                'Id': str(event_id),
+                'MonitorId': str(monitor_id),
+                }} for (event_id, monitor_id) in page],
+            'pagination': {
+                'page': 1,
+                'current': len(page),
+                'count': len(events),
+                'nextPage': len(events) > limit,
+                'limit': limit,
+                },
+            }
+
+    def route(self, request, path, args):
+        """ Returns a response body, or None for a 404 """
+        if 'api/host/login.json' == path:
+            return json.dumps(self.api_login(request, args))
+
+        session = request.getCookie('ZMSESSID')
+        authorized = session in self.sessions or (
+            args.get('token', '').replace('access', '') in self.sessions
+            )
+
+        if 'index.php' == path:
+            if not authorized:
+                return login_page
+            return self.console()
+        elif not path.startswith('api/'):
+            return None
+        elif not authorized:
+            request.setResponseCode(401)
+            return json.dumps({'success': False})
+
+        simple = {
+            'api/host/getVersion.json': lambda: {
+                'version': self.version,
+                'apiversion': self.apiversion,
+                },
+            'api/host/logout.json': lambda: {'result': 'ok'},
+            'api/host/daemonCheck.json': lambda: {'result': 1},
+            'api/host/getLoad.json': lambda: {'load': [0.52, 0.48, 0.41]},
+            'api/configs.json': lambda: self.api_configs(request, args),
+            'api/controls.json': lambda: self.api_controls(request, args),
+            'api/monitors.json': lambda: self.api_monitors(request, args),
+            'api/states.json': lambda: self.api_states(request, args),
+            'api/storage.json': lambda: self.api_storage(request, args),
+            }
+        if path in simple:
+            return json.dumps(simple[path]())
+        elif path.startswith('api/events/consoleEvents/'):
+            return json.dumps(self.api_console_events(request, args))
+        elif path.startswith('api/monitors/daemonStatus/'):
+            return json.dumps({'status': True, 'statustext': 'running'})
+        elif path.startswith('api/events/index'):
+            conditions = path[len('api/events/index'):]
+            conditions = conditions.rsplit('.json', 1)[0].strip('/')
+            return json.dumps(self.api_events(
+                request,
+                args,
+                [x for x in conditions.split('/') if x]
+                ))
+        elif path.startswith('api/monitors/index'):
+            conditions = path[len('api/monitors/index'):]
+            conditions = conditions.rsplit('.json', 1)[0].strip('/')
+            return json.dumps(self.api_monitors(
+                request,
+                args,
+                [x for x in conditions.split('/') if x]
+                ))
+        return None
+
+    def render(self, request):
+        path = urllib.unquote(request.path)
+        if path.startswith('/zm/'):
+            path = path[len('/zm/'):]
+        args = dict(urlparse.parse_qsl(urlparse.urlparse(request.uri).query))
+
+        body = self.route(request, path, args)
+        if body is None:
+            request.setResponseCode(404)
+            body = 'Not Found'
+
+        self.requests += 1
+        self.bytes += len(body)
+        self.paths[path] = self.paths.get(path, 0) + 1
+
+        if not self.latency:
+            return body
+
+        def respond(_):
+            request.write(body)
+            request.finish()
+
+        deferLater(reactor, self.latency, lambda: None).addCallback(respond)
+        return NOT_DONE_YET
+
+
+def listen(server, port=0, interface='127.0.0.1'):
+    """ Starts serving a FakeZoneMinder, returning the listening port """
+    return reactor.listenTCP(port, Site(server), interface=interface)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--monitors', type=int, default=10)
+    parser.add_argument('--volumes', type=int, default=3)
+    parser.add_argument('--layout', choices=layouts, default='1.36-late')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--port', type=int, default=8080)
+    options = parser.parse_args()
+
+    listen(
+        FakeZoneMinder(
+            options.monitors,
+            options.volumes,
+            options.layout,
+            options.latency
+            ),
+        options.port,
+        '0.0.0.0'
+        )
+    print('Fake ZoneMinder {0} with {1} monitors on port {2}'.format(
+        options.layout,
+        options.monitors,
+        options.port
+        ))
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+""" Microbenchmarks of the zmUtil scrapers over a synthetic corpus
+
+Times each scraper against Console pages and monitors.json of every
+layout at increasing monitor counts, reporting the time per call,
+throughput, peak memory allocated, and how time scales with monitor
+count. Results can be saved as a baseline, and a later run compared
+with it exits non-zero if any scraper's throughput has regressed by
+more than the threshold:
+
+    python -m ZenPacks.daviswr.ZoneMinder.tests.scrapebench \\
+        --save baseline.json
+    python -m ZenPacks.daviswr.ZoneMinder.tests.scrapebench \\
+        --baseline baseline.json --threshold 0.25
+
+Times are divided by the fastest of a fixed calibration workload run
+before and after, to even out a machine's speed changing between runs.
+Baselines are still only comparable on the machine they were saved on.
+"""
+
+import argparse
+import json
+import math
+import sys
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmUtil
+from ZenPacks.daviswr.ZoneMinder.tests import corpus, fakezm
+
+# Bytes of the page fed to a ConsoleParser at a time, about the most
+# of a response body delivered at once
+chunk_size = 65536
+
+
+def stream_console(page, enough=None):
+    """ Feeds a ConsoleParser the page in chunks, as session.stream does """
+    parser = zmUtil.ConsoleParser()
+    html = page.html
+    for start in range(0, len(html), chunk_size):
+        parser.feed(html[start:start + chunk_size])
+        if enough is not None and enough(parser):
+            break
+    return parser.close()
+
+
+def stream_header(page):
+    return stream_console(page, zmUtil.ConsoleParser.header_parsed)
+
+
+def online_states(page):
+    return [zmUtil.monitor_online(x) for x in page.items]
+
+
+def summarize(page):
+    return zmUtil.summarize_monitors(page.items)
+
+
+def parse_api(page):
+    return json.loads(page.api)['monitors']
+
+
+def load_monitors(page):
+    return zmUtil.load_monitors(page.api)['monitors']
+
+
+# Name and function of each scraper, given a corpus Page
+scrapers = (
+    ('parse_console', lambda page: zmUtil.parse_console(page.html)),
+    ('ConsoleParser stream', stream_console),
+    ('ConsoleParser header', stream_header),
+    ('monitors.json', parse_api),
+    ('load_monitors', load_monitors),
+    ('monitor_online', online_states),
+    ('summarize_monitors', summarize),
+    )
+
+# Shortest time in seconds to run each scraper in one timing loop
+min_loop_time = 0.05
+
+header = '{0:<11} {1:>5} {2:<24} {3:>10} {4:>8} {5:>10}'
+row = '{0:<11} {1:>5} {2:<24} {3:>10.3f} {4:>8.1f} {5:>10}'
+
+
+def calibrate(repeat):
+    """ Returns the seconds taken by a fixed pure-Python workload """
+    def workload():
+        total = 0
+        for index in range(100000):
+            total += len(str(index).split('0'))
+        return total
+    return min(timeit.repeat(workload, number=1, repeat=max(repeat, 5)))
+
+
+def time_call(func, repeat):
+    """ Returns the fastest seconds per call of a function """
+    number = 1
+    while True:
+        elapsed = timeit.timeit(func, number=number)
+        if elapsed >= min_loop_time or number >= 10 ** 6:
+            break
+        number *= 10
+    best = min([elapsed] + timeit.repeat(func, number=number, repeat=repeat))
+    return best / number
+
+
+def peak_allocated(func):
+    """ Returns the peak KB allocated by a call, if it can be traced """
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1024.0
+    finally:
+        tracemalloc.stop()
+
+
+def scaling(results, layout, scraper):
+    """ Returns the slope of log time against log monitors
+
+    About 1 is linear in the monitor count, about 2 quadratic.
+    """
+    points = sorted(
+        (size, seconds) for ((x, size, y), seconds) in results.items()
+        if x == layout and y == scraper and seconds > 0
+        )
+    if len(points) < 2 or points[0][0] == points[-1][0]:
+        return None
+    ((small, fast), (large, slow)) = (points[0], points[-1])
+    return math.log(slow / fast) / math.log(float(large) / small)
+
+
+def run(options):
+    """ Benchmarks every scraper, returning results and failures """
+    before = calibrate(options.repeat)
+    print('calibration {0:.3f}s'.format(before))
+    print(header.format('layout', 'size', 'scraper', 'ms/call', 'MB/s',
+                        'alloc KB'))
+
+    results = dict()
+    failures = list()
+    for page in corpus.generate(options.layouts, options.sizes):
+        errors = page.check(zmUtil.parse_console(page.html))
+        if errors:
+            failures.append('{0}: parse_console wrong {1}'.format(
+                page.name,
+                ', '.join(errors)
+                ))
+
+        for (name, scraper) in scrapers:
+            def func():
+                return scraper(page)
+            seconds = time_call(func, options.repeat)
+            results[(page.layout, page.size, name)] = seconds
+            length = len(
+                page.api if name in ('monitors.json', 'load_monitors')
+                else page.html
+                )
+            allocated = peak_allocated(func)
+            print(row.format(
+                page.layout,
+                page.size,
+                name,
+                seconds * 1000,
+                length / seconds / 1024 ** 2,
+                '-' if allocated is None else '{0:.0f}'.format(allocated)
+                ))
+
+    print('')
+    for layout in options.layouts:
+        for (name, _) in scrapers:
+            slope = scaling(results, layout, name)
+            if slope is not None:
+                print('{0:<11} {1:<24} scaling {2:.2f}'.format(
+                    layout,
+                    name,
+                    slope
+                    ))
+
+    # Calibrated again after, so a slow start on a busy machine
+    # doesn't skew every result
+    after = calibrate(options.repeat)
+    calibration = min(before, after)
+    print('calibration {0:.3f}s after, using {1:.3f}s'.format(
+        after,
+        calibration
+        ))
+
+    normalized = dict(
+        ('/'.join(str(x) for x in key), seconds / calibration)
+        for (key, seconds) in results.items()
+        )
+    return (normalized, failures)
+
+
+def compare(normalized, baseline, threshold):
+    """ Returns the scrapers slower than the baseline by the threshold """
+    failures = list()
+    for (key, relative) in sorted(normalized.items()):
+        if key not in baseline:
+            continue
+        change = relative / baseline[key] - 1
+        if change > threshold:
+            failures.append('{0}: {1:.0%} slower than baseline'.format(
+                key,
+                change
+                ))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--sizes',
+        default=','.join(str(x) for x in corpus.sizes),
+        help='comma-separated monitor counts'
+        )
+    parser.add_argument(
+        '--layout',
+        dest='layouts',
+        action='append',
+        choices=fakezm.layouts,
+        help='Console layout, may be repeated, defaults to all'
+        )
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help='write results to a baseline file')
+    parser.add_argument('--baseline', help='compare with a baseline file')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.25,
+        help='fraction slower than the baseline that fails'
+        )
+    options = parser.parse_args()
+    options.sizes = [int(x) for x in options.sizes.split(',')]
+    options.layouts = options.layouts or fakezm.layouts
+
+    (normalized, failures) = run(options)
+
+    if options.save:
+        with open(options.save, 'w') as output:
+            json.dump(normalized, output, indent=2, sort_keys=True)
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            failures.extend(compare(
+                normalized,
+                json.load(baseline),
+                options.threshold
+                ))
+
+    for failure in failures:
+        print('FAIL {0}'.format(failure))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
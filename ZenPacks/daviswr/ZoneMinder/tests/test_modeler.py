@@ -0,0 +1,67 @@
+""" Tests of the modeler against a fake ZoneMinder server """
+
+import logging
+import urllib
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.trial import unittest
+from twisted.web.client import Agent, HTTPConnectionPool
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmHttp, zmServer, zmUtil
+from ZenPacks.daviswr.ZoneMinder.modeler.plugins.daviswr.python.ZoneMinder \
+    import ZoneMinder
+from ZenPacks.daviswr.ZoneMinder.tests import benchmark, fakezm
+
+LOG = logging.getLogger('zen.ZoneMinder.tests')
+
+
+class ModelerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakezm.FakeZoneMinder(monitors=5)
+        port = fakezm.listen(self.server)
+        self.addCleanup(port.stopListening)
+        self.base_url = 'http://127.0.0.1:{0}/zm/'.format(port.getHost().port)
+        self.addCleanup(zmServer.evict, self.base_url)
+
+        pool = HTTPConnectionPool(reactor, persistent=True)
+        self.addCleanup(pool.closeCachedConnections)
+        self.patch(zmHttp, 'agent', Agent(reactor, pool=pool))
+
+        self.device = benchmark.make_device('zm1', self.base_url, None)
+        self.device.zZoneMinderIgnoreMonitorId = ['2', '4']
+        self.filtered = urllib.unquote(zmUtil.monitors_path(['2', '4']))
+
+    @inlineCallbacks
+    def model(self):
+        """ Returns the IDs of the monitors collected """
+        self.server.reset_counters()
+        results = yield ZoneMinder().collect(self.device, LOG)
+        returnValue(sorted(
+            x['Monitor']['Id'] for x in results['monitors']
+            ))
+
+    @inlineCallbacks
+    def test_monitors_filtered(self):
+        monitors = yield self.model()
+        self.assertEqual(['1', '3', '5'], monitors)
+        self.assertEqual(1, self.server.paths.get(self.filtered))
+        self.assertNotIn('api/monitors.json', self.server.paths)
+
+        yield self.model()
+        self.assertEqual(1, self.server.paths.get(self.filtered))
+
+    @inlineCallbacks
+    def test_filter_ignored(self):
+        self.server.filters = False
+        # Left out by the modeler instead
+        monitors = yield self.model()
+        self.assertEqual(['1', '2', '3', '4', '5'], monitors)
+        self.assertEqual(1, self.server.paths.get(self.filtered))
+        self.assertEqual(1, self.server.paths.get('api/monitors.json'))
+
+        # Not tried again for the same server
+        yield self.model()
+        self.assertNotIn(self.filtered, self.server.paths)
+        self.assertEqual(1, self.server.paths.get('api/monitors.json'))
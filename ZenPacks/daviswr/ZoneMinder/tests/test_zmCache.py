@@ -0,0 +1,112 @@
+""" Tests of the short-lived response cache """
+
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.trial import unittest
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmCache
+from ZenPacks.daviswr.ZoneMinder.tests.faketime import FakeTime
+
+
+class Requests(object):
+    """ A request function returning queued results, counting calls """
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = 0
+
+    def __call__(self, path):
+        self.calls += 1
+        return self.results.pop(0)
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeTime()
+        self.patch(zmCache, 'time', self.clock)
+        self.cache = zmCache.ResponseCache('http://zm.example.com/zm/')
+
+    def test_cycle_ttl(self):
+        self.assertEqual(30, zmCache.cycle_ttl(60))
+        self.assertEqual(150, zmCache.cycle_ttl('300'))
+        self.assertEqual(0, zmCache.cycle_ttl(None))
+        self.assertEqual(0, zmCache.cycle_ttl(-60))
+
+    def test_hit_within_ttl(self):
+        request = Requests(succeed('first'), succeed('second'))
+        first = self.cache.fetch('console', 30, request, 'console')
+        self.clock.now += 29
+        second = self.cache.fetch('console', 30, request, 'console')
+
+        self.assertEqual('first', self.successResultOf(first))
+        self.assertEqual('first', self.successResultOf(second))
+        self.assertEqual(1, request.calls)
+        self.assertEqual({'hits': 1, 'misses': 1}, self.cache.stats())
+
+    def test_expires_after_ttl(self):
+        request = Requests(succeed('first'), succeed('second'))
+        self.cache.fetch('console', 30, request, 'console')
+        self.clock.now += 30
+        self.assertFalse(self.cache.has('console'))
+        second = self.cache.fetch('console', 30, request, 'console')
+
+        self.assertEqual('second', self.successResultOf(second))
+        self.assertEqual(2, request.calls)
+
+    def test_keys_cached_separately(self):
+        request = Requests(succeed('console'), succeed('events'))
+        self.cache.fetch('console', 30, request, 'console')
+        events = self.cache.fetch('events', 30, request, 'events')
+        self.assertEqual('events', self.successResultOf(events))
+        self.assertEqual(2, request.calls)
+
+    def test_zero_ttl_not_cached(self):
+        request = Requests(succeed('first'), succeed('second'))
+        self.cache.fetch('console', 0, request, 'console')
+        second = self.cache.fetch('console', 0, request, 'console')
+        self.assertEqual('second', self.successResultOf(second))
+
+    def test_in_flight_shared(self):
+        response = Deferred()
+        request = Requests(response)
+        first = self.cache.fetch('console', 30, request, 'console')
+        self.assertTrue(self.cache.has('console'))
+        second = self.cache.fetch('console', 30, request, 'console')
+        self.assertNoResult(second)
+
+        response.callback('page')
+        self.assertEqual('page', self.successResultOf(first))
+        self.assertEqual('page', self.successResultOf(second))
+        self.assertEqual(1, request.calls)
+
+    def test_failure_not_cached(self):
+        response = Deferred()
+        request = Requests(response, succeed('page'))
+        first = self.cache.fetch('console', 30, request, 'console')
+        second = self.cache.fetch('console', 30, request, 'console')
+
+        response.errback(ValueError('refused'))
+        self.failureResultOf(first, ValueError)
+        self.failureResultOf(second, ValueError)
+        self.assertFalse(self.cache.has('console'))
+
+        third = self.cache.fetch('console', 30, request, 'console')
+        self.assertEqual('page', self.successResultOf(third))
+        self.assertEqual(2, request.calls)
+
+    def test_exception_not_cached(self):
+        def request(path):
+            raise ValueError(path)
+        result = self.cache.fetch('console', 30, request, 'console')
+        self.failureResultOf(result, ValueError)
+        self.assertFalse(self.cache.has('console'))
+
+        result = self.cache.fetch('console', 30, fail, ValueError())
+        self.failureResultOf(result, ValueError)
+
+    def test_clear(self):
+        request = Requests(succeed('first'), succeed('second'))
+        self.cache.fetch('console', 30, request, 'console')
+        self.cache.clear()
+        second = self.cache.fetch('console', 30, request, 'console')
+        self.assertEqual('second', self.successResultOf(second))
@@ -0,0 +1,143 @@
+""" Tests of the per-server request limiter and circuit breaker
+
+    python -m twisted.trial ZenPacks.daviswr.ZoneMinder.tests
+"""
+
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.error import ConnectionRefusedError
+from twisted.trial import unittest
+from twisted.web.error import Error
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmCircuit
+from ZenPacks.daviswr.ZoneMinder.tests.faketime import FakeTime
+
+
+class CircuitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeTime()
+        self.patch(zmCircuit, 'time', self.clock)
+        self.circuit = zmCircuit.Circuit('http://zm.example.com/zm/')
+
+    def run_failures(self, count, error=None):
+        """ Runs requests that fail, returning the last Deferred """
+        for _ in range(count):
+            result = self.circuit.run(
+                fail,
+                error or ConnectionRefusedError()
+                )
+            result.addErrback(lambda x: x.trap(
+                ConnectionRefusedError,
+                Error
+                ))
+        return result
+
+    def test_closed_passes_result(self):
+        result = self.circuit.run(succeed, 'page')
+        self.assertEqual('page', self.successResultOf(result))
+        self.assertEqual(zmCircuit.CLOSED, self.circuit.state)
+
+    def test_opens_after_threshold(self):
+        self.run_failures(zmCircuit.failure_threshold - 1)
+        self.assertEqual(zmCircuit.CLOSED, self.circuit.state)
+
+        self.run_failures(1)
+        self.assertEqual(zmCircuit.OPEN, self.circuit.state)
+        self.assertTrue(self.circuit.is_open())
+
+        calls = list()
+        result = self.circuit.run(lambda: calls.append(1))
+        self.failureResultOf(result, zmCircuit.CircuitOpen)
+        self.assertEqual([], calls)
+
+    def test_success_resets_failures(self):
+        self.run_failures(zmCircuit.failure_threshold - 1)
+        self.successResultOf(self.circuit.run(succeed, 'page'))
+        self.run_failures(zmCircuit.failure_threshold - 1)
+        self.assertEqual(zmCircuit.CLOSED, self.circuit.state)
+
+    def test_client_errors_dont_count(self):
+        self.run_failures(zmCircuit.failure_threshold * 2, Error('404'))
+        self.assertEqual(zmCircuit.CLOSED, self.circuit.state)
+        self.assertEqual(0, self.circuit.failures)
+
+    def test_server_errors_count(self):
+        self.run_failures(zmCircuit.failure_threshold, Error('503'))
+        self.assertEqual(zmCircuit.OPEN, self.circuit.state)
+
+    def test_probe_success_closes(self):
+        self.run_failures(zmCircuit.failure_threshold)
+        self.clock.now += zmCircuit.reset_timeout
+
+        result = self.circuit.run(succeed, 'page')
+        self.assertEqual('page', self.successResultOf(result))
+        self.assertEqual(zmCircuit.CLOSED, self.circuit.state)
+        self.assertEqual(zmCircuit.reset_timeout, self.circuit.timeout)
+
+    def test_probe_failure_backs_off(self):
+        self.run_failures(zmCircuit.failure_threshold)
+        timeout = zmCircuit.reset_timeout
+        while timeout < zmCircuit.max_reset_timeout:
+            self.clock.now += self.circuit.timeout
+            self.run_failures(1)
+            timeout = min(timeout * 2, zmCircuit.max_reset_timeout)
+            self.assertEqual(zmCircuit.OPEN, self.circuit.state)
+            self.assertEqual(timeout, self.circuit.timeout)
+            self.assertEqual(
+                self.clock.now + timeout,
+                self.circuit.retry_at
+                )
+
+        self.clock.now += self.circuit.timeout
+        self.run_failures(1)
+        self.assertEqual(zmCircuit.max_reset_timeout, self.circuit.timeout)
+
+    def test_only_one_probe(self):
+        self.run_failures(zmCircuit.failure_threshold)
+        self.clock.now += zmCircuit.reset_timeout
+
+        probe = Deferred()
+        first = self.circuit.run(lambda: probe)
+        self.assertEqual(zmCircuit.HALF_OPEN, self.circuit.state)
+        second = self.circuit.run(succeed, 'page')
+        self.failureResultOf(second, zmCircuit.CircuitOpen)
+
+        probe.callback('page')
+        self.assertEqual('page', self.successResultOf(first))
+        self.assertEqual(zmCircuit.CLOSED, self.circuit.state)
+
+    def test_limit(self):
+        self.circuit.set_limit(2)
+        requests = [Deferred() for _ in range(3)]
+        calls = list()
+
+        def request(index):
+            calls.append(index)
+            return requests[index]
+
+        results = [self.circuit.run(request, x) for x in range(3)]
+        self.assertEqual([0, 1], calls)
+        requests[0].callback('first')
+        self.assertEqual([0, 1, 2], calls)
+        requests[1].callback('second')
+        requests[2].callback('third')
+        self.assertEqual(
+            ['first', 'second', 'third'],
+            [self.successResultOf(x) for x in results]
+            )
+
+    def test_invalid_limit_ignored(self):
+        semaphore = self.circuit.semaphore
+        for limit in (None, '', 'four', 0, -1):
+            self.circuit.set_limit(limit)
+        self.assertIdentical(semaphore, self.circuit.semaphore)
+
+    def test_event(self):
+        event = self.circuit.event('zm', 'ZoneMinder')
+        self.assertEqual(0, event['severity'])
+
+        self.run_failures(zmCircuit.failure_threshold)
+        event = self.circuit.event('zm', 'ZoneMinder')
+        self.assertEqual(4, event['severity'])
+        self.assertEqual('Daemon-Circuit', event['eventKey'])
+        self.assertIn('not responding', event['summary'])
@@ -0,0 +1,521 @@
+""" Tests of the Event Notification Server websocket client """
+
+import json
+import struct
+
+from twisted.internet import reactor
+from twisted.internet.address import IPv4Address
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import Clock, deferLater
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmEventServer, zmServer
+from ZenPacks.daviswr.ZoneMinder.tests import fakees
+
+
+@inlineCallbacks
+def eventually(predicate, timeout=5.0):
+    """ Waits for predicate() to be true, failing after timeout seconds """
+    waited = 0.0
+    while not predicate():
+        if waited >= timeout:
+            raise AssertionError('timed out waiting')
+        yield deferLater(reactor, 0.01, lambda: None)
+        waited += 0.01
+    returnValue(True)
+
+
+def client_frames(data):
+    """ Returns (opcode, payload, masked) of each client frame in data """
+    frames = list()
+    while data:
+        (opcode, payload, masked, data) = fakees.read_frame(data)
+        frames.append((opcode, payload, masked))
+    return frames
+
+
+class FramingTest(unittest.TestCase):
+
+    def test_accept_key(self):
+        # The example from RFC 6455 section 1.3
+        self.assertEqual(
+            's3pPLMBiTxaQ9kYGzzhZRbK+xOo=',
+            zmEventServer.accept_key('dGhlIHNhbXBsZSBub25jZQ==')
+            )
+
+    def test_client_frames_masked(self):
+        for length in (0, 5, 125, 126, 65535, 65536):
+            payload = 'x' * length
+            frame = zmEventServer.build_frame(zmEventServer.OP_TEXT, payload)
+            (opcode, received, masked, rest) = fakees.read_frame(frame)
+            self.assertEqual(zmEventServer.OP_TEXT, opcode)
+            self.assertEqual(payload, received)
+            self.assertTrue(masked)
+            self.assertEqual('', rest)
+
+    def test_parse_own_frames(self):
+        for length in (0, 125, 126, 65536):
+            payload = 'y' * length
+            frame = zmEventServer.build_frame(zmEventServer.OP_PING, payload)
+            self.assertEqual(
+                (True, zmEventServer.OP_PING, payload, 'rest'),
+                zmEventServer.parse_frame(frame + 'rest')
+                )
+
+    def test_parse_server_frames(self):
+        for length in (0, 125, 126, 65535, 65536):
+            payload = 'z' * length
+            frame = fakees.server_frame(fakees.OP_TEXT, payload, False)
+            self.assertEqual(
+                (False, zmEventServer.OP_TEXT, payload, ''),
+                zmEventServer.parse_frame(frame)
+                )
+
+    def test_parse_incomplete(self):
+        for length in (5, 126, 65536):
+            frame = fakees.server_frame(fakees.OP_TEXT, 'a' * length)
+            for end in (0, 1, 2, 3, len(frame) - 1):
+                self.assertIdentical(
+                    None,
+                    zmEventServer.parse_frame(frame[:end])
+                    )
+
+    def test_mask(self):
+        key = '\x01\x02\x03\x04'
+        masked = zmEventServer.mask('payload', key)
+        self.assertNotEqual('payload', masked)
+        self.assertEqual('payload', zmEventServer.mask(masked, key))
+
+
+class ProtocolTest(unittest.TestCase):
+    """ A client connection driven through a StringTransport """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.client = zmEventServer.EventServerClient(
+            'ws://zm.example.com:9000/',
+            'admin',
+            'secret',
+            self.clock
+            )
+        self.client.keep(300)
+        self.connection = self.client.buildProtocol(
+            IPv4Address('TCP', '127.0.0.1', 9000)
+            )
+        self.transport = StringTransport()
+        self.connection.makeConnection(self.transport)
+
+    def upgrade(self, accept=None):
+        request = self.transport.value()
+        self.transport.clear()
+        self.assertIn('GET / HTTP/1.1\r\n', request)
+        self.assertIn('Host: zm.example.com:9000\r\n', request)
+        self.assertIn('Sec-WebSocket-Version: 13\r\n', request)
+        self.connection.dataReceived(
+            'HTTP/1.1 101 Switching Protocols\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Accept: {0}\r\n\r\n'.format(
+                accept or zmEventServer.accept_key(self.connection.key)
+                )
+            )
+
+    def push(self, message, fragments=1, step=None):
+        """ Delivers a server message, optionally a few bytes at a time """
+        text = json.dumps(message)
+        size = max(len(text) // fragments, 1)
+        pieces = [text[x:x + size] for x in range(0, len(text), size)]
+        data = ''.join(
+            fakees.server_frame(
+                fakees.OP_CONTINUATION if index else fakees.OP_TEXT,
+                piece,
+                index == len(pieces) - 1
+                )
+            for (index, piece) in enumerate(pieces)
+            )
+        step = step or len(data)
+        for start in range(0, len(data), step):
+            self.connection.dataReceived(data[start:start + step])
+
+    def authenticate(self):
+        self.upgrade()
+        self.transport.clear()
+        self.push({'event': 'auth', 'status': 'Success'})
+
+    def alarm(self, *monitor_ids, **kwargs):
+        self.push({'event': 'alarm', 'events': [
+            {'MonitorId': x, 'EventId': kwargs.get('event_id'),
+             'Cause': kwargs.get('cause', 'Motion')}
+            for x in monitor_ids
+            ]})
+
+    def counts(self, consumer='Daemon', window=60):
+        return self.client.event_counts(consumer, window)
+
+    def test_handshake_sends_auth(self):
+        self.upgrade()
+        [(opcode, payload, masked)] = client_frames(self.transport.value())
+        self.assertEqual(fakees.OP_TEXT, opcode)
+        self.assertTrue(masked)
+        self.assertEqual(
+            {'event': 'auth',
+             'data': {'user': 'admin', 'password': 'secret'}},
+            json.loads(payload)
+            )
+
+    def test_handshake_split_across_reads(self):
+        response = (
+            'HTTP/1.1 101 Switching Protocols\r\n'
+            'Sec-WebSocket-Accept: {0}\r\n\r\n'.format(
+                zmEventServer.accept_key(self.connection.key)
+                )
+            )
+        self.transport.clear()
+        for char in response:
+            self.connection.dataReceived(char)
+        self.assertTrue(self.connection.handshaken)
+        self.assertEqual(1, len(client_frames(self.transport.value())))
+
+    def test_bad_accept_key(self):
+        self.upgrade('d3Jvbmc=')
+        self.assertFalse(self.connection.handshaken)
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_upgrade_refused(self):
+        self.transport.clear()
+        self.connection.dataReceived('HTTP/1.1 403 Forbidden\r\n\r\n')
+        self.assertFalse(self.connection.handshaken)
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_handshake_too_large(self):
+        self.connection.dataReceived('x' * (zmEventServer.max_handshake + 1))
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_auth_failure(self):
+        self.upgrade()
+        self.push({'event': 'auth', 'status': 'Fail', 'reason': 'BADAUTH'})
+        self.assertFalse(self.client.authenticated)
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_fragmented_messages(self):
+        self.authenticate()
+        self.counts()
+        self.alarm('1', event_id='10')
+        self.push(
+            {'event': 'alarm', 'events': [{'MonitorId': '2'}]},
+            fragments=3,
+            step=1
+            )
+        self.clock.advance(60)
+        self.assertEqual({'1': 1, '2': 1}, self.counts())
+
+    def test_ping_answered(self):
+        self.authenticate()
+        self.connection.dataReceived(
+            fakees.server_frame(fakees.OP_PING, 'hello')
+            )
+        self.assertEqual(
+            [(fakees.OP_PONG, 'hello', True)],
+            client_frames(self.transport.value())
+            )
+
+    def test_pings_sent_and_silence_drops(self):
+        self.authenticate()
+        self.clock.advance(zmEventServer.ping_interval)
+        self.assertEqual(
+            [(fakees.OP_PING, '', True)],
+            client_frames(self.transport.value())
+            )
+        self.connection.dataReceived(fakees.server_frame(fakees.OP_PONG))
+        self.clock.advance(zmEventServer.ping_interval * 2)
+        self.assertFalse(self.transport.disconnecting)
+        self.clock.advance(zmEventServer.ping_interval)
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_close_echoed(self):
+        self.authenticate()
+        self.connection.dataReceived(
+            fakees.server_frame(fakees.OP_CLOSE, struct.pack('!H', 1001))
+            )
+        self.assertEqual(
+            [(fakees.OP_CLOSE, struct.pack('!H', 1001), True)],
+            client_frames(self.transport.value())
+            )
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_first_read_sets_mark(self):
+        self.assertIdentical(None, self.counts())
+        self.authenticate()
+        self.alarm('1')
+        self.assertIdentical(None, self.counts())
+        self.clock.advance(60)
+        self.assertEqual({'1': 0}, self.counts())
+
+    def test_counts_since_last_read(self):
+        self.authenticate()
+        self.counts()
+        self.clock.advance(50)
+        self.alarm('1', '2')
+        self.clock.advance(10)
+        self.assertEqual({'1': 1, '2': 1}, self.counts())
+        # An event at the moment of a read is counted by that read
+        self.alarm('1')
+        self.assertEqual({'1': 1, '2': 0}, self.counts())
+        self.clock.advance(90)
+        self.assertEqual({'1': 0, '2': 0}, self.counts())
+
+    def test_consumers_counted_separately(self):
+        # Staggered and jittered cycles each count every event once
+        self.authenticate()
+        self.counts('Daemon')
+        self.clock.advance(30)
+        self.counts('Monitor')
+        for (when, consumer, expected) in (
+                (50, None, None),
+                (60, 'Daemon', 1),
+                (70, None, None),
+                (95, 'Monitor', 2),
+                (130, 'Daemon', 1),
+                (140, None, None),
+                (150, 'Monitor', 1),
+                (175, 'Daemon', 1),
+                ):
+            self.clock.advance(when - self.clock.seconds())
+            if consumer is None:
+                self.alarm('1')
+            else:
+                self.assertEqual(
+                    {'1': expected},
+                    self.counts(consumer),
+                    '{0} at {1}'.format(consumer, when)
+                    )
+
+    def test_lost_connection_sets_mark(self):
+        self.authenticate()
+        self.counts()
+        self.clock.advance(60)
+        self.connection.connectionLost(None)
+        self.assertIdentical(None, self.counts())
+
+        self.clock.advance(10)
+        self.connection = self.client.buildProtocol(None)
+        self.transport = StringTransport()
+        self.connection.makeConnection(self.transport)
+        self.authenticate()
+        # Events may have been missed since the last read
+        self.assertIdentical(None, self.counts())
+        self.alarm('1')
+        self.clock.advance(60)
+        self.assertEqual({'1': 1}, self.counts())
+
+    def test_stale_mark(self):
+        self.authenticate()
+        self.counts()
+        self.alarm('1')
+        self.clock.advance(60 * zmEventServer.zmEvents.stale_cycles + 1)
+        self.assertIdentical(None, self.counts())
+        self.alarm('1')
+        self.clock.advance(60)
+        self.assertEqual({'1': 1}, self.counts())
+
+    def test_old_events_and_marks_pruned(self):
+        self.authenticate()
+        self.counts('gone')
+        self.alarm('1')
+        self.clock.advance(300 * zmEventServer.zmEvents.stale_cycles + 1)
+        self.alarm('1')
+        self.assertEqual(1, len(self.client.events['1']))
+        self.assertNotIn('gone', self.client.marks)
+
+    def test_duplicate_event_counted_once(self):
+        self.authenticate()
+        self.counts()
+        self.alarm('1', event_id='10')
+        self.alarm('1', event_id='10')
+        self.clock.advance(60)
+        self.assertEqual({'1': 1}, self.counts())
+
+    def test_alarm_states(self):
+        self.assertIdentical(None, self.client.alarm_states())
+        self.authenticate()
+        self.alarm('1', '2')
+        self.assertEqual({'1': 1, '2': 1}, self.client.alarm_states())
+
+        self.alarm('1', cause='End:Motion')
+        self.assertEqual({'2': 1}, self.client.alarm_states())
+        self.clock.advance(zmEventServer.alarm_timeout)
+        self.assertEqual({'2': 0}, self.client.alarm_states())
+
+    def test_connection_lost_resets(self):
+        self.authenticate()
+        self.alarm('1')
+        self.connection.connectionLost(None)
+        self.assertFalse(self.client.authenticated)
+        self.assertIdentical(None, self.client.connection)
+        self.assertIdentical(None, self.client.alarm_states())
+
+
+class FakeSession(object):
+    """ The parts of a ZMSession get_client uses """
+
+    def __init__(self, server, username='admin', password='secret'):
+        self.server = server
+        self.username = username
+        self.password = password
+
+
+class SilentProtocol(fakees.FakeEventServerProtocol):
+    """ Never answers, leaving the client mid-handshake """
+
+    def dataReceived(self, data):
+        pass
+
+
+class ConnectionTest(unittest.TestCase):
+    """ Clients connected to a fakees.FakeEventServer """
+
+    def setUp(self):
+        self.clock = Clock()
+        self.server = fakees.FakeEventServer()
+        self.port = fakees.listen(self.server)
+        self.url = 'ws://127.0.0.1:{0}/'.format(self.port.getHost().port)
+        self.clients = list()
+
+    @inlineCallbacks
+    def tearDown(self):
+        for client in self.clients:
+            client.stop()
+        yield eventually(lambda: not self.server.connections)
+        yield self.port.stopListening()
+
+    def connect(self, password='secret'):
+        client = zmEventServer.EventServerClient(
+            self.url,
+            'admin',
+            password,
+            self.clock
+            )
+        self.clients.append(client)
+        client.keep(60)
+        client.start()
+        return client
+
+    @inlineCallbacks
+    def test_authenticates_and_counts(self):
+        client = self.connect()
+        yield eventually(lambda: client.authenticated)
+        self.assertEqual(1, len(self.server.authenticated()))
+        self.assertIdentical(None, client.event_counts('Daemon', 60))
+
+        self.server.alarm(['1', '2'], fragments=4)
+        self.server.alarm(['1'])
+        yield eventually(lambda: 2 == len(client.events.get('1', ())))
+        self.clock.advance(60)
+        self.assertEqual(
+            {'1': 2, '2': 1},
+            client.event_counts('Daemon', 60)
+            )
+        self.assertEqual(0, self.server.unmasked)
+
+    @inlineCallbacks
+    def test_ping_and_close(self):
+        client = self.connect()
+        yield eventually(lambda: client.authenticated)
+        self.server.ping('are you there')
+        yield eventually(lambda: self.server.pongs)
+        self.assertEqual(['are you there'], self.server.pongs)
+
+        self.server.close()
+        yield eventually(lambda: not self.server.connections)
+        self.assertEqual([struct.pack('!H', 1001)], self.server.closes)
+        self.assertFalse(client.authenticated)
+
+    @inlineCallbacks
+    def test_auth_failure(self):
+        client = self.connect('wrong')
+        yield eventually(lambda: self.server.disconnects)
+        self.assertFalse(client.authenticated)
+        self.assertEqual('auth', self.server.messages[0]['event'])
+        # Tried again later, with a growing delay
+        yield eventually(lambda: self.clock.getDelayedCalls())
+        self.assertEqual(1, client.retries)
+
+    @inlineCallbacks
+    def test_reconnect(self):
+        client = self.connect()
+        yield eventually(lambda: client.authenticated)
+        client.event_counts('Daemon', 60)
+        self.clock.advance(60)
+        self.assertEqual(dict(), client.event_counts('Daemon', 60))
+
+        self.server.drop()
+        yield eventually(lambda: not client.authenticated)
+        self.assertIdentical(None, client.event_counts('Daemon', 60))
+
+        yield eventually(lambda: self.clock.getDelayedCalls())
+        self.clock.advance(client.delay)
+        yield eventually(lambda: client.authenticated)
+        self.assertEqual(2, len(self.server.messages))
+        # Events may have been missed while disconnected
+        self.assertIdentical(None, client.event_counts('Daemon', 60))
+        # A successful login starts the delay over
+        self.assertEqual(zmEventServer.initial_delay, client.delay)
+
+    @inlineCallbacks
+    def test_refused_upgrade(self):
+        self.server.refuse = True
+        client = self.connect()
+        yield eventually(lambda: self.server.disconnects)
+        self.assertFalse(client.authenticated)
+        self.assertEqual(list(), self.server.messages)
+
+    @inlineCallbacks
+    def test_stop_during_handshake(self):
+        self.server.protocol = SilentProtocol
+        client = self.connect()
+        yield eventually(lambda: self.server.connections)
+        client.stop()
+        yield eventually(lambda: not self.server.connections)
+        self.assertEqual(list(), self.clock.getDelayedCalls())
+
+    @inlineCallbacks
+    def test_get_client_replaces_changed_settings(self):
+        self.patch(zmEventServer, 'EventServerClient', self.client_class())
+        zm = zmServer.ZMServer('http://127.0.0.1/zm/')
+        first = zmEventServer.get_client(FakeSession(zm), self.url, 60)
+        self.assertIdentical(
+            first,
+            zmEventServer.get_client(FakeSession(zm), self.url, 300)
+            )
+        self.assertEqual(300, first.window)
+        yield eventually(lambda: first.authenticated)
+
+        second = zmEventServer.get_client(
+            FakeSession(zm, password='changed'),
+            self.url,
+            60
+            )
+        self.assertNotIdentical(first, second)
+        self.assertIdentical(second, zm.event_client)
+        yield eventually(lambda: not first.authenticated)
+        self.assertEqual('disconnected', first.connector.state)
+        self.assertFalse(first.continueTrying)
+
+    def client_class(self):
+        """ Returns an EventServerClient that uses the test's clock """
+        base = zmEventServer.EventServerClient
+        clients = self.clients
+        clock = self.clock
+
+        class TestClient(base):
+            def __init__(self, url, username, password):
+                base.__init__(
+                    self,
+                    url,
+                    username,
+                    password,
+                    clock
+                    )
+                clients.append(self)
+        return TestClient
@@ -0,0 +1,140 @@
+""" Tests of incremental event counts from the per-server cursor """
+
+import json
+
+from twisted.internet.defer import succeed
+from twisted.trial import unittest
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmCache, zmEvents, zmServer
+from ZenPacks.daviswr.ZoneMinder.tests.faketime import FakeTime
+
+
+class FakeSession(object):
+    """ Answers the events API from a list of (ID, monitor ID) events """
+
+    def __init__(self, events=(), recent=None):
+        self.server = zmServer.ZMServer('http://zm.example.com/zm/')
+        self.base_url = self.server.base_url
+        self.cache = self.server.cache
+        self.events = list(events)
+        # consoleEvents results for the seed
+        self.recent = recent or dict()
+        self.paths = list()
+
+    def add(self, monitor_id, count=1):
+        last = self.events[-1][0] if self.events else 0
+        for event_id in range(last + 1, last + 1 + count):
+            self.events.append((event_id, monitor_id))
+
+    def get(self, path):
+        self.paths.append(path)
+        if path.startswith('api/events/consoleEvents/'):
+            response = {'results': self.recent or list()}
+        elif path == zmEvents.latest_path:
+            response = {'events': [self.item(x) for x in self.events[-1:]]}
+        else:
+            # api/events/index/Id >:mark.json?...&limit=N
+            mark = int(path.split('%3E:')[1].split('.json')[0])
+            limit = int(path.split('limit=')[1])
+            newer = [x for x in self.events if x[0] > mark]
+            response = {
+                'events': [self.item(x) for x in newer[:limit]],
+                'pagination': {'nextPage': len(newer) > limit},
+                }
+        return succeed(json.dumps(response))
+
+    def item(self, event):
+        return {'Event': {'Id': str(event[0]), 'MonitorId': event[1]}}
+
+
+class EventCursorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeTime()
+        self.patch(zmEvents, 'time', self.clock)
+        self.patch(zmCache, 'time', self.clock)
+        self.patch(zmEvents, 'page_size', 10)
+
+    def advance(self, session, cycletime=60):
+        return self.successResultOf(zmEvents.advance(session, cycletime))
+
+    def test_seed(self):
+        session = FakeSession([(41, '1'), (42, '2')], {'1': 3, '2': '1'})
+        self.assertEqual({'1': 3, '2': 1}, self.advance(session))
+        self.assertEqual((42, self.clock.now), session.server.cursor)
+        self.assertEqual(
+            zmEvents.seed_path.format(60),
+            session.paths[-1]
+            )
+
+    def test_seed_without_events(self):
+        session = FakeSession()
+        self.assertEqual(dict(), self.advance(session))
+        self.assertEqual(0, session.server.cursor[0])
+
+    def test_advance(self):
+        session = FakeSession([(1, '1')])
+        self.advance(session)
+        session.add('1', 2)
+        session.add('2')
+        self.clock.now += 60
+
+        self.assertEqual({'1': 2, '2': 1}, self.advance(session))
+        self.assertEqual((4, self.clock.now), session.server.cursor)
+
+        self.clock.now += 60
+        self.assertEqual(dict(), self.advance(session))
+        self.assertEqual(4, session.server.cursor[0])
+
+    def test_advance_pages(self):
+        session = FakeSession()
+        self.advance(session)
+        session.add('1', 25)
+        self.clock.now += 60
+
+        self.assertEqual({'1': 25}, self.advance(session))
+        self.assertEqual(25, session.server.cursor[0])
+        # Three pages of ten after the seed's two requests
+        self.assertEqual(5, len(session.paths))
+
+    def test_advance_stops_after_max_pages(self):
+        self.patch(zmEvents, 'max_pages', 2)
+        session = FakeSession()
+        self.advance(session)
+        session.add('1', 25)
+        self.clock.now += 60
+
+        self.assertEqual({'1': 20}, self.advance(session))
+        self.assertEqual(20, session.server.cursor[0])
+        self.clock.now += 60
+        self.assertEqual({'1': 5}, self.advance(session))
+
+    def test_stale_cursor_seeded_again(self):
+        session = FakeSession([(1, '1')], {'1': 2})
+        self.advance(session)
+        session.add('1', 100)
+
+        self.clock.now += 60 * zmEvents.stale_cycles
+        self.assertEqual({'1': 100}, self.advance(session))
+
+        session.add('1', 100)
+        self.clock.now += 60 * zmEvents.stale_cycles + 1
+        self.assertEqual({'1': 2}, self.advance(session))
+        self.assertEqual((201, self.clock.now), session.server.cursor)
+
+    def test_event_counts_shared_within_cycle(self):
+        session = FakeSession([(1, '1')])
+        self.advance(session)
+        session.add('2')
+        self.clock.now += 60
+
+        first = zmEvents.event_counts(session, 60)
+        session.add('2')
+        second = zmEvents.event_counts(session, 60)
+        self.assertEqual({'2': 1}, self.successResultOf(first))
+        self.assertEqual({'2': 1}, self.successResultOf(second))
+
+        self.clock.now += 60
+        third = zmEvents.event_counts(session, 60)
+        self.assertEqual({'2': 1}, self.successResultOf(third))
+        self.assertEqual(3, session.server.cursor[0])
@@ -0,0 +1,334 @@
+""" Tests of shared ZoneMinder login sessions and the server registry """
+
+import json
+
+from twisted.internet.defer import (
+    Deferred,
+    fail,
+    maybeDeferred,
+    succeed
+    )
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twisted.web.client import ResponseDone
+from twisted.web.error import Error
+
+from ZenPacks.daviswr.ZoneMinder.lib import (
+    zmHttp,
+    zmSchedule,
+    zmServer,
+    zmSession,
+    )
+from ZenPacks.daviswr.ZoneMinder.tests.faketime import FakeTime
+
+base_url = 'http://zm.example.com/zm/'
+
+
+class FakeHttp(object):
+    """ Stands in for zmHttp, answering logins and queued pages """
+
+    def __init__(self):
+        self.logins = 0
+        self.refreshes = 0
+        self.urls = list()
+        # Responses to page requests, Deferreds or strings, in order
+        self.pages = list()
+        # Deferred to answer the next login with, if any
+        self.login_response = None
+        self.refresh_fails = False
+
+    def tokens(self, count):
+        return json.dumps({
+            'access_token': 'access{0}'.format(count),
+            'access_token_expires': 3600,
+            'refresh_token': 'refresh{0}'.format(count),
+            'refresh_token_expires': 86400,
+            })
+
+    def get_page(self, url, method='GET', cookies=None):
+        self.urls.append(url)
+        if 'host/login.json?user=' in url:
+            self.logins += 1
+            cookies['ZMSESSID'] = 'session{0}'.format(self.logins)
+            response = self.tokens(self.logins)
+            if self.login_response is not None:
+                (waiting, self.login_response) = (self.login_response, None)
+                return waiting.addCallback(lambda _: response)
+            return succeed(response)
+        elif 'host/login.json?token=' in url:
+            self.refreshes += 1
+            if self.refresh_fails:
+                return fail(Error('401'))
+            return succeed(json.dumps({
+                'access_token': 'renewed{0}'.format(self.refreshes),
+                'access_token_expires': 3600,
+                }))
+        page = self.pages.pop(0) if self.pages else 'page'
+        return page if isinstance(page, Deferred) else succeed(page)
+
+    def stream(self, url, feed, cookies=None):
+        self.urls.append(url)
+        chunks = self.pages.pop(0)
+        for chunk in chunks:
+            enough = list()
+            maybeDeferred(feed, chunk).addCallback(enough.append)
+            if enough[0]:
+                break
+        return succeed(sum(len(x) for x in chunks))
+
+
+class TextParser(object):
+    """ A streaming parser returning the text it was fed """
+
+    def __init__(self):
+        self.chunks = list()
+
+    def feed(self, chunk):
+        self.chunks.append(chunk)
+
+    def close(self):
+        return ''.join(self.chunks)
+
+
+class SessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.http = FakeHttp()
+        self.patch(zmHttp, 'get_page', self.http.get_page)
+        self.patch(zmHttp, 'stream', self.http.stream)
+        self.clock = FakeTime()
+        self.patch(zmSession, 'time', self.clock)
+        self.session = zmSession.ZMSession(
+            zmServer.ZMServer(base_url),
+            'admin',
+            'secret'
+            )
+
+    def test_login_reused(self):
+        self.successResultOf(self.session.get('api/monitors.json'))
+        self.successResultOf(self.session.get('api/monitors.json'))
+        self.assertEqual(1, self.http.logins)
+        self.assertTrue(self.http.urls[-1].endswith('?token=access1'))
+
+    def test_token_not_sent_to_console(self):
+        self.successResultOf(self.session.get('index.php?view=console'))
+        self.assertEqual(
+            '{0}index.php?view=console'.format(base_url),
+            self.http.urls[-1]
+            )
+
+    def test_concurrent_callers_login_once(self):
+        login = self.http.login_response = Deferred()
+        first = self.session.get('api/monitors.json')
+        second = self.session.get('api/host/daemonCheck.json')
+        self.assertNoResult(first)
+        self.assertNoResult(second)
+
+        login.callback(None)
+        self.assertEqual('page', self.successResultOf(first))
+        self.assertEqual('page', self.successResultOf(second))
+        self.assertEqual(1, self.http.logins)
+
+    def test_expired_access_token_refreshed(self):
+        self.successResultOf(self.session.get('api/monitors.json'))
+        self.clock.now += 3600
+
+        self.successResultOf(self.session.get('api/monitors.json'))
+        self.assertEqual(1, self.http.logins)
+        self.assertEqual(1, self.http.refreshes)
+        self.assertTrue(self.http.urls[-1].endswith('?token=renewed1'))
+
+    def test_refresh_failure_logs_in(self):
+        self.successResultOf(self.session.get('api/monitors.json'))
+        self.clock.now += 3600
+        self.http.refresh_fails = True
+
+        self.successResultOf(self.session.get('api/monitors.json'))
+        self.assertEqual(2, self.http.logins)
+        self.assertTrue(self.http.urls[-1].endswith('?token=access2'))
+
+    def test_expired_refresh_token_logs_in(self):
+        self.successResultOf(self.session.get('api/monitors.json'))
+        self.clock.now += 86400
+
+        self.successResultOf(self.session.get('api/monitors.json'))
+        self.assertEqual(0, self.http.refreshes)
+        self.assertEqual(2, self.http.logins)
+
+    def test_rejected_session_retried_once(self):
+        self.http.pages = [fail(Error('401')), 'page']
+        result = self.session.get('api/monitors.json')
+        self.assertEqual('page', self.successResultOf(result))
+        self.assertEqual(2, self.http.logins)
+
+        self.http.pages = [fail(Error('401')), fail(Error('401'))]
+        result = self.session.get('api/monitors.json')
+        self.failureResultOf(result, Error)
+        self.assertEqual(3, self.http.logins)
+
+    def test_login_marker_retried_once(self):
+        login_page = '<input name="action" value="login"/>'
+        self.http.pages = [login_page, 'page']
+        result = self.session.get('index.php?view=console')
+        self.assertEqual('page', self.successResultOf(result))
+        self.assertEqual(2, self.http.logins)
+
+        self.http.pages = [login_page, login_page]
+        result = self.session.get('index.php?view=console')
+        self.assertEqual(login_page, self.successResultOf(result))
+        self.assertEqual(3, self.http.logins)
+
+    def test_login_marker_ignored_in_api(self):
+        page = '<input {0}/>'.format(zmSession.login_marker)
+        self.http.pages = [page]
+        result = self.session.get('api/configs.json')
+        self.assertEqual(page, self.successResultOf(result))
+        self.assertEqual(1, self.http.logins)
+
+    def test_stream_login_marker_split_across_chunks(self):
+        self.http.pages = [
+            ['<form><input name="action" ', 'value="login"/></form>'],
+            ['console\n', 'page\n'],
+            ]
+        result = self.session.stream('index.php?view=console', TextParser)
+        self.assertEqual('console\npage\n', self.successResultOf(result))
+        self.assertEqual(2, self.http.logins)
+
+    def test_stream_stops_when_enough(self):
+        # Parse every chunk as it's received
+        self.patch(zmSession, 'stream_batch', 1)
+        self.http.pages = [['header\n', 'monitors\n']]
+        result = self.session.stream(
+            'index.php?view=console',
+            TextParser,
+            lambda parser: 'header\n' in parser.chunks
+            )
+        self.assertEqual('header\n', self.successResultOf(result))
+
+    def test_login_denied(self):
+        self.patch(
+            zmHttp,
+            'get_page',
+            lambda url, method, cookies: succeed('Login denied')
+            )
+        result = self.session.get('api/monitors.json')
+        self.failureResultOf(result, zmSession.LoginError)
+
+
+class ServerRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(zmServer, 'servers', dict())
+        self.clock = FakeTime()
+        self.patch(zmServer, 'time', self.clock)
+
+    def test_sessions_share_server(self):
+        session = zmSession.get_session(base_url, 'admin', 'secret', 8)
+        self.assertIdentical(
+            session,
+            zmSession.get_session(base_url, 'admin', 'secret')
+            )
+        other = zmSession.get_session(base_url, 'viewer', 'secret')
+        self.assertNotIdentical(session, other)
+        self.assertIdentical(session.server, other.server)
+        self.assertIdentical(session.circuit, other.circuit)
+        self.assertIdentical(session.cache, other.cache)
+        self.assertEqual(8, session.circuit.semaphore.limit)
+
+    def test_idle_server_evicted(self):
+        server = zmServer.get_server(base_url)
+        stopped = list()
+        server.event_client = type(
+            'Client',
+            (object,),
+            {'stop': lambda self: stopped.append(self)}
+            )()
+
+        self.clock.now += zmServer.idle_timeout
+        zmServer.get_server('http://other.example.com/zm/')
+        self.assertIn(base_url, zmServer.servers)
+
+        self.clock.now += 1
+        zmServer.get_server('http://other.example.com/zm/')
+        self.assertNotIn(base_url, zmServer.servers)
+        self.assertEqual(1, len(stopped))
+        self.assertNotIdentical(server, zmServer.get_server(base_url))
+
+    def test_device_state_evicted_with_server(self):
+        session = zmSession.get_session(base_url, 'admin', 'secret')
+        zmSchedule.update(session, 'zm1', [
+            {'Monitor': {'Id': '1', 'Function': 'None', 'Enabled': '0'}},
+            ])
+        zmSchedule.state_changed(session, 'zm1', 1)
+        self.assertEqual(
+            ('None', False),
+            zmSchedule.get_function(session, 'zm1', '1', 'Modect', '1')
+            )
+
+        self.clock.now += zmServer.idle_timeout + 1
+        session = zmSession.get_session(base_url, 'admin', 'secret')
+        self.assertEqual(
+            ('Modect', True),
+            zmSchedule.get_function(session, 'zm1', '1', 'Modect', '1')
+            )
+        self.assertFalse(zmSchedule.state_changed(session, 'zm1', 2))
+
+    def test_evict(self):
+        server = zmServer.get_server(base_url)
+        zmServer.evict(base_url)
+        zmServer.evict(base_url)
+        self.assertNotIdentical(server, zmServer.get_server(base_url))
+
+
+class StreamProtocolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fed = list()
+        self.parsing = None
+        self.protocol = zmHttp.StreamProtocol(self.feed)
+        self.transport = StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def feed(self, data):
+        self.fed.append(data)
+        self.parsing = Deferred()
+        return self.parsing
+
+    def test_paused_while_parsing(self):
+        self.protocol.dataReceived('one')
+        self.assertEqual('paused', self.transport.producerState)
+        self.protocol.dataReceived('two')
+        self.protocol.dataReceived('three')
+        self.assertEqual(['one'], self.fed)
+
+        self.parsing.callback(False)
+        self.assertEqual(['one', 'twothree'], self.fed)
+        self.assertEqual('paused', self.transport.producerState)
+        self.parsing.callback(False)
+        self.assertEqual('producing', self.transport.producerState)
+
+    def test_body_ends_while_parsing(self):
+        self.protocol.dataReceived('one')
+        self.protocol.dataReceived('two')
+        self.protocol.connectionLost(Failure(ResponseDone()))
+        self.assertNoResult(self.protocol.finished)
+
+        self.parsing.callback(False)
+        self.assertNoResult(self.protocol.finished)
+        self.parsing.callback(False)
+        self.assertEqual(6, self.successResultOf(self.protocol.finished))
+
+    def test_enough_after_parsing(self):
+        self.protocol.dataReceived('one')
+        self.protocol.dataReceived('two')
+        self.parsing.callback(True)
+        self.assertEqual(['one'], self.fed)
+        self.assertEqual('stopped', self.transport.producerState)
+        self.assertEqual(6, self.successResultOf(self.protocol.finished))
+
+    def test_parse_failed(self):
+        self.protocol.dataReceived('one')
+        self.parsing.errback(ValueError('unparseable'))
+        self.assertEqual('stopped', self.transport.producerState)
+        self.failureResultOf(self.protocol.finished, ValueError)
@@ -0,0 +1,127 @@
+""" Tests of the single-pass Console page parser """
+
+from twisted.trial import unittest
+
+from ZenPacks.daviswr.ZoneMinder.lib import zmUtil
+from ZenPacks.daviswr.ZoneMinder.tests import corpus, fakezm
+
+# Chunk sizes pages are fed in, down to a byte at a time
+chunk_sizes = (1, 2, 3, 7, 64, 1000, 65536)
+
+
+def feed(html, size, enough=None):
+    """ Returns the ConsoleParser after feeding html in chunks of size """
+    parser = zmUtil.ConsoleParser()
+    for start in range(0, len(html), size):
+        parser.feed(html[start:start + size])
+        if enough is not None and enough(parser):
+            break
+    return parser
+
+
+def values(snapshot):
+    """ Returns a ConsoleSnapshot's values, to compare two snapshots """
+    return dict(vars(snapshot))
+
+
+class ConsoleParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pages = [corpus.Page(x, 20) for x in fakezm.layouts]
+
+    def test_whole_page(self):
+        for page in self.pages:
+            self.assertEqual(
+                list(),
+                page.check(zmUtil.parse_console(page.html)),
+                page.name
+                )
+
+    def test_any_chunk_size(self):
+        for page in self.pages:
+            expected = values(zmUtil.parse_console(page.html))
+            for size in chunk_sizes:
+                snapshot = feed(page.html, size).close()
+                self.assertEqual(
+                    expected,
+                    values(snapshot),
+                    '{0} in chunks of {1}'.format(page.name, size)
+                    )
+
+    def test_crlf_line_endings(self):
+        for page in self.pages:
+            expected = values(zmUtil.parse_console(page.html))
+            html = page.html.replace('\n', '\r\n')
+            for size in chunk_sizes:
+                self.assertEqual(
+                    expected,
+                    values(feed(html, size).close()),
+                    '{0} in chunks of {1}'.format(page.name, size)
+                    )
+
+    def test_volume_split_across_lines(self):
+        html = '\n'.join((
+            '<a class="dropdown-item " title="2.38TB of 5.41TB 2.11TB '
+            'used by events"',
+            '\thref="?view=options&amp;tab=storage">Storage2: 44%</a>',
+            '<span class="" title="390.06GB of 2.69TB 249.93GB used by '
+            'events">Storage3: 14%</span>',
+            ))
+        for size in chunk_sizes:
+            volumes = feed(html, size).close().volumes
+            self.assertEqual(['Storage2', 'Storage3'], sorted(volumes))
+            self.assertEqual(44, volumes['Storage2']['percent'])
+            self.assertEqual(14, volumes['Storage3']['percent'])
+
+    def test_state_on_later_line(self):
+        # 1.32 and early 1.36 put the state several lines after the ID
+        for page in self.pages:
+            if page.layout not in ('1.32', '1.36-early'):
+                continue
+            for size in chunk_sizes:
+                snapshot = feed(page.html, size).close()
+                self.assertEqual(page.monitors, snapshot.monitors)
+
+    def check_header(self, page, size):
+        """ Checks what's parsed of a page up to its monitor table """
+        parser = feed(page.html, size, zmUtil.ConsoleParser.header_parsed)
+        self.assertTrue(parser.header_parsed(), page.name)
+        snapshot = parser.close()
+        self.assertEqual(37, snapshot.shm, page.name)
+        self.assertEqual(42, snapshot.db['db-used'], page.name)
+        self.assertEqual(
+            page.volumes - set(['Default']),
+            set(snapshot.volumes) - set(['Default']),
+            page.name
+            )
+
+    def test_header_parsed(self):
+        for page in self.pages:
+            header = page.html.split('<table')[0]
+            parser = feed(header, 64)
+            self.assertFalse(parser.header_parsed(), page.name)
+            for size in chunk_sizes:
+                self.check_header(page, size)
+
+    def test_marker_in_header(self):
+        for layout in fakezm.layouts:
+            page = corpus.Page(layout, 20, navbar_markers=True)
+            self.assertIn(fakezm.navbar_marker_lines[layout], page.html)
+            for size in chunk_sizes:
+                self.check_header(page, size)
+
+    def test_header_without_table(self):
+        # An unrecognized table is read to the end rather than cut short
+        html = self.pages[0].html.replace('consoleTable', 'monitorTable')
+        parser = feed(html, 64, zmUtil.ConsoleParser.header_parsed)
+        self.assertFalse(parser.header_parsed())
+        self.assertEqual(
+            self.pages[0].monitors,
+            parser.close().monitors
+            )
+
+    def test_empty_page(self):
+        snapshot = feed('', 1).close()
+        self.assertIdentical(None, snapshot.layout)
+        self.assertEqual(dict(), snapshot.monitors)
+        self.assertEqual('', snapshot.shm)
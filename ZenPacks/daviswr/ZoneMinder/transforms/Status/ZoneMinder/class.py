@@ -21,11 +21,18 @@ if evt.eventKey.endswith('Daemon-Status'):
         }
 
 elif evt.eventKey.endswith('Daemon-RunState'):
-    # Run State has changed, remodel to get new monitor functions
-    # Model in background so transform isn't delayed
-    device.collectDevice(background=True)
+    # Run State has changed, the Daemon datasource updates
+    # monitor functions itself rather than remodeling
     evt._action = 'history'
 
+elif evt.eventKey.endswith('Daemon-Circuit'):
+    # Summary set by the datasource, requests are suspended
+    # while the server isn't responding
+    severities = {
+        0: SEVERITY_ERROR,
+        1: SEVERITY_CLEAR,
+        }
+
 elif evt.eventKey.endswith('Daemon-Capturing'):
     if SEVERITY_CLEAR == evt.severity:
         evt.summary = 'All monitors are capturing'